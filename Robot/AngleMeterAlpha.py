@@ -7,10 +7,23 @@
 
 
 from Kalman import KalmanAngle
-import smbus2			#import SMBus module of I2C
+from mpu6050 import read_motion_burst
+from i2c_bus import open_bus, PRIORITY_IMU	#shared SMBus handle for I2C
+from gpio_backend import open_edge_pin
+from imu_calibration import GyroBiasTracker
+import sensor_decode
 import time
 import math
 import threading
+from collections import namedtuple
+from math import radians
+
+
+#One complete orientation update. Records are never modified after they are published.
+#yaw is only estimated when a fusion filter is used
+Orientation = namedtuple('Orientation', ['timestamp', 'sequence', 'pitch', 'roll',
+					'kalman_pitch', 'kalman_roll', 'compl_pitch', 'compl_roll', 'yaw'],
+					defaults=(0.0,))
 
 
 class AngleMeterAlpha:
@@ -39,20 +52,18 @@ class AngleMeterAlpha:
 
 
 		def read_raw_data(self, addr):
-				#Accelero and Gyro value are 16-bit
-				high = self.bus.read_byte_data(self.DeviceAddress, addr)
-				low = self.bus.read_byte_data(self.DeviceAddress, addr+1)
-
-				#concatenate higher and lower value
-				value = ((high << 8) | low)
+				#Accelero and Gyro value are 16-bit, high byte first
+				raw_data = self.bus.read_i2c_block_data(self.DeviceAddress, addr, 2)
 
 				#to get signed value from mpu6050
-				if(value > 32768):
-						value = value - 65536
-				return value
+				return sensor_decode.int16_be(raw_data)
+
+		def read_motion(self):
+				#Accel, temperature and gyro in a single 14 byte transaction
+				accX, accY, accZ, temp, gyroX, gyroY, gyroZ = read_motion_burst(self.bus, self.DeviceAddress)
+				return accX, accY, accZ, gyroX, gyroY, gyroZ
 
 
-		bus = smbus2.SMBus(1) 	# or bus = smbus.SMBus(0) for older version boards
 		DeviceAddress = 0x68   # MPU6050 device address
 
 		def measureAngles(self):
@@ -64,20 +75,13 @@ class AngleMeterAlpha:
 				radToDeg = 57.2957786
 				kalAngleX = 0
 				kalAngleY = 0
-				# some MPU6050 Registers and their Address
 
-				ACCEL_XOUT_H = 0x3B
-				ACCEL_YOUT_H = 0x3D
-				ACCEL_ZOUT_H = 0x3F
-				GYRO_XOUT_H = 0x43
-				GYRO_YOUT_H = 0x45
-				GYRO_ZOUT_H = 0x47
-
-				time.sleep(1)
+				edge_time = None
+				if self.data_ready is not None:
+					#Start from a fresh sample rather than sleeping a fixed time
+					edge_time = self.data_ready.wait_for_edge(self.DataReadyTimeout)
 				# Read Accelerometer raw value
-				accX = self.read_raw_data(ACCEL_XOUT_H)
-				accY = self.read_raw_data(ACCEL_YOUT_H)
-				accZ = self.read_raw_data(ACCEL_ZOUT_H)
+				accX, accY, accZ, gyroX, gyroY, gyroZ = self.read_motion()
 
 				# print(accX,accY,accZ)
 				# print(math.sqrt((accY**2)+(accZ**2)))
@@ -95,7 +99,13 @@ class AngleMeterAlpha:
 				compAngleX = roll;
 				compAngleY = pitch;
 
-				timer = time.time()
+				if self.data_ready is None:
+					timer = time.time()
+				elif edge_time is not None:
+					timer = edge_time
+				else:
+					#Edge timestamps come from the monotonic clock
+					timer = time.monotonic()
 				flag = 0
 
 				while True:
@@ -105,18 +115,32 @@ class AngleMeterAlpha:
 							flag=0
 							continue
 						try:
-							#Read Accelerometer raw value
-							accX = self.read_raw_data(ACCEL_XOUT_H)
-							accY = self.read_raw_data(ACCEL_YOUT_H)
-							accZ = self.read_raw_data(ACCEL_ZOUT_H)
-
-							#Read Gyroscope raw value
-							gyroX = self.read_raw_data(GYRO_XOUT_H)
-							gyroY = self.read_raw_data(GYRO_YOUT_H)
-							gyroZ = self.read_raw_data(GYRO_ZOUT_H)
+							if self.data_ready is not None:
+								#Sleep until the MPU6050 raises DATA_RDY on its INT pin
+								edge_time = self.data_ready.wait_for_edge(self.DataReadyTimeout)
+								if edge_time is None:
+									raise IOError("No data ready interrupt from the MPU6050")
+
+							#Read Accelerometer and Gyroscope raw values from the same sample
+							accX, accY, accZ, gyroX, gyroY, gyroZ = self.read_motion()
+							#Remove the gyro bias, which is learned whenever the robot stands still
+							gyroX, gyroY, gyroZ = self.gyroBias.update((gyroX, gyroY, gyroZ), (accX, accY, accZ))
+
+							if self.data_ready is not None:
+								#dt is the exact spacing between the two samples
+								dt = edge_time - timer
+								timer = edge_time
+							else:
+								dt = time.time() - timer
+								timer = time.time()
 
-							dt = time.time() - timer
-							timer = time.time()
+							if self.fusion is not None:
+								#One AHRS update replaces the Kalman and complementary filters below
+								self.updateFusion(accX, accY, accZ, gyroX, gyroY, gyroZ, dt,
+										edge_time if self.data_ready is not None else time.monotonic())
+								if self.data_ready is None:
+									time.sleep(0.005)
+								continue
 
 							if (RestrictPitch):
 								roll = math.atan2(accY,accZ) * radToDeg
@@ -169,15 +193,14 @@ class AngleMeterAlpha:
 								gyroYAngle = kalAngleY
 
 							#print("Angle X: " + str(complAngleX)+"   " +"Angle Y: " + str(complAngleY))
-							self.pitch = compAngleY
-							self.roll  = compAngleX
-
-							self.kalman_pitch = kalAngleY
-							self.kalman_roll = kalAngleX
-							self.compl_pitch = compAngleY
-							self.compl_roll = compAngleX
+							if self.data_ready is not None:
+								timestamp = edge_time
+							else:
+								timestamp = time.monotonic()
+							self.publish(timestamp, compAngleY, compAngleX, kalAngleY, kalAngleX, compAngleY, compAngleX)
 							#print(str(roll)+"  "+str(gyroXAngle)+"  "+str(compAngleX)+"  "+str(kalAngleX)+"  "+str(pitch)+"  "+str(gyroYAngle)+"  "+str(compAngleY)+"  "+str(kalAngleY))
-							time.sleep(0.005)
+							if self.data_ready is None:
+								time.sleep(0.005)
 
 						except Exception as exc:
                                                     if(flag == 100):
@@ -185,16 +208,93 @@ class AngleMeterAlpha:
                                                     flag +=1
 							
 
-		def __init__(self):
-			self.pitch=0
-			self.roll = 0
-			self.MPU_Init()
-			self.bus = smbus2.SMBus(1)  # or bus = smbus.SMBus(0) for older version boards
+		DataReadyTimeout = 1.0  # seconds to wait for an INT edge before reporting a problem
+		GyroLSB = 16.4  # LSB per deg/s with GYRO_CONFIG 24 (+-2000 deg/s), used by the fusion filter
+		AccelLSB = 16384.0  # LSB per g at the power-on +-2 g range
+
+		def __init__(self, int_pin=None, fusion=None, magnetometer=None, gyro_bias=None):
+			# int_pin: GPIO (BCM) wired to the MPU6050 INT pin, or an EdgePin.
+			# When given, samples are read once per DATA_RDY edge instead of polling
+			# fusion: an ahrs.MadgwickAHRS or ahrs.MahonyAHRS that replaces the two Kalman
+			# filters and the complementary filter, and also estimates yaw
+			# magnetometer: e.g. an HMC5883 (its poll() is used) giving the fusion filter a heading,
+			# with its axes aligned to the MPU6050
+			# gyro_bias: an imu_calibration.GyroBiasTracker in raw LSB units, e.g. started from a stored
+			# bias. By default one learns the bias while the robot stands still, so no calibration
+			# stop is needed
+			self.fusion = fusion
+			if gyro_bias is None:
+				gyro_bias = GyroBiasTracker(max_std=0.5 * self.GyroLSB, max_change=2.0 * self.GyroLSB,
+							max_accel_std=0.01 * self.AccelLSB)
+			self.gyroBias = gyro_bias
+			self.magnetometer = magnetometer
+			self.magneticField = (0.0, 0.0, 0.0)
+			self.orientation = Orientation(None, 0, 0, 0, 0, 0, 0, 0)
+			self.orientationChanged = threading.Condition()
+			self.subscribers = ()
+			self.bus = open_bus(1, PRIORITY_IMU)  # or bus = open_bus(0) for older version boards
 			self.DeviceAddress = 0x68  # MPU6050 device address
-			self.compl_pitch = 0
-			self.compl_roll = 0
-			self.kalman_pitch = 0
-			self.kalman_roll = 0
+			self.MPU_Init()
+			if int_pin is None or hasattr(int_pin, 'wait_for_edge'):
+				self.data_ready = int_pin
+			else:
+				self.data_ready = open_edge_pin(int_pin)
+
+		def updateFusion(self, accX, accY, accZ, gyroX, gyroY, gyroZ, dt, timestamp):
+			if self.magnetometer is not None:
+				sample = self.magnetometer.poll()
+				if sample is not None:
+					self.magneticField = sample[1:]
+			scale = radians(1.0 / self.GyroLSB)
+			self.fusion.update(gyroX * scale, gyroY * scale, gyroZ * scale, accX, accY, accZ,
+					*self.magneticField, dt=dt)
+			roll, pitch, yaw = self.fusion.get_roll_pitch_yaw()
+			self.publish(timestamp, pitch, roll, pitch, roll, pitch, roll, yaw)
+
+		def publish(self, timestamp, pitch, roll, kalman_pitch, kalman_roll, compl_pitch, compl_roll, yaw=0.0):
+			#Swap in a new immutable record: readers see either the old or the new sample, never a mix
+			with self.orientationChanged:
+				orientation = Orientation(timestamp, self.orientation.sequence + 1, pitch, roll,
+							kalman_pitch, kalman_roll, compl_pitch, compl_roll, yaw)
+				self.orientation = orientation
+				self.orientationChanged.notify_all()
+			for callback in self.subscribers:
+				try:
+					callback(orientation)
+				except Exception as exc:
+					#A failing subscriber must not stop the measurements
+					print("Removing orientation callback: " + str(exc))
+					self.unsubscribe(callback)
+
+		def snapshot(self):
+			#Latest consistent orientation record (timestamp is time.monotonic(), sequence counts updates)
+			return self.orientation
+
+		def wait_next(self, timeout=None, sequence=None):
+			#Block until a record newer than sequence (default: the current one) is published.
+			#Returns the record, or None on timeout
+			with self.orientationChanged:
+				if sequence is None:
+					sequence = self.orientation.sequence
+				if self.orientationChanged.wait_for(lambda: self.orientation.sequence > sequence, timeout):
+					return self.orientation
+				return None
+
+		def subscribe(self, callback):
+			#callback(orientation) is called from the measuring thread on every update
+			self.subscribers = self.subscribers + (callback,)
+
+		def unsubscribe(self, callback):
+			self.subscribers = tuple(subscriber for subscriber in self.subscribers if subscriber is not callback)
+
+		#Attributes kept for older code, each read from the latest record
+		pitch = property(lambda self: self.orientation.pitch)
+		roll = property(lambda self: self.orientation.roll)
+		kalman_pitch = property(lambda self: self.orientation.kalman_pitch)
+		kalman_roll = property(lambda self: self.orientation.kalman_roll)
+		compl_pitch = property(lambda self: self.orientation.compl_pitch)
+		compl_roll = property(lambda self: self.orientation.compl_roll)
+		yaw = property(lambda self: self.orientation.yaw)
 
 		def measure(self):
 			angleThread = threading.Thread(target=self.measureAngles)
@@ -206,6 +306,9 @@ class AngleMeterAlpha:
 		def getPitch(self):
 			return self.pitch
 
+		def getYaw(self):
+			return self.yaw
+
 		def get_int_pitch(self):
 			return int(self.pitch)
 
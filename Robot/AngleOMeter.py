@@ -5,7 +5,8 @@ angleMeter = AngleMeterAlpha()
 angleMeter.measure()
 
 while True:
-    print(angleMeter.get_kalman_roll(),",", angleMeter.get_complementary_roll(), ",",angleMeter.get_kalman_pitch(),",", angleMeter.get_complementary_pitch(),".")
+    angles = angleMeter.snapshot()  # kalman and complementary angles from the same sample
+    print(int(angles.kalman_roll),",", int(angles.compl_roll), ",",int(angles.kalman_pitch),",", int(angles.compl_pitch),".")
     #print(angleMeter.get_int_roll(), angleMeter.get_int_pitch())
     time.sleep(0.3)
 
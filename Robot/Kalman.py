@@ -1,61 +1,80 @@
 #Kalman Filter MPU6050
+#
+#KalmanAngle filters one angle from an accelerometer angle and a gyro rate.
+#KalmanAngleBank runs N of them at once on NumPy arrays, and filter_angles /
+#smooth_angles reprocess whole recordings (the smoother is a
+#Rauch-Tung-Striebel pass over the filtered result).
+#
+#State is [angle, gyro bias]. The prediction is angle += dt * (rate - bias)
+#with process noise QAngle * dt and QBias * dt, the measurement is the angle.
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+QANGLE = 0.001
+QBIAS = 0.003
+RMEASURE = 0.03
+
+
 class KalmanAngle:
+    __slots__ = ('QAngle', 'QBias', 'RMeasure', 'angle', 'bias', 'rate',
+                 'P00', 'P01', 'P10', 'P11')
+
     def __init__(self):
-        self.QAngle = 0.001
-        self.QBias = 0.003
-        self.RMeasure = 0.03
+        self.QAngle = QANGLE
+        self.QBias = QBIAS
+        self.RMeasure = RMEASURE
         self.angle = 0.0
         self.bias = 0.0
         self.rate = 0.0
-        self.P=[[0.0,0.0],[0.0,0.0]]
-
-    '''def kalman():
-        QAngle = 0.001
-        QBias = 0.003
-        RMeasure = 0.03
+        self.P00 = 0.0
+        self.P01 = 0.0
+        self.P10 = 0.0
+        self.P11 = 0.0
 
-        angle = 0.0
-        bias = 0.0
+    @property
+    def P(self):
+        #Error covariance as a nested list (a copy)
+        return [[self.P00, self.P01], [self.P10, self.P11]]
 
-        P[0][0] = 0.0
-        P[0][1] = 0.0
-        P[1][0] = 0.0
-        P[1][1] = 0.0'''
+    @P.setter
+    def P(self, P):
+        (self.P00, self.P01), (self.P10, self.P11) = P
 
     def getAngle(self,newAngle, newRate,dt):
-        #step 1:
-        self.rate = newRate - self.bias;    #new_rate is the latest Gyro measurement
-        self.angle += dt * self.rate;
+        #Step 1: Predict the angle with the bias corrected gyro rate
+        rate = newRate - self.bias    #new_rate is the latest Gyro measurement
+        angle = self.angle + dt * rate
 
-        #Step 2:
-        self.P[0][0] += dt * (dt*self.P[1][1] -self.P[0][1] - self.P[1][0] + self.QAngle)
-        self.P[0][1] -= dt * self.P[1][1]
-        self.P[1][0] -= dt * self.P[1][1]
-        self.P[1][1] += self.QBias * dt
+        #Step 2: Predict the error covariance
+        P11 = self.P11
+        P00 = self.P00 + dt * (dt*P11 - self.P01 - self.P10 + self.QAngle)
+        P01 = self.P01 - dt * P11
+        P10 = self.P10 - dt * P11
+        P11 += self.QBias * dt
 
         #Step 3: Innovation
-        y = newAngle - self.angle
+        y = newAngle - angle
 
         #Step 4: Innovation covariance
-        s = self.P[0][0] + self.RMeasure
+        s = P00 + self.RMeasure
 
-        #Step 5:    Kalman Gain
-        K=[0.0,0.0]
-        K[0] = self.P[0][0]/s
-        K[1] = self.P[1][0]/s
+        #Step 5: Kalman Gain
+        K0 = P00 / s
+        K1 = P10 / s
 
         #Step 6: Update the Angle
-        self.angle += K[0] * y
-        self.bias  += K[1] * y
-
-        #Step 7: Calculate estimation error covariance - Update the error covariance
-        P00Temp = self.P[0][0]
-        P01Temp = self.P[0][1]
+        self.angle = angle + K0 * y
+        self.bias += K1 * y
+        self.rate = rate
 
-        self.P[0][0] -= K[0] * P00Temp;
-        self.P[0][1] -= K[0] * P01Temp;
-        self.P[1][0] -= K[1] * P00Temp;
-        self.P[1][1] -= K[1] * P01Temp;
+        #Step 7: Update the error covariance
+        self.P00 = P00 - K0 * P00
+        self.P01 = P01 - K0 * P01
+        self.P10 = P10 - K1 * P00
+        self.P11 = P11 - K1 * P01
 
         return self.angle
 
@@ -82,3 +101,167 @@ class KalmanAngle:
 
     def  getRMeasure(self):
         return self.RMeasure
+
+
+class KalmanAngleBank:
+    #N independent angle filters updated together, e.g. roll and pitch of
+    #several IMUs. The same equations as KalmanAngle, on arrays.
+
+    def __init__(self, n, QAngle=QANGLE, QBias=QBIAS, RMeasure=RMEASURE):
+        if np is None:
+            raise ImportError("numpy is needed for KalmanAngleBank")
+        self.QAngle = QAngle
+        self.QBias = QBias
+        self.RMeasure = RMeasure
+        self.angle = np.zeros(n)
+        self.bias = np.zeros(n)
+        self.rate = np.zeros(n)
+        self.P00 = np.zeros(n)
+        self.P01 = np.zeros(n)
+        self.P10 = np.zeros(n)
+        self.P11 = np.zeros(n)
+
+    def setAngles(self, angles):
+        self.angle[:] = angles
+
+    def getAngles(self, newAngles, newRates, dt):
+        #newAngles, newRates: N measurements, dt: scalar or N time steps.
+        #Returns the N filtered angles (the bank's own array, updated in place)
+        np.subtract(newRates, self.bias, out=self.rate)
+        self.angle += dt * self.rate
+
+        P00, P01, P10, P11 = self.P00, self.P01, self.P10, self.P11
+        P00 += dt * (dt*P11 - P01 - P10 + self.QAngle)
+        P01 -= dt * P11
+        P10 -= dt * P11
+        P11 += self.QBias * dt
+
+        y = newAngles - self.angle
+        s = P00 + self.RMeasure
+        K0 = P00 / s
+        K1 = P10 / s
+
+        self.angle += K0 * y
+        self.bias += K1 * y
+
+        P00Temp = P00.copy()
+        P01Temp = P01.copy()
+        P00 -= K0 * P00Temp
+        P01 -= K0 * P01Temp
+        P10 -= K1 * P00Temp
+        P11 -= K1 * P01Temp
+        return self.angle
+
+
+def _covariances(dts, count, QAngle, QBias, RMeasure, smoother=False):
+    #The covariance and gain recursion does not depend on the measurements,
+    #so it is run once for all channels. With a constant dt the gains reach
+    #a steady state after which the remaining steps are copies.
+    #Returns the gains K0, K1 and, for the smoother, the smoother gains
+    #C00, C01, C10, C11 linking step t to step t + 1
+    P00 = P01 = P10 = P11 = 0.0
+    K0s, K1s = [], []
+    Cs = ([], [], [], [])
+    previous = None
+    for t in range(0, count):
+        dt = dts if dts.__class__ is float else dts[t]
+        if smoother and t > 0:
+            #Smoother gain C = Pf[t-1] F^T inv(Pp[t]), F = [[1, -dt], [0, 1]]
+            Pp00 = P00 + dt * (dt*P11 - P01 - P10 + QAngle)
+            Pp01 = P01 - dt * P11
+            Pp10 = P10 - dt * P11
+            Pp11 = P11 + QBias * dt
+            det = Pp00 * Pp11 - Pp01 * Pp10
+            A00 = P00 - P01 * dt
+            A10 = P10 - P11 * dt
+            Cs[0].append((A00 * Pp11 - P01 * Pp10) / det)
+            Cs[1].append((P01 * Pp00 - A00 * Pp01) / det)
+            Cs[2].append((A10 * Pp11 - P11 * Pp10) / det)
+            Cs[3].append((P11 * Pp00 - A10 * Pp01) / det)
+        P00 += dt * (dt*P11 - P01 - P10 + QAngle)
+        P01 -= dt * P11
+        P10 -= dt * P11
+        P11 += QBias * dt
+        s = P00 + RMeasure
+        K0 = P00 / s
+        K1 = P10 / s
+        P00, P01, P10, P11 = (P00 - K0 * P00, P01 - K0 * P01,
+                              P10 - K1 * P00, P11 - K1 * P01)
+        K0s.append(K0)
+        K1s.append(K1)
+        if dts.__class__ is float:
+            state = (P00, P01, P10, P11)
+            if state == previous and t > 0:
+                #Steady state: every later step is identical
+                remaining = count - t - 1
+                K0s.extend([K0] * remaining)
+                K1s.extend([K1] * remaining)
+                if smoother:
+                    for C in Cs:
+                        C.extend([C[-1]] * remaining)
+                break
+            previous = state
+    return K0s, K1s, Cs
+
+
+def _as_channels(values):
+    values = np.asarray(values, dtype=np.float64)
+    return values.reshape(len(values), -1)
+
+
+def filter_angles(angles, rates, dt, QAngle=QANGLE, QBias=QBIAS,
+                  RMeasure=RMEASURE, smooth=False):
+    #Filter whole recordings offline.
+    #angles, rates: (T,) or (T, N) accelerometer angles and gyro rates
+    #dt: scalar time step or T time steps (dt[t] is the step ending at t)
+    #smooth: also run the Rauch-Tung-Striebel smoother backwards
+    #Returns (angle, bias) arrays shaped like angles. The first sample sets
+    #the initial angle, like KalmanAngle.setAngle
+    if np is None:
+        raise ImportError("numpy is needed for filter_angles")
+    shape = np.shape(angles)
+    angles = _as_channels(angles)
+    rates = _as_channels(rates)
+    count, channels = angles.shape
+    if np.ndim(dt) == 0:
+        dts = float(dt)
+    else:
+        dts = np.asarray(dt, dtype=np.float64).tolist()
+    K0s, K1s, Cs = _covariances(dts, count, QAngle, QBias, RMeasure, smooth)
+    dt_list = [dts] * count if dts.__class__ is float else dts
+    angle_out = np.empty((count, channels))
+    bias_out = np.empty((count, channels))
+    for channel in range(0, channels):
+        measured = angles[:, channel].tolist()
+        rate_in = rates[:, channel].tolist()
+        angle = measured[0] if count else 0.0
+        bias = 0.0
+        filtered = [0.0] * count
+        biases = [0.0] * count
+        predicted = [0.0] * count
+        for t in range(0, count):
+            angle += dt_list[t] * (rate_in[t] - bias)
+            predicted[t] = angle
+            y = measured[t] - angle
+            angle += K0s[t] * y
+            bias += K1s[t] * y
+            filtered[t] = angle
+            biases[t] = bias
+        if smooth and count > 1:
+            C00, C01, C10, C11 = Cs
+            for t in range(count - 2, -1, -1):
+                #Predicted bias at t + 1 is the filtered bias at t
+                dA = filtered[t + 1] - predicted[t + 1]
+                dB = biases[t + 1] - biases[t]
+                filtered[t] += C00[t] * dA + C01[t] * dB
+                biases[t] += C10[t] * dA + C11[t] * dB
+        angle_out[:, channel] = filtered
+        bias_out[:, channel] = biases
+    return angle_out.reshape(shape), bias_out.reshape(shape)
+
+
+def smooth_angles(angles, rates, dt, QAngle=QANGLE, QBias=QBIAS,
+                  RMeasure=RMEASURE):
+    #Rauch-Tung-Striebel smoothed (angle, bias) for a whole recording
+    return filter_angles(angles, rates, dt, QAngle, QBias, RMeasure,
+                         smooth=True)
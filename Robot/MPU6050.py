@@ -49,11 +49,42 @@ THE SOFTWARE.
 import math
 import ctypes
 import time
-import smbus
-import csv
+import zlib
+import sensor_decode
+from i2c_bus import open_bus, PRIORITY_IMU
 from MPUConstants import MPUConstants as C
+from register_cache import RegisterShadow
 from Quaternion import Quaternion as Q
 from Quaternion import XYZVector as V
+import imu_log
+import calibration_store
+
+
+# ACCEL_XOUT_H .. GYRO_ZOUT_L as seven big endian int16 words
+MOTION_BURST = sensor_decode.MOTION6
+# Largest transfer a single SMBus block read can return
+I2C_BLOCK_MAX = 32
+# Hardware FIFO depth (bytes)
+FIFO_SIZE = 1024
+# Raw FIFO records are accel xyz followed by gyro xyz, big endian int16
+RAW_FIFO_COLUMNS = 6
+RAW_FIFO_RECORD_SIZE = 2 * RAW_FIFO_COLUMNS
+RAW_FIFO_SOURCES = (1 << C.MPU6050_ACCEL_FIFO_EN_BIT |
+                    1 << C.MPU6050_XG_FIFO_EN_BIT |
+                    1 << C.MPU6050_YG_FIFO_EN_BIT |
+                    1 << C.MPU6050_ZG_FIFO_EN_BIT)
+# Offset calibration runs at +-2 g and +-250 deg/s. The offset registers
+# count 1/2048 g and 1/32.8 deg/s whatever the range, so one register step
+# moves the readings by this many LSB
+ACCEL_LSB_PER_G = 16384
+ACCEL_OFFSET_STEP = ACCEL_LSB_PER_G / 2048.0
+GYRO_OFFSET_STEP = 131 / 32.8
+# Time for new offsets or ranges to show through the 42 Hz DLPF (s)
+OFFSET_SETTLE_TIME = 0.03
+# Sample period at the 1 kHz rate used during offset calibration (s)
+OFFSET_SAMPLE_PERIOD = 0.001
+# Time for the first temperature sample after wake up (s)
+WAKE_UP_TIME = 0.01
 
 
 class MPU6050:
@@ -62,13 +93,28 @@ class MPU6050:
     __DMP_packet_size = 0
     __dev_id = 0
     __bus = None
+    __registers = None
+    __bus_number = 1
+    __calibration = None
+    __raw_FIFO_rate = None
+    __raw_FIFO_buffer = None
+    __raw_FIFO_time = 0.0
+    __raw_FIFO_samples = 0
+    __raw_FIFO_overflows = 0
+    __raw_FIFO_dropped = 0
 
     def __init__(self, a_bus=1, a_address=C.MPU6050_DEFAULT_ADDRESS,
                  a_xAOff=None, a_yAOff=None, a_zAOff=None, a_xGOff=None,
-                 a_yGOff=None, a_zGOff=None, a_debug=False):
+                 a_yGOff=None, a_zGOff=None, a_debug=False,
+                 a_calibration=None):
         self.__dev_id = a_address
+        self.__bus_number = a_bus
         # Connect to num 1 SMBus
-        self.__bus = smbus.SMBus(a_bus)
+        self.__bus = open_bus(a_bus, PRIORITY_IMU)
+        # Configuration registers are shadowed so read-modify-write cycles
+        # only cost a bus write
+        self.__registers = RegisterShadow.for_device(self.__bus, a_bus,
+                                                     a_address)
         # Set clock source to gyro
         self.set_clock_source(C.MPU6050_CLOCK_PLL_XGYRO)
         # Set accelerometer range
@@ -77,6 +123,16 @@ class MPU6050:
         self.set_full_scale_gyro_range(C.MPU6050_GYRO_FS_250)
         # Take the MPU out of time.sleep mode
         self.wake_up()
+        # Offsets stored by an earlier calibration of this device in the
+        # same temperature band, see calibration_store.CalibrationStore
+        if a_calibration is not None:
+            time.sleep(WAKE_UP_TIME)
+            self.__calibration = a_calibration.load(
+                self.get_identity(), calibration_store.OFFSETS,
+                self.get_temperature())
+            if self.__calibration is not None:
+                self.set_accel_offsets(self.__calibration.values['accel'])
+                self.set_gyro_offsets(self.__calibration.values['gyro'])
         # Set offsets
         if a_xAOff:
             self.set_x_accel_offset(a_xAOff)
@@ -97,33 +153,33 @@ class MPU6050:
         return self.read_bits(a_reg_add, a_bit_position, 1)
 
     def write_bit(self, a_reg_add, a_bit_num, a_bit):
-        byte = self.__bus.read_byte_data(self.__dev_id, a_reg_add)
-        if a_bit:
-            byte |= 1 << a_bit_num
-        else:
-            byte &= ~(1 << a_bit_num)
-        self.__bus.write_byte_data(
-            self.__dev_id, a_reg_add, ctypes.c_int8(byte).value)
+        with self.__bus.locked():
+            byte = self.__registers.read(a_reg_add)
+            if a_bit:
+                byte |= 1 << a_bit_num
+            else:
+                byte &= ~(1 << a_bit_num)
+            self.__registers.write(a_reg_add, ctypes.c_int8(byte).value)
 
     def read_bits(self, a_reg_add, a_bit_start, a_length):
-        byte = self.__bus.read_byte_data(self.__dev_id, a_reg_add)
+        byte = self.__registers.read(a_reg_add)
         mask = ((1 << a_length) - 1) << (a_bit_start - a_length + 1)
         byte &= mask
         byte >>= a_bit_start - a_length + 1
         return byte
 
     def write_bits(self, a_reg_add, a_bit_start, a_length, a_data):
-        byte = self.__bus.read_byte_data(self.__dev_id, a_reg_add)
-        mask = ((1 << a_length) - 1) << (a_bit_start - a_length + 1)
-        # Get data in position and zero all non-important bits in data
-        a_data <<= a_bit_start - a_length + 1
-        a_data &= mask
-        # Clear all important bits in read byte and combine with data
-        byte &= ~mask
-        byte = byte | a_data
-        # Write the data to the I2C device
-        self.__bus.write_byte_data(
-            self.__dev_id, a_reg_add, ctypes.c_int8(byte).value)
+        with self.__bus.locked():
+            byte = self.__registers.read(a_reg_add)
+            mask = ((1 << a_length) - 1) << (a_bit_start - a_length + 1)
+            # Get data in position and zero all non-important bits in data
+            a_data <<= a_bit_start - a_length + 1
+            a_data &= mask
+            # Clear all important bits in read byte and combine with data
+            byte &= ~mask
+            byte = byte | a_data
+            # Write the data to the I2C device
+            self.__registers.write(a_reg_add, ctypes.c_int8(byte).value)
 
     def read_memory_byte(self):
         return self.__bus.read_byte_data(self.__dev_id, C.MPU6050_RA_MEM_R_W)
@@ -145,37 +201,80 @@ class MPU6050:
 
     def write_memory_block(self, a_data_list, a_data_size, a_bank, a_address,
                            a_verify):
+        # Nobody else may move the bank or address pointer half way through
+        with self.__bus.locked():
+            return self.__write_memory_block(a_data_list, a_data_size, a_bank,
+                                             a_address, a_verify)
+
+    def __write_memory_block(self, a_data_list, a_data_size, a_bank,
+                             a_address, a_verify):
         success = True
         self.set_memory_bank(a_bank)
-        self.set_memory_start_address(a_address)
 
-        # For each a_data_item we want to write it to the board to a certain
-        # memory bank and address
-        for i in range(0, a_data_size):
-            # Write each data to memory
-            self.__bus.write_byte_data(self.__dev_id, C.MPU6050_RA_MEM_R_W,
-                                       a_data_list[i])
+        # Write the data in chunks, never letting a chunk cross into the
+        # next memory bank
+        index = 0
+        while index < a_data_size:
+            chunk_size = min(C.MPU6050_DMP_MEMORY_CHUNK_SIZE,
+                             a_data_size - index,
+                             C.MPU6050_DMP_MEMORY_BANK_SIZE - a_address)
+            chunk = list(a_data_list[index:index + chunk_size])
+
+            self.set_memory_start_address(a_address)
+            self.__bus.write_i2c_block_data(self.__dev_id,
+                                            C.MPU6050_RA_MEM_R_W, chunk)
 
             if a_verify:
-                self.set_memory_bank(a_bank)
+                # Read the whole chunk back in one transaction
                 self.set_memory_start_address(a_address)
-                verify_data = self.__bus.read_byte_data(self.__dev_id,
-                                                        C.MPU6050_RA_MEM_R_W)
-                if verify_data != a_data_list[i]:
+                verify_data = self.__bus.read_i2c_block_data(
+                    self.__dev_id, C.MPU6050_RA_MEM_R_W, chunk_size)
+                if list(verify_data) != chunk:
                     success = False
 
+            index += chunk_size
+            a_address += chunk_size
             # If we've filled the bank, change the memory bank
-            if a_address == 255:
+            if a_address == C.MPU6050_DMP_MEMORY_BANK_SIZE:
                 a_address = 0
                 a_bank += 1
-                self.set_memory_bank(a_bank)
-            else:
-                a_address += 1
+                if index < a_data_size:
+                    self.set_memory_bank(a_bank)
+
+        return success
+
+    def read_memory_block(self, a_data_size, a_bank=0, a_address=0):
+        with self.__bus.locked():
+            return self.__read_memory_block(a_data_size, a_bank, a_address)
+
+    def __read_memory_block(self, a_data_size, a_bank, a_address):
+        data = bytearray(a_data_size)
+        self.set_memory_bank(a_bank)
 
-            # Either way update the memory address
+        index = 0
+        while index < a_data_size:
+            chunk_size = min(I2C_BLOCK_MAX, a_data_size - index,
+                             C.MPU6050_DMP_MEMORY_BANK_SIZE - a_address)
             self.set_memory_start_address(a_address)
+            data[index:index + chunk_size] = self.__bus.read_i2c_block_data(
+                self.__dev_id, C.MPU6050_RA_MEM_R_W, chunk_size)
 
-        return success
+            index += chunk_size
+            a_address += chunk_size
+            if a_address == C.MPU6050_DMP_MEMORY_BANK_SIZE:
+                a_address = 0
+                a_bank += 1
+                if index < a_data_size:
+                    self.set_memory_bank(a_bank)
+
+        return data
+
+    def DMP_firmware_resident(self, a_data_list=C.dmpMemory,
+                              a_data_size=C.MPU6050_DMP_CODE_SIZE):
+        # Compare the CRC32 fingerprint of the DMP memory with the image we
+        # would upload, so a warm restart can skip the upload
+        fingerprint = zlib.crc32(bytes(a_data_list[:a_data_size]))
+        return zlib.crc32(self.read_memory_block(a_data_size)) == fingerprint
 
     def wake_up(self):
         self.write_bit(
@@ -195,9 +294,38 @@ class MPU6050:
                         C.MPU6050_ACONFIG_AFS_SEL_BIT,
                         C.MPU6050_ACONFIG_AFS_SEL_LENGTH, a_data)
 
+    def get_identity(self):
+        # Key of this device in a calibration_store.CalibrationStore
+        who_am_i = self.__bus.read_byte_data(self.__dev_id,
+                                             C.MPU6050_RA_WHO_AM_I)
+        return calibration_store.SensorIdentity(self.__bus_number,
+                                                self.__dev_id, who_am_i)
+
+    def get_temperature(self):
+        # Die temperature in degrees Celsius
+        raw_data = self.__bus.read_i2c_block_data(self.__dev_id,
+                                                  C.MPU6050_RA_TEMP_OUT_H, 2)
+        return sensor_decode.int16_be(raw_data) / 340.0 + 36.53
+
+    def get_calibration(self):
+        # The calibration_store.Calibration loaded at construction, or None
+        return self.__calibration
+
+    def save_calibration(self, a_store):
+        # Store the current offset registers for this device and
+        # temperature band, e.g. after calibrate_offsets
+        self.__calibration = a_store.save(
+            self.get_identity(), calibration_store.OFFSETS,
+            self.get_temperature(),
+            {'accel': self.get_accel_offsets(),
+             'gyro': self.get_gyro_offsets()})
+        return self.__calibration
+
     def reset(self):
         self.write_bit(C.MPU6050_RA_PWR_MGMT_1,
                        C.MPU6050_PWR1_DEVICE_RESET_BIT, 1)
+        # Every register goes back to its power-on value
+        self.__registers.invalidate()
 
     def set_sleep_enabled(self, a_enabled):
         set_bit = 0
@@ -293,8 +421,8 @@ class MPU6050:
                 index += 1
                 if special == 0x01:
                     # TODO Figure out if write8 can return True/False
-                    success = self.__bus.write_byte_data(
-                        self.__dev_id, C.MPU6050_RA_INT_ENABLE, 0x32)
+                    success = self.__registers.write(
+                        C.MPU6050_RA_INT_ENABLE, 0x32)
 
             if success == False:
                 # TODO implement error messagemajigger
@@ -306,12 +434,10 @@ class MPU6050:
         return self.write_DMP_configuration_set(a_data_list, a_data_size)
 
     def set_int_enable(self, a_enabled):
-        self.__bus.write_byte_data(
-            self.__dev_id, C.MPU6050_RA_INT_ENABLE, a_enabled)
+        self.__registers.write(C.MPU6050_RA_INT_ENABLE, a_enabled)
 
     def set_rate(self, a_rate):
-        self.__bus.write_byte_data(
-            self.__dev_id, C.MPU6050_RA_SMPLRT_DIV, a_rate)
+        self.__registers.write(C.MPU6050_RA_SMPLRT_DIV, a_rate)
 
     def set_external_frame_sync(self, a_sync):
         self.write_bits(C.MPU6050_RA_CONFIG,
@@ -363,6 +489,14 @@ class MPU6050:
         self.__bus.write_byte_data(
             self.__dev_id, C.MPU6050_RA_ZRMOT_DUR, a_duration)
 
+    def get_zero_motion_detected(self):
+        # True while the zero motion detector (ZRMOT_THR, ZRMOT_DUR) sees
+        # the IMU at rest, e.g. for the still argument of
+        # imu_calibration.GyroBiasTracker.update
+        status = self.__bus.read_byte_data(self.__dev_id,
+                                           C.MPU6050_RA_MOT_DETECT_STATUS)
+        return bool(status & (1 << C.MPU6050_MOTION_MOT_ZRMOT_BIT))
+
     def set_FIFO_enabled(self, a_enabled):
         bit = 0
         if a_enabled:
@@ -381,7 +515,11 @@ class MPU6050:
         self.write_bit(C.MPU6050_RA_USER_CTRL,
                        C.MPU6050_USERCTRL_DMP_RESET_BIT, True)
 
-    def dmp_initialize(self):
+    def dmp_initialize(self, a_skip_resident_firmware=True):
+        # The reset clears the offsets set at construction (e.g. the ones
+        # loaded from a calibration store), keep them to restore below
+        accel_offsets = self.get_accel_offsets()
+        gyro_offsets = self.get_gyro_offsets()
         # Reset the MPU
         self.reset()
         # time.Sleep a bit while resetting
@@ -444,11 +582,21 @@ class MPU6050:
         # Wait a bit for the device to register the changes
         time.sleep(20 / 1000)
 
-        # load DMP code into memory banks
-        if self.__debug:
-            print('Writing DMP code to MPU memory banks ' +
-                  repr(C.MPU6050_DMP_CODE_SIZE) + ' bytes')
-        if self.write_prog_memory_block(C.dmpMemory, C.MPU6050_DMP_CODE_SIZE):
+        # load DMP code into memory banks, unless it is already there
+        firmware_loaded = False
+        if a_skip_resident_firmware:
+            if self.__debug:
+                print('Checking DMP firmware fingerprint')
+            firmware_loaded = self.DMP_firmware_resident()
+            if self.__debug and firmware_loaded:
+                print('DMP code already resident, skipping upload')
+        if not firmware_loaded:
+            if self.__debug:
+                print('Writing DMP code to MPU memory banks ' +
+                      repr(C.MPU6050_DMP_CODE_SIZE) + ' bytes')
+            firmware_loaded = self.write_prog_memory_block(
+                C.dmpMemory, C.MPU6050_DMP_CODE_SIZE)
+        if firmware_loaded:
             # TODO Check if we've actually verified this
             if self.__debug:
                 print('Success! DMP code written and verified')
@@ -499,6 +647,12 @@ class MPU6050:
                 self.set_y_gyro_offset_TC(y_g_offset_TC)
                 self.set_z_gyro_offset_TC(z_g_offset_TC)
 
+                if self.__debug:
+                    print('Setting X/Y/Z accel and gyro offsets to previous '
+                          'values')
+                self.set_accel_offsets(accel_offsets)
+                self.set_gyro_offsets(gyro_offsets)
+
                 # Uncomment this to zero offsets when dmp_initialize is called
                 # if self.__debug:
                 #    print('Setting X/Y/Z gyro user offsets to zero')
@@ -731,24 +885,128 @@ class MPU6050:
         self.__bus.write_byte_data(self.__dev_id, C.MPU6050_RA_ZG_OFFS_USRL,
                                    ctypes.c_int8(a_offset).value)
 
+    def get_accel_offsets(self):
+        raw_data = self.__bus.read_i2c_block_data(self.__dev_id,
+                                                  C.MPU6050_RA_XA_OFFS_H, 6)
+        return list(sensor_decode.vector_be(raw_data))
+
+    def get_gyro_offsets(self):
+        raw_data = self.__bus.read_i2c_block_data(self.__dev_id,
+                                                  C.MPU6050_RA_XG_OFFS_USRH, 6)
+        return list(sensor_decode.vector_be(raw_data))
+
+    def set_accel_offsets(self, a_offsets):
+        self.set_x_accel_offset(a_offsets[0])
+        self.set_y_accel_offset(a_offsets[1])
+        self.set_z_accel_offset(a_offsets[2])
+
+    def set_gyro_offsets(self, a_offsets):
+        self.set_x_gyro_offset(a_offsets[0])
+        self.set_y_gyro_offset(a_offsets[1])
+        self.set_z_gyro_offset(a_offsets[2])
+
+    def calibrate_offsets(self, a_samples=1000, a_verify_samples=250,
+                          a_passes=3, a_gravity=(0, 0, 1)):
+        # Set the offset registers so that the gyro reads zero and the
+        # accelerometer reads a_gravity (in g) while the IMU lies still.
+        # The bias is measured once at +-2 g / +-250 deg/s and converted
+        # straight to offset register steps; up to a_passes shorter
+        # measurements then remove what rounding left. Bit 0 of the accel
+        # offsets is kept as it is. Returns the accel offsets, the gyro
+        # offsets and the residual bias in LSB as [ax, ay, az, gx, gy, gz].
+        # The ranges, DLPF and sample rate are restored afterwards.
+        gyro_range = self.read_bits(C.MPU6050_RA_GYRO_CONFIG,
+                                    C.MPU6050_GCONFIG_FS_SEL_BIT,
+                                    C.MPU6050_GCONFIG_FS_SEL_LENGTH)
+        accel_range = self.read_bits(C.MPU6050_RA_ACCEL_CONFIG,
+                                     C.MPU6050_ACONFIG_AFS_SEL_BIT,
+                                     C.MPU6050_ACONFIG_AFS_SEL_LENGTH)
+        DLPF_mode = self.read_bits(C.MPU6050_RA_CONFIG,
+                                   C.MPU6050_CFG_DLPF_CFG_BIT,
+                                   C.MPU6050_CFG_DLPF_CFG_LENGTH)
+        rate = self.__registers.read(C.MPU6050_RA_SMPLRT_DIV)
+        self.set_full_scale_gyro_range(C.MPU6050_GYRO_FS_250)
+        self.set_full_scale_accel_range(C.MPU6050_ACCEL_FS_2)
+        self.set_DLF_mode(C.MPU6050_DLPF_BW_42)
+        self.set_rate(0)
+        try:
+            accel_offsets = self.get_accel_offsets()
+            gyro_offsets = self.get_gyro_offsets()
+            expected = [g * ACCEL_LSB_PER_G for g in a_gravity] + [0, 0, 0]
+            samples = a_samples
+            for pass_index in range(0, a_passes + 1):
+                time.sleep(OFFSET_SETTLE_TIME)
+                bias = [mean - reference for mean, reference in
+                        zip(self.__average_motion(samples), expected)]
+                # Accel offsets move in steps of two to keep bit 0
+                accel_steps = [2 * int(round(value / ACCEL_OFFSET_STEP / 2))
+                               for value in bias[:3]]
+                gyro_steps = [int(round(value / GYRO_OFFSET_STEP))
+                              for value in bias[3:]]
+                if pass_index == a_passes or \
+                        not any(accel_steps + gyro_steps):
+                    break
+                accel_offsets = [min(max(offset - step, -32768), 32767)
+                                 for offset, step in
+                                 zip(accel_offsets, accel_steps)]
+                gyro_offsets = [min(max(offset - step, -32768), 32767)
+                                for offset, step in
+                                zip(gyro_offsets, gyro_steps)]
+                self.set_accel_offsets(accel_offsets)
+                self.set_gyro_offsets(gyro_offsets)
+                samples = a_verify_samples
+        finally:
+            self.set_full_scale_gyro_range(gyro_range)
+            self.set_full_scale_accel_range(accel_range)
+            self.set_DLF_mode(DLPF_mode)
+            self.set_rate(rate)
+        if self.__debug:
+            print('Offset calibration: accel ' + str(accel_offsets) +
+                  ' gyro ' + str(gyro_offsets) + ' residual ' + str(bias))
+        return accel_offsets, gyro_offsets, bias
+
+    def __average_motion(self, a_samples):
+        # Mean of a_samples burst reads as [ax, ay, az, gx, gy, gz]. Reads
+        # are paced to the 1 kHz sample rate so that each one gets a new
+        # sample
+        sums = [0] * 6
+        next_read = time.monotonic()
+        for _ in range(0, a_samples):
+            delay = next_read - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            next_read += OFFSET_SAMPLE_PERIOD
+            ax, ay, az, temp, gx, gy, gz = self.read_motion_burst()
+            sums[0] += ax
+            sums[1] += ay
+            sums[2] += az
+            sums[3] += gx
+            sums[4] += gy
+            sums[5] += gz
+        return [total / float(a_samples) for total in sums]
+
     # Main interfacing functions to get raw data from MPU
     def get_acceleration(self):
         raw_data = self.__bus.read_i2c_block_data(self.__dev_id,
                                                   C.MPU6050_RA_ACCEL_XOUT_H, 6)
-        accel = [0] * 3
-        accel[0] = ctypes.c_int16(raw_data[0] << 8 | raw_data[1]).value
-        accel[1] = ctypes.c_int16(raw_data[2] << 8 | raw_data[3]).value
-        accel[2] = ctypes.c_int16(raw_data[4] << 8 | raw_data[5]).value
-        return accel
+        return list(sensor_decode.vector_be(raw_data))
 
     def get_rotation(self):
         raw_data = self.__bus.read_i2c_block_data(self.__dev_id,
                                                   C.MPU6050_RA_GYRO_XOUT_H, 6)
-        gyro = [0] * 3
-        gyro[0] = ctypes.c_int16(raw_data[0] << 8 | raw_data[1]).value
-        gyro[1] = ctypes.c_int16(raw_data[2] << 8 | raw_data[3]).value
-        gyro[2] = ctypes.c_int16(raw_data[4] << 8 | raw_data[5]).value
-        return gyro
+        return list(sensor_decode.vector_be(raw_data))
+
+    def read_motion_burst(self):
+        # Accel, temperature and gyro in one 14 byte transaction, so all
+        # values come from the same sample
+        raw_data = self.__bus.read_i2c_block_data(self.__dev_id,
+                                                  C.MPU6050_RA_ACCEL_XOUT_H,
+                                                  MOTION_BURST.size)
+        return sensor_decode.motion6(raw_data)
+
+    def get_motion6(self):
+        ax, ay, az, temp, gx, gy, gz = self.read_motion_burst()
+        return [ax, ay, az], [gx, gy, gz], temp
 
     # Interfacing functions to get data from FIFO buffer
     def DMP_get_FIFO_packet_size(self):
@@ -759,66 +1017,187 @@ class MPU6050:
                        C.MPU6050_USERCTRL_FIFO_RESET_BIT, True)
 
     def get_FIFO_count(self):
-        data = [0] * 2
-        data = self.read_bytes(data, C.MPU6050_RA_FIFO_COUNTH, 2)
+        data = self.__bus.read_i2c_block_data(self.__dev_id,
+                                              C.MPU6050_RA_FIFO_COUNTH, 2)
         return (data[0] << 8) | data[1]
 
     def get_FIFO_bytes(self, a_FIFO_count):
-        return_list = list()
-        for index in range(0, a_FIFO_count):
-            return_list.append(
-                self.__bus.read_byte_data(self.__dev_id,
-                                          C.MPU6050_RA_FIFO_R_W))
-        return return_list
+        FIFO_buffer = bytearray(a_FIFO_count)
+        self.read_FIFO_into(FIFO_buffer, a_FIFO_count)
+        return FIFO_buffer
+
+    def read_FIFO_into(self, a_buffer, a_FIFO_count):
+        # Fill the first a_FIFO_count bytes of the bytearray a_buffer.
+        # FIFO_R_W does not auto increment, so repeated block reads of it
+        # drain the FIFO up to I2C_BLOCK_MAX bytes per transaction
+        index = 0
+        while index < a_FIFO_count:
+            length = min(a_FIFO_count - index, I2C_BLOCK_MAX)
+            a_buffer[index:index + length] = \
+                self.__bus.read_i2c_block_data(self.__dev_id,
+                                               C.MPU6050_RA_FIFO_R_W, length)
+            index += length
+
+    def DMP_get_FIFO_packets(self, a_FIFO_count=None, a_max_packets=None):
+        # Drain every whole DMP packet waiting in the FIFO in one go and
+        # return a memoryview per packet over the shared buffer
+        packet_size = self.__DMP_packet_size
+        if packet_size == 0:
+            return []
+        if a_FIFO_count is None:
+            a_FIFO_count = self.get_FIFO_count()
+        packets = a_FIFO_count // packet_size
+        if a_max_packets is not None:
+            packets = min(packets, a_max_packets)
+        FIFO_view = memoryview(self.get_FIFO_bytes(packets * packet_size))
+        return [FIFO_view[index:index + packet_size]
+                for index in range(0, packets * packet_size, packet_size)]
+
+    # Raw accel and gyro capture through the FIFO, without the DMP
+    def set_FIFO_sources(self, a_sources):
+        self.__registers.write(C.MPU6050_RA_FIFO_EN, a_sources)
+
+    def raw_FIFO_start(self, a_rate=1000, a_DLPF_mode=C.MPU6050_DLPF_BW_188):
+        # Sample accel and gyro at a_rate (Hz, up to 1 kHz) into the FIFO.
+        # The DLPF must be on so the gyro output rate is 1 kHz like the
+        # accelerometer. Returns the rate actually configured.
+        divider = min(max(int(round(1000.0 / a_rate)) - 1, 0), 255)
+        self.set_DMP_enabled(False)
+        self.set_FIFO_enabled(False)
+        self.set_FIFO_sources(0)
+        if not C.MPU6050_DLPF_BW_188 <= a_DLPF_mode <= C.MPU6050_DLPF_BW_5:
+            a_DLPF_mode = C.MPU6050_DLPF_BW_188
+        self.set_DLF_mode(a_DLPF_mode)
+        self.set_rate(divider)
+        self.__raw_FIFO_rate = 1000.0 / (1 + divider)
+        if self.__raw_FIFO_buffer is None:
+            self.__raw_FIFO_buffer = bytearray(FIFO_SIZE)
+        self.__raw_FIFO_samples = 0
+        self.__raw_FIFO_overflows = 0
+        self.__raw_FIFO_dropped = 0
+        self.reset_FIFO()
+        self.set_FIFO_sources(RAW_FIFO_SOURCES)
+        self.set_FIFO_enabled(True)
+        self.__raw_FIFO_time = time.monotonic()
+        return self.__raw_FIFO_rate
+
+    def raw_FIFO_stop(self):
+        self.set_FIFO_enabled(False)
+        self.set_FIFO_sources(0)
+        self.reset_FIFO()
+        self.__raw_FIFO_rate = None
+
+    def raw_FIFO_read(self, a_out, a_max_samples=None):
+        # Drain the whole records waiting in the FIFO into rows of a_out,
+        # an (N, 6) array of ax, ay, az, gx, gy, gz (see
+        # sensor_decode.allocate_block). Returns the number of rows written.
+        # A full FIFO has dropped data and lost its record alignment, so it
+        # is reset and the samples lost since the last read are counted.
+        if self.__raw_FIFO_rate is None:
+            raise IOError("Raw FIFO capture is not started")
+        max_samples = len(a_out)
+        if a_max_samples is not None:
+            max_samples = min(max_samples, a_max_samples)
+        FIFO_count = self.get_FIFO_count()
+        now = time.monotonic()
+        if FIFO_count >= FIFO_SIZE:
+            self.reset_FIFO()
+            self.__raw_FIFO_overflows += 1
+            self.__raw_FIFO_dropped += int(round(
+                (now - self.__raw_FIFO_time) * self.__raw_FIFO_rate))
+            self.__raw_FIFO_time = now
+            return 0
+        self.__raw_FIFO_time = now
+        samples = min(FIFO_count // RAW_FIFO_RECORD_SIZE, max_samples)
+        length = samples * RAW_FIFO_RECORD_SIZE
+        self.read_FIFO_into(self.__raw_FIFO_buffer, length)
+        sensor_decode.block_be(memoryview(self.__raw_FIFO_buffer)[:length],
+                               RAW_FIFO_COLUMNS, a_out[:samples])
+        self.__raw_FIFO_samples += samples
+        return samples
+
+    def raw_FIFO_capture(self, a_samples, a_out=None, a_timeout=None):
+        # Collect a_samples evenly spaced samples, sleeping between drains
+        # for about half a FIFO worth of records. Returns the filled array.
+        if a_out is None:
+            a_out = sensor_decode.allocate_block(a_samples, RAW_FIFO_COLUMNS)
+        if self.__raw_FIFO_rate is None:
+            self.raw_FIFO_start()
+        period = (FIFO_SIZE // RAW_FIFO_RECORD_SIZE) / \
+            (2.0 * self.__raw_FIFO_rate)
+        deadline = None
+        if a_timeout is not None:
+            deadline = time.monotonic() + a_timeout
+        index = 0
+        while index < a_samples:
+            if deadline is not None and time.monotonic() > deadline:
+                raise IOError("Raw FIFO capture timed out")
+            index += self.raw_FIFO_read(a_out[index:a_samples])
+            if index < a_samples:
+                time.sleep(min(period, (a_samples - index) /
+                               self.__raw_FIFO_rate))
+        return a_out
+
+    def get_raw_FIFO_stats(self):
+        # rate (Hz), samples read, overflows and samples dropped by them
+        return {'rate': self.__raw_FIFO_rate,
+                'samples': self.__raw_FIFO_samples,
+                'overflows': self.__raw_FIFO_overflows,
+                'dropped': self.__raw_FIFO_dropped}
 
     def get_int_status(self):
         return self.__bus.read_byte_data(self.__dev_id,
                                          C.MPU6050_RA_INT_STATUS)
 
     # Data retrieval from received FIFO buffer
-    def DMP_get_quaternion_int16(self, a_FIFO_buffer):
-        w = ctypes.c_int16((a_FIFO_buffer[0] << 8) | a_FIFO_buffer[1]).value
-        x = ctypes.c_int16((a_FIFO_buffer[4] << 8) | a_FIFO_buffer[5]).value
-        y = ctypes.c_int16((a_FIFO_buffer[8] << 8) | a_FIFO_buffer[9]).value
-        z = ctypes.c_int16((a_FIFO_buffer[12] << 8) | a_FIFO_buffer[13]).value
-        return Q(w, x, y, z)
-
-    def DMP_get_quaternion(self, a_FIFO_buffer):
-        quat = self.DMP_get_quaternion_int16(a_FIFO_buffer)
-        w = quat.w / 16384.0
-        x = quat.x / 16384.0
-        y = quat.y / 16384.0
-        z = quat.z / 16384.0
-        return Q(w, x, y, z)
+    # The a_out parameters take a Q or V to fill in place instead of
+    # allocating a new one per packet
+    def DMP_get_quaternion_int16(self, a_FIFO_buffer, a_out=None):
+        w, x, y, z = sensor_decode.dmp_quaternion(a_FIFO_buffer)
+        if a_out is None:
+            return Q(w, x, y, z)
+        return a_out.set(w, x, y, z)
+
+    def DMP_get_quaternion(self, a_FIFO_buffer, a_out=None):
+        w, x, y, z = sensor_decode.dmp_quaternion(a_FIFO_buffer)
+        w = w / 16384.0
+        x = x / 16384.0
+        y = y / 16384.0
+        z = z / 16384.0
+        if a_out is None:
+            return Q(w, x, y, z)
+        return a_out.set(w, x, y, z)
 
     def DMP_get_acceleration_int16(self, a_FIFO_buffer):
-        x = ctypes.c_int16(a_FIFO_buffer[28] << 8 | a_FIFO_buffer[29]).value
-        y = ctypes.c_int16(a_FIFO_buffer[32] << 8 | a_FIFO_buffer[33]).value
-        z = ctypes.c_int16(a_FIFO_buffer[36] << 8 | a_FIFO_buffer[37]).value
+        x, y, z = sensor_decode.dmp_acceleration(a_FIFO_buffer)
         return V(x, y, z)
 
-    def DMP_get_gravity(self, a_quat):
+    def DMP_get_gravity(self, a_quat, a_out=None):
         x = 2.0 * (a_quat.x * a_quat.z - a_quat.w * a_quat.y)
         y = 2.0 * (a_quat.w * a_quat.x + a_quat.y * a_quat.z)
         z = 1.0 * (a_quat.w * a_quat.w - a_quat.x * a_quat.x -
                    a_quat.y * a_quat.y + a_quat.z * a_quat.z)
-        return V(x, y, z)
+        if a_out is None:
+            return V(x, y, z)
+        return a_out.set(x, y, z)
 
     def DMP_get_linear_accel_int16(self, a_v_raw, a_grav):
-        x = ctypes.c_int16(a_v_raw.x - (a_grav.x*8192)).value
-        y = ctypes.c_int16(a_v_raw.y - (a_grav.y*8192)).value
-        y = ctypes.c_int16(a_v_raw.y - (a_grav.y*8192)).value
+        x = sensor_decode.to_int16(a_v_raw.x - (a_grav.x*8192))
+        y = sensor_decode.to_int16(a_v_raw.y - (a_grav.y*8192))
+        z = sensor_decode.to_int16(a_v_raw.z - (a_grav.z*8192))
         return V(x, y, z)
 
-    def DMP_get_euler(self, a_quat):
+    def DMP_get_euler(self, a_quat, a_out=None):
         psi = math.atan2(2*a_quat.x*a_quat.y - 2*a_quat.w*a_quat.z,
                          2*a_quat.w*a_quat.w + 2*a_quat.x*a_quat.x - 1)
-        theta = -asin(2*a_quat.x*a_quat.z + 2*a_quat.w*a_quat.y)
+        theta = -math.asin(2*a_quat.x*a_quat.z + 2*a_quat.w*a_quat.y)
         phi = math.atan2(2*a_quat.y*a_quat.z - 2*a_quat.w*a_quat.x,
                          2*a_quat.w*a_quat.w + 2*a_quat.z*a_quat.z - 1)
-        return V(psi, theta, phi)
+        if a_out is None:
+            return V(psi, theta, phi)
+        return a_out.set(psi, theta, phi)
 
-    def DMP_get_roll_pitch_yaw(self, a_quat, a_grav_vect):
+    def DMP_get_roll_pitch_yaw(self, a_quat, a_grav_vect, a_out=None):
         # roll: (tilt left/right, about X axis)
         roll = math.atan(a_grav_vect.y /
                          math.sqrt(a_grav_vect.x*a_grav_vect.x +
@@ -830,14 +1209,16 @@ class MPU6050:
         # yaw: (about Z axis)
         yaw = math.atan2(2*a_quat.x*a_quat.y - 2*a_quat.w*a_quat.z,
                          2*a_quat.w*a_quat.w + 2*a_quat.x*a_quat.x - 1)
-        return V(roll, pitch, yaw)
+        if a_out is None:
+            return V(roll, pitch, yaw)
+        return a_out.set(roll, pitch, yaw)
 
-    def DMP_get_euler_roll_pitch_yaw(self, a_quat, a_grav_vect):
-        rad_ypr = self.DMP_get_roll_pitch_yaw(a_quat, a_grav_vect)
-        roll = rad_ypr.x * (180.0/math.pi)
-        pitch = rad_ypr.y * (180.0/math.pi)
-        yaw = rad_ypr.z * (180.0/math.pi)
-        return V(roll, pitch, yaw)
+    def DMP_get_euler_roll_pitch_yaw(self, a_quat, a_grav_vect, a_out=None):
+        rad_ypr = self.DMP_get_roll_pitch_yaw(a_quat, a_grav_vect, a_out)
+        rad_ypr.x = rad_ypr.x * (180.0/math.pi)
+        rad_ypr.y = rad_ypr.y * (180.0/math.pi)
+        rad_ypr.z = rad_ypr.z * (180.0/math.pi)
+        return rad_ypr
 
     def DMP_get_linear_accel(self, a_vector_raw, a_vect_grav):
         x = a_vector_raw.x - a_vect_grav.x*8192
@@ -846,6 +1227,12 @@ class MPU6050:
         return V(x, y, z)
 
 
+# Record layout of the MPU6050IRQHandler log (26 bytes per packet)
+DMP_LOG_FIELDS = [('t', '<f8'),
+                  ('accel_x', '<i2'), ('accel_y', '<i2'), ('accel_z', '<i2'),
+                  ('roll', '<f4'), ('pitch', '<f4'), ('yaw', '<f4')]
+
+
 class MPU6050IRQHandler:
     __mpu = MPU6050
     __FIFO_buffer = list()
@@ -853,9 +1240,11 @@ class MPU6050IRQHandler:
     __packet_size = None
     __detected_error = False
     __logging = False
-    __log_file = None
-    __csv_writer = None
+    __log_writer = None
     __start_time = None
+    __quat = None
+    __grav = None
+    __roll_pitch_yaw = None
     __debug = None
 
     # def __init__(self, a_i2c_bus, a_device_address, a_x_accel_offset,
@@ -865,7 +1254,7 @@ class MPU6050IRQHandler:
     #                         a_y_accel_offset, a_z_accel_offset,
     #                         a_x_gyro_offset, a_y_gyro_offset, a_z_gyro_offset,
     #                         a_enable_debug_output)
-    def __init__(self, a_mpu, a_logging=False, a_log_file='log.csv',
+    def __init__(self, a_mpu, a_logging=False, a_log_file='log.imu',
                  a_debug=False):
         self.__mpu = a_mpu
         self.__FIFO_buffer = [0]*64
@@ -873,15 +1262,26 @@ class MPU6050IRQHandler:
         self.__mpu.set_DMP_enabled(True)
         self.__packet_size = self.__mpu.DMP_get_FIFO_packet_size()
         mpu_int_status = self.__mpu.get_int_status()
+        # Reused for every packet
+        self.__quat = Q()
+        self.__grav = V()
+        self.__roll_pitch_yaw = V()
         if a_logging:
-            self.__start_time = time.clock()
+            # Binary records written by a background thread, see imu_log
+            self.__start_time = time.monotonic()
             self.__logging = True
-            self.__log_file = open(a_log_file, 'ab')
-            self.__csv_writer = csv.writer(self.__log_file, delimiter=',',
-                                           quotechar='|',
-                                           quoting=csv.QUOTE_MINIMAL)
+            self.__log_writer = imu_log.LogWriter(
+                a_log_file, DMP_LOG_FIELDS,
+                meta={'sensor': 'MPU6050 DMP',
+                      'units': {'t': 's', 'accel': 'LSB',
+                                'roll_pitch_yaw': 'deg'}})
         self.__debug = a_debug
 
+    def close(self):
+        # Write out and close the log
+        if self.__log_writer is not None:
+            self.__log_writer.close()
+
     def action(self, channel):
         if self.__detected_error:
             # Clear FIFO and reset MPU
@@ -915,32 +1315,30 @@ class MPU6050IRQHandler:
                     self.__detected_error = True
                     return
 
-            while FIFO_count > self.__packet_size:
+            # Drain every whole packet that is waiting with block reads
+            try:
+                FIFO_packets = self.__mpu.DMP_get_FIFO_packets(FIFO_count)
+            except:
+                self.__detected_error = True
+                return
 
-                try:
-                    self.__FIFO_buffer = \
-                        self.__mpu.get_FIFO_bytes(self.__packet_size)
-                except:
-                    self.__detected_error = True
-                    return
+            for FIFO_packet in FIFO_packets:
                 accel = \
-                    self.__mpu.DMP_get_acceleration_int16(self.__FIFO_buffer)
-                quat = self.__mpu.DMP_get_quaternion_int16(self.__FIFO_buffer)
-                grav = self.__mpu.DMP_get_gravity(quat)
-                roll_pitch_yaw = self.__mpu.DMP_get_euler_roll_pitch_yaw(quat,
-                                                                         grav)
+                    self.__mpu.DMP_get_acceleration_int16(FIFO_packet)
+                quat = self.__mpu.DMP_get_quaternion_int16(FIFO_packet,
+                                                           self.__quat)
+                grav = self.__mpu.DMP_get_gravity(quat, self.__grav)
+                roll_pitch_yaw = self.__mpu.DMP_get_euler_roll_pitch_yaw(
+                    quat, grav, self.__roll_pitch_yaw)
                 if self.__logging:
-                    delta_time = time.clock() - self.__start_time
-                    data_concat = ['%.4f' % delta_time] + \
-                        [accel.x, accel.y, accel.z] + \
-                        ['%.3f' % roll_pitch_yaw.x,
-                         '%.3f' % roll_pitch_yaw.y,
-                         '%.3f' % roll_pitch_yaw.z]
-                    self.__csv_writer.writerow(data_concat)
+                    delta_time = time.monotonic() - self.__start_time
+                    self.__log_writer.append(
+                        (delta_time, accel.x, accel.y, accel.z,
+                         roll_pitch_yaw.x, roll_pitch_yaw.y,
+                         roll_pitch_yaw.z))
 
                 if (self.__debug) and (self.__count % 100 == 0):
                     print('roll: ' + str(roll_pitch_yaw.x))
                     print('pitch: ' + str(roll_pitch_yaw.y))
                     print('yaw: ' + str(roll_pitch_yaw.z))
                 self.__count += 1
-                FIFO_count -= self.__packet_size
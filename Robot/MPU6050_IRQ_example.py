@@ -1,12 +1,14 @@
 import time
 from MPU6050 import MPU6050
 from MPU6050 import MPU6050IRQHandler
+from calibration_store import CalibrationStore
 import Adafruit_BBIO.GPIO as GPIO
 
 i2c_bus = 1
 device_address = 0x68
-# The offsets are different for each device and should be changed to
-# sutiable figures using a calibration procedure
+# The offsets are different for each device. The ones saved by
+# MPU6050_cal.py for this device and temperature are loaded from the
+# calibration store; these figures are only used when there are none
 x_accel_offset = -5489
 y_accel_offset = -1441
 z_accel_offset = 1305
@@ -15,11 +17,13 @@ y_gyro_offset = -72
 z_gyro_offset = -5
 enable_debug_output = True
 enable_logging = True
-log_file = 'mpulog.csv'
+log_file = 'mpulog.imu'
 
-mpu = MPU6050(i2c_bus, device_address, x_accel_offset,
-              y_accel_offset, z_accel_offset, x_gyro_offset,
-              y_gyro_offset, z_gyro_offset, enable_debug_output)
+mpu = MPU6050(i2c_bus, device_address, a_debug=enable_debug_output,
+              a_calibration=CalibrationStore())
+if mpu.get_calibration() is None:
+    mpu.set_accel_offsets([x_accel_offset, y_accel_offset, z_accel_offset])
+    mpu.set_gyro_offsets([x_gyro_offset, y_gyro_offset, z_gyro_offset])
 mpuC = MPU6050IRQHandler(mpu, enable_logging, log_file)
 
 GPIO.setup("P9_11", GPIO.IN)
@@ -30,4 +34,5 @@ try:
         time.sleep(1)
 except KeyboardInterrupt:
     GPIO.cleanup()
+mpuC.close()  # write out the rest of the log
 GPIO.cleanup()
@@ -47,12 +47,14 @@ THE SOFTWARE.
 """
 from math import sqrt
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 
 class Quaternion:
-    w = 0.0
-    x = 0.0
-    y = 0.0
-    z = 0.0
+    __slots__ = ('w', 'x', 'y', 'z')
 
     def __init__(self, a_w=1.0, a_x=0.0, a_y=0.0, a_z=0.0):
         self.w = a_w
@@ -60,6 +62,13 @@ class Quaternion:
         self.y = a_y
         self.z = a_z
 
+    def set(self, a_w, a_x, a_y, a_z):
+        self.w = a_w
+        self.x = a_x
+        self.y = a_y
+        self.z = a_z
+        return self
+
     def get_product(self, a_quat):
         result = Quaternion(
             self.w * a_quat.w - self.x * a_quat.x -
@@ -75,10 +84,25 @@ class Quaternion:
             self.y * a_quat.x + self.z * a_quat.w)
         return result
 
+    def mul_(self, a_quat):
+        # In place self = self * a_quat, returns self
+        w, x, y, z = self.w, self.x, self.y, self.z
+        self.w = w * a_quat.w - x * a_quat.x - y * a_quat.y - z * a_quat.z
+        self.x = w * a_quat.x + x * a_quat.w + y * a_quat.z - z * a_quat.y
+        self.y = w * a_quat.y - x * a_quat.z + y * a_quat.w + z * a_quat.x
+        self.z = w * a_quat.z + x * a_quat.y - y * a_quat.x + z * a_quat.w
+        return self
+
     def get_conjugate(self):
         result = Quaternion(self.w, -self.x, -self.y, -self.z)
         return result
 
+    def conjugate_(self):
+        self.x = -self.x
+        self.y = -self.y
+        self.z = -self.z
+        return self
+
     def get_magnitude(self):
         return sqrt(self.w * self.w + self.x * self.x + self.y * self.y +
                     self.z * self.z)
@@ -90,6 +114,11 @@ class Quaternion:
         self.y = self.y / m
         self.z = self.z / m
 
+    def normalize_(self):
+        # In place normalize, returns self
+        self.normalize()
+        return self
+
     def get_normalized(self):
         result = Quaternion(self.w, self.x, self.y, self.z)
         result.normalize()
@@ -97,15 +126,19 @@ class Quaternion:
 
 
 class XYZVector:
-    x = 0.0
-    y = 0.0
-    z = 0.0
+    __slots__ = ('x', 'y', 'z')
 
     def __init__(self, a_x=0.0, a_y=0.0, a_z=0.0):
         self.x = a_x
         self.y = a_y
         self.z = a_z
 
+    def set(self, a_x, a_y, a_z):
+        self.x = a_x
+        self.y = a_y
+        self.z = a_z
+        return self
+
     def get_magnitude(self):
         return sqrt(self.x*self.x + self.y*self.y + self.z*self.z)
 
@@ -115,21 +148,195 @@ class XYZVector:
         self.y = self.y / m
         self.z = self.z / m
 
+    def normalize_(self):
+        # In place normalize, returns self
+        self.normalize()
+        return self
+
     def get_normalized(self):
         result = XYZVector(self.x, self.y, self.z)
         result.normalize()
         return result
 
     def rotate(self, a_quat):
-        p = Quaternion(0.0, self.x, self.y, self.z)
-        p = a_quat.get_product(p)
-        p = p.get_product(a_quat.get_conjugate())
-        # By magic quaternion p is now [0, x', y', z']
-        self.x = p.x
-        self.y = p.y
-        self.z = p.z
+        self.rotate_(a_quat)
+
+    def rotate_(self, a_quat):
+        # q p q* expanded for p = [0, v], u = [q.x, q.y, q.z]:
+        # v' = (w^2 - u.u) v + 2 (u.v) u + 2 w (u x v)
+        # which needs no temporary quaternions. Returns self
+        w, qx, qy, qz = a_quat.w, a_quat.x, a_quat.y, a_quat.z
+        x, y, z = self.x, self.y, self.z
+        s = w * w - qx * qx - qy * qy - qz * qz
+        d = 2.0 * (qx * x + qy * y + qz * z)
+        w2 = 2.0 * w
+        self.x = s * x + d * qx + w2 * (qy * z - qz * y)
+        self.y = s * y + d * qy + w2 * (qz * x - qx * z)
+        self.z = s * z + d * qz + w2 * (qx * y - qy * x)
+        return self
 
     def get_rotated(self, a_quat):
         r = XYZVector(self.x, self.y, self.z)
-        r.rotate(a_quat)
+        r.rotate_(a_quat)
         return r
+
+
+def _require_numpy():
+    if np is None:
+        raise ImportError("numpy is needed for QuaternionArray and "
+                          "VectorArray")
+
+
+class QuaternionArray:
+    # N quaternions as an (N, 4) float array of w, x, y, z; the batch
+    # counterpart of Quaternion and the MPU6050 DMP_get_* helpers
+    __slots__ = ('data',)
+
+    def __init__(self, a_data):
+        _require_numpy()
+        self.data = np.asarray(a_data, dtype=np.float64).reshape(-1, 4)
+
+    @classmethod
+    def from_quaternions(cls, a_quats):
+        return cls([(q.w, q.x, q.y, q.z) for q in a_quats])
+
+    @classmethod
+    def from_DMP_packets(cls, a_FIFO_buffer, a_packet_size=42):
+        # Quaternions of a run of DMP FIFO packets (e.g. a logged FIFO
+        # drain): the high words of the 32 bit w, x, y, z, scaled to 1.0
+        _require_numpy()
+        words = np.frombuffer(bytes(a_FIFO_buffer), dtype='>i2')
+        words = words[:len(words) - len(words) % (a_packet_size // 2)]
+        words = words.reshape(-1, a_packet_size // 2)
+        return cls(words[:, 0:8:2] / 16384.0)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, a_index):
+        w, x, y, z = self.data[a_index].tolist()
+        return Quaternion(w, x, y, z)
+
+    @property
+    def w(self):
+        return self.data[:, 0]
+
+    @property
+    def x(self):
+        return self.data[:, 1]
+
+    @property
+    def y(self):
+        return self.data[:, 2]
+
+    @property
+    def z(self):
+        return self.data[:, 3]
+
+    def get_product(self, a_quats):
+        # Element wise self * a_quats, a_quats being a QuaternionArray of
+        # the same length or one Quaternion
+        w1, x1, y1, z1 = self.w, self.x, self.y, self.z
+        w2, x2, y2, z2 = a_quats.w, a_quats.x, a_quats.y, a_quats.z
+        result = np.empty(self.data.shape)
+        result[:, 0] = w1 * w2 - x1 * x2 - y1 * y2 - z1 * z2
+        result[:, 1] = w1 * x2 + x1 * w2 + y1 * z2 - z1 * y2
+        result[:, 2] = w1 * y2 - x1 * z2 + y1 * w2 + z1 * x2
+        result[:, 3] = w1 * z2 + x1 * y2 - y1 * x2 + z1 * w2
+        return QuaternionArray(result)
+
+    def get_conjugate(self):
+        return QuaternionArray(self.data * (1.0, -1.0, -1.0, -1.0))
+
+    def get_magnitude(self):
+        return np.sqrt(np.einsum('ij,ij->i', self.data, self.data))
+
+    def normalize_(self):
+        self.data /= self.get_magnitude()[:, None]
+        return self
+
+    def get_normalized(self):
+        return QuaternionArray(self.data.copy()).normalize_()
+
+    def get_gravity(self):
+        # Batch MPU6050.DMP_get_gravity
+        w, x, y, z = self.w, self.x, self.y, self.z
+        return VectorArray(np.column_stack((
+            2.0 * (x * z - w * y),
+            2.0 * (w * x + y * z),
+            w * w - x * x - y * y + z * z)))
+
+    def get_euler(self):
+        # Batch MPU6050.DMP_get_euler: (psi, theta, phi) in radians
+        w, x, y, z = self.w, self.x, self.y, self.z
+        return VectorArray(np.column_stack((
+            np.arctan2(2*x*y - 2*w*z, 2*w*w + 2*x*x - 1),
+            -np.arcsin(np.clip(2*x*z + 2*w*y, -1.0, 1.0)),
+            np.arctan2(2*y*z - 2*w*x, 2*w*w + 2*z*z - 1))))
+
+    def get_roll_pitch_yaw(self, a_gravity=None):
+        # Batch MPU6050.DMP_get_roll_pitch_yaw in radians
+        if a_gravity is None:
+            a_gravity = self.get_gravity()
+        gx, gy, gz = a_gravity.x, a_gravity.y, a_gravity.z
+        w, x, y, z = self.w, self.x, self.y, self.z
+        return VectorArray(np.column_stack((
+            np.arctan(gy / np.sqrt(gx * gx + gz * gz)),
+            np.arctan(gx / np.sqrt(gy * gy + gz * gz)),
+            np.arctan2(2*x*y - 2*w*z, 2*w*w + 2*x*x - 1))))
+
+
+class VectorArray:
+    # N vectors as an (N, 3) float array of x, y, z
+    __slots__ = ('data',)
+
+    def __init__(self, a_data):
+        _require_numpy()
+        self.data = np.asarray(a_data, dtype=np.float64).reshape(-1, 3)
+
+    @classmethod
+    def from_vectors(cls, a_vectors):
+        return cls([(v.x, v.y, v.z) for v in a_vectors])
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, a_index):
+        x, y, z = self.data[a_index].tolist()
+        return XYZVector(x, y, z)
+
+    @property
+    def x(self):
+        return self.data[:, 0]
+
+    @property
+    def y(self):
+        return self.data[:, 1]
+
+    @property
+    def z(self):
+        return self.data[:, 2]
+
+    def get_magnitude(self):
+        return np.sqrt(np.einsum('ij,ij->i', self.data, self.data))
+
+    def normalize_(self):
+        self.data /= self.get_magnitude()[:, None]
+        return self
+
+    def get_normalized(self):
+        return VectorArray(self.data.copy()).normalize_()
+
+    def get_rotated(self, a_quats):
+        # Rotate by a QuaternionArray (element wise) or one Quaternion,
+        # with the same expansion as XYZVector.rotate_
+        if isinstance(a_quats, Quaternion):
+            w = a_quats.w
+            u = np.array([a_quats.x, a_quats.y, a_quats.z])
+        else:
+            w = a_quats.w[:, None]
+            u = a_quats.data[:, 1:]
+        v = self.data
+        s = w * w - np.sum(u * u, axis=-1, keepdims=True)
+        d = 2.0 * np.sum(u * v, axis=1, keepdims=True)
+        return VectorArray(s * v + d * u + 2.0 * w * np.cross(u, v))
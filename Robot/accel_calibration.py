@@ -12,9 +12,9 @@
 ######################################################
 import numpy as np
 import matplotlib.pyplot as plt
-from scipy.optimize import curve_fit
 
 from mpu6050 import MPU6050
+from imu_calibration import AccelCalibrator, SIX_POSITIONS
 
 
 def accel_fit(x_input, m_x, b):
@@ -24,34 +24,25 @@ def accel_fit(x_input, m_x, b):
 def accel_cal():
     print("-" * 50)
     print("Accelerometer Calibration")
-    mpu_offsets = [[], [], []]  # offset array to be printed
-    axis_vec = ['z', 'y', 'x']  # axis labels
-    cal_directions = ["upward", "downward", "perpendicular to gravity"]  # direction for IMU cal
-    cal_indices = [2, 1, 0]  # axis indices
-    for qq, ax_qq in enumerate(axis_vec):
-        ax_offsets = [[], [], []]
+    calibrator = AccelCalibrator()  # accumulates the fit as samples stream in
+    for ax_qq, direc, reference in SIX_POSITIONS:
         print("-" * 50)
-        for direc_ii, direc in enumerate(cal_directions):
-            input("-" * 8 + " Press Enter and Keep IMU Steady to Calibrate the Accelerometer with the -" +
-                  ax_qq + "-axis pointed " + direc)
-            [mpu.get_accel_data() for ii in range(0, cal_size)]  # clear buffer between readings
-            mpu_array = []
-            while len(mpu_array) < cal_size:
-                try:
-                    ax, ay, az = mpu.get_accel_data()
-                    mpu_array.append([ax, ay, az])  # append to array
-                except:
-                    continue
-            ax_offsets[direc_ii] = np.array(mpu_array)[:, cal_indices[qq]]  # offsets for direction
+        input("-" * 8 + " Press Enter and Keep IMU Steady to Calibrate the Accelerometer with the -" +
+              ax_qq + "-axis pointed " + direc)
+        [mpu.get_accel_data() for ii in range(0, cal_size)]  # clear buffer between readings
+        ii = 0
+        while ii < cal_size:
+            try:
+                calibrator.add(mpu.get_accel_data(), reference)
+            except (IOError, OSError):
+                continue
+            ii += 1
 
-        # use three calibrations (+1g, -1g, 0g) for linear fit
-        popts, _ = curve_fit(accel_fit, np.append(np.append(ax_offsets[0],
-                                                            ax_offsets[1]), ax_offsets[2]),
-                             np.append(np.append(1.0 * np.ones(np.shape(ax_offsets[0])),
-                                                 -1.0 * np.ones(np.shape(ax_offsets[1]))),
-                                       0.0 * np.ones(np.shape(ax_offsets[2]))),
-                             maxfev=10000)
-        mpu_offsets[cal_indices[qq]] = popts  # place slope and intercept in offset array
+    # closed form least squares for every axis: +1g, -1g and 0g references
+    scale, bias = calibrator.solve_linear()
+    mpu_offsets = [np.array([scale[ii], bias[ii]]) for ii in range(0, 3)]  # slope and intercept per axis
+    matrix, offset = calibrator.solve_six_position()  # with cross-axis misalignment
+    print('Misalignment and scale matrix:\n{0}\nOffset: {1}'.format(matrix, offset))
     print('Accelerometer Calibration Complete')
     return mpu_offsets
 
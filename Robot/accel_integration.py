@@ -13,12 +13,14 @@
 import time
 import numpy as np
 import matplotlib.pyplot as plt
-from scipy.optimize import curve_fit
 from scipy.integrate import cumtrapz
 from scipy import signal
 
 from hmc5883 import HMC5883
 from mpu6050 import MPU6050
+from ring_buffer import RingBuffer
+from imu_calibration import AccelCalibrator, SIX_POSITIONS
+import calibration_store
 
 
 def accel_fit(x_input, m_x, b):
@@ -33,36 +35,26 @@ def get_accel():
 def accel_cal():
     print("-" * 50)
     print("Accelerometer Calibration")
-    mpu_offsets = [[], [], []]  # offset array to be printed
-    axis_vec = ['z', 'y', 'x']  # axis labels
-    cal_directions = ["upward", "downward", "perpendicular to gravity"]  # direction for IMU cal
-    cal_indices = [2, 1, 0]  # axis indices
-    for qq, ax_qq in enumerate(axis_vec):
-        ax_offsets = [[], [], []]
+    calibrator = AccelCalibrator()  # accumulates the fit as samples stream in
+    for ax_qq, direc, reference in SIX_POSITIONS:
         print("-" * 50)
-        for direc_ii, direc in enumerate(cal_directions):
-            input("-" * 8 + " Press Enter and Keep IMU Steady to Calibrate the Accelerometer with the -" +
-                  ax_qq + "-axis pointed " + direc)
-            [mpu.get_accel_data() for ii in range(0, cal_size)]  # clear buffer between readings
-            mpu_array = []
-            while len(mpu_array) < cal_size:
-                try:
-                    ax, ay, az = get_accel()
-                    mpu_array.append([ax, ay, az])  # append to array
-                except:
-                    continue
-            ax_offsets[direc_ii] = np.array(mpu_array)[:, cal_indices[qq]]  # offsets for direction
-
-        # use three calibrations (+1g, -1g, 0g) for linear fit
-        popts, _ = curve_fit(accel_fit, np.append(np.append(ax_offsets[0],
-                                                  ax_offsets[1]),
-                                                  ax_offsets[2]),
-                             np.append(np.append(1.0 * np.ones(np.shape(ax_offsets[0])),
-                                       -1.0 * np.ones(np.shape(ax_offsets[1]))),
-                                       0.0 * np.ones(np.shape(ax_offsets[2]))),
-                             maxfev=10000)
-        mpu_offsets[cal_indices[qq]] = popts  # place slope and intercept in offset array
-    print('Accelerometer Calibrations Complete')
+        input("-" * 8 + " Press Enter and Keep IMU Steady to Calibrate the Accelerometer with the -" +
+              ax_qq + "-axis pointed " + direc)
+        [mpu.get_accel_data() for ii in range(0, cal_size)]  # clear buffer between readings
+        ii = 0
+        while ii < cal_size:
+            try:
+                calibrator.add(mpu.get_accel_data(), reference)
+            except (IOError, OSError):
+                continue
+            ii += 1
+
+    # closed form least squares for every axis: +1g, -1g and 0g references
+    scale, bias = calibrator.solve_linear()
+    mpu_offsets = [np.array([scale[ii], bias[ii]]) for ii in range(0, 3)]  # slope and intercept per axis
+    matrix, offset = calibrator.solve_six_position()  # with cross-axis misalignment
+    print('Misalignment and scale matrix:\n{0}\nOffset: {1}'.format(matrix, offset))
+    print('Accelerometer Calibration Complete')
     return mpu_offsets
 
 
@@ -70,26 +62,31 @@ def imu_integrator():
     # main loop to integrate IMU
     data_indx = 1  # index of variable to integrate
     dt_stop = 5  # seconds to record and integrate
+    max_rate = 2000  # highest expected sample rate (sizes the buffer)
 
     plt.style.use('ggplot')
     plt.ion()
     fig, axs = plt.subplots(3, 1, figsize=(12, 9))
     break_bool = False
+    accel_ring = RingBuffer(int(dt_stop * max_rate), ['accel'])  # pre-allocated
     while True:
         # reading and printing IMU values
-        accel_array, t_array = [], []
+        accel_ring.clear()
         print("Starting Data Acquisition")
         [axs[ii].clear() for ii in range(0, 3)]
         t0 = time.time()
         loop_bool = False
+        mx, my, mz = np.nan, np.nan, np.nan  # latest magnetometer sample
         while True:
             try:
-                ax, ay, az, wx, wy, wz = mpu.get_accel_data()  # accelerometer data
-                mx, my, mz = hmc.read()  # magnetometer data
-                t_array.append(time.time()-t0)
+                (ax, ay, az), (wx, wy, wz), temp = mpu.get_motion6()  # accel/gyro data
+                mag_sample = hmc.poll()  # magnetometer data, None until new
+                if mag_sample is not None:
+                    t_mag, mx, my, mz = mag_sample
                 data_array = [ax, ay, az, wx, wy, wz, mx, my, mz]
-                accel_array.append(accel_fit(data_array[data_indx],
-                                             *accel_coeffs[data_indx]))
+                accel_ring.append((accel_fit(data_array[data_indx],
+                                             *accel_coeffs[data_indx]),),
+                                  timestamp=time.time()-t0)
                 if not loop_bool:
                     loop_bool = True
                     print("Start Moving IMU...")
@@ -100,15 +97,20 @@ def imu_integrator():
                 break
         if break_bool:
             break
+        if accel_ring.written > accel_ring.capacity:
+            print("Warning: {0} samples overflowed the {1} sample buffer, raise max_rate".format(
+                accel_ring.written, accel_ring.capacity))
+        accel_data = accel_ring.view()
+        t_array, accel_array = accel_data['t'], accel_data['accel']
 
         # signal filtering
-        Fs_approx = len(accel_array)/dt_stop
+        Fs_approx = (len(accel_array)-1)/(t_array[-1]-t_array[0])  # only the kept samples
         b_filt, a_filt = signal.butter(4, 5, 'low', fs=Fs_approx)
         accel_array = signal.filtfilt(b_filt, a_filt, accel_array)
         accel_array = np.multiply(accel_array, 9.80665)
 
         # print Sample Rate and Accel Integration Value
-        print("Sample Rate: {0:2.0f}Hz".format(len(accel_array)/dt_stop))
+        print("Sample Rate: {0:2.0f}Hz".format(Fs_approx))
         veloc_array = np.append(0.0, cumtrapz(accel_array, x=t_array))
         dist_approx = np.trapz(veloc_array, x=t_array)
         dist_array = np.append(0.0, cumtrapz(veloc_array, x=t_array))
@@ -133,19 +135,22 @@ def imu_integrator():
 
 
 if __name__ == '__main__':
-    mpu = MPU6050()  # IMU (Accelerometer, Gyroscope)
-    hmc = HMC5883()  # Magnetometer
+    store = calibration_store.CalibrationStore()  # coefficients saved by earlier runs
+    mpu = MPU6050(0x68, calibration=store)  # IMU (Accelerometer, Gyroscope)
+    hmc = HMC5883(rate=75.0)  # Magnetometer
 
     # Accelerometer Gravity Calibration
     mpu_labels = ['a_x', 'a_y', 'a_z']  # gyro labels for plots
     cal_size = 1000  # number of points to use for calibration
-    old_vals_bool = True  # True uses values from another calibration
-    if old_vals_bool:
-        accel_coeffs = [np.array([0.9978107, -0.19471673]),
-                        np.array([0.99740193, -0.56129248]),
-                        np.array([0.9893495, 0.20589886])]
+    stored = mpu.calibrations.get(calibration_store.ACCEL_LINEAR)
+    if stored is not None:  # values from another calibration of this IMU
+        accel_coeffs = [np.array([scale, bias]) for scale, bias in
+                        zip(stored.values['scale'], stored.values['bias'])]
     else:
         accel_coeffs = accel_cal()  # grab accel coefficients
+        mpu.save_calibration(store, calibration_store.ACCEL_LINEAR,
+                             {'scale': [float(coeffs[0]) for coeffs in accel_coeffs],
+                              'bias': [float(coeffs[1]) for coeffs in accel_coeffs]})
 
     # record new data
     data = np.array([get_accel() for ii in range(0, cal_size)])  # new values
@@ -0,0 +1,344 @@
+"""
+Quaternion attitude and heading reference systems (AHRS)
+
+Madgwick (gradient descent) and Mahony (complementary PI) orientation
+filters. One update fuses the gyroscope with the accelerometer and, when
+given, the magnetometer into a Quaternion, from which roll, pitch and yaw
+are read. Without a magnetometer yaw is gyro only and drifts.
+
+Updates work on plain floats so they stay cheap in CPython; see
+benchmark_ahrs.py for the cost per update.
+
+Based on the reference implementations by Sebastian Madgwick,
+https://x-io.co.uk/open-source-imu-and-ahrs-algorithms/
+"""
+
+from math import atan2, asin, degrees, sqrt
+
+from Quaternion import Quaternion
+
+
+class AHRS:
+    """ Common state of the orientation filters """
+
+    def __init__(self, sample_period=0.01):
+        """
+        :param sample_period: Default time step of update() (s)
+        """
+        self.sample_period = sample_period
+        self.quaternion = Quaternion()
+
+    def reset(self, a_quat=None):
+        """
+        Restart from the given orientation, level and north by default
+
+        :param a_quat: A Quaternion
+        """
+        if a_quat is None:
+            a_quat = Quaternion()
+        self.quaternion = Quaternion(a_quat.w, a_quat.x, a_quat.y, a_quat.z)
+
+    def get_roll_pitch_yaw(self):
+        """
+        Get the orientation as Euler angles
+
+        :return: (roll, pitch, yaw) in degrees
+        """
+        q = self.quaternion
+        w, x, y, z = q.w, q.x, q.y, q.z
+        sin_pitch = 2.0 * (w * y - z * x)
+        if sin_pitch > 1.0:
+            sin_pitch = 1.0
+        elif sin_pitch < -1.0:
+            sin_pitch = -1.0
+        return (degrees(atan2(2.0 * (w * x + y * z),
+                              1.0 - 2.0 * (x * x + y * y))),
+                degrees(asin(sin_pitch)),
+                degrees(atan2(2.0 * (w * z + x * y),
+                              1.0 - 2.0 * (y * y + z * z))))
+
+    def update(self, gx, gy, gz, ax, ay, az, mx=0.0, my=0.0, mz=0.0,
+               dt=None):
+        """
+        Fuse one sample
+
+        :param gx, gy, gz: Angular rate (rad/s)
+        :param ax, ay, az: Acceleration, any unit (only the direction is
+                           used); all zero skips the correction
+        :param mx, my, mz: Magnetic field, any unit, in the accelerometer
+                           axes; all zero for a gyro and accel only update
+        :param dt: Time step (s), sample_period when omitted
+        :return: The updated Quaternion
+        """
+        if dt is None:
+            dt = self.sample_period
+        # Subclasses implement the filter step
+        return self._step(gx, gy, gz, ax, ay, az, mx, my, mz, dt)
+
+
+class MadgwickAHRS(AHRS):
+    """ Madgwick gradient descent orientation filter """
+
+    def __init__(self, sample_period=0.01, beta=0.1):
+        """
+        :param sample_period: Default time step of update() (s)
+        :param beta: Gradient descent gain; higher trusts the
+                     accelerometer and magnetometer more
+        """
+        AHRS.__init__(self, sample_period)
+        self.beta = beta
+
+    def _step(self, gx, gy, gz, ax, ay, az, mx, my, mz, dt):
+        if mx == 0.0 and my == 0.0 and mz == 0.0:
+            return self._step_imu(gx, gy, gz, ax, ay, az, dt)
+        q = self.quaternion
+        q0, q1, q2, q3 = q.w, q.x, q.y, q.z
+
+        # Rate of change of quaternion from gyroscope
+        qDot1 = 0.5 * (-q1 * gx - q2 * gy - q3 * gz)
+        qDot2 = 0.5 * (q0 * gx + q2 * gz - q3 * gy)
+        qDot3 = 0.5 * (q0 * gy - q1 * gz + q3 * gx)
+        qDot4 = 0.5 * (q0 * gz + q1 * gy - q2 * gx)
+
+        if not (ax == 0.0 and ay == 0.0 and az == 0.0):
+            recipNorm = 1.0 / sqrt(ax * ax + ay * ay + az * az)
+            ax *= recipNorm
+            ay *= recipNorm
+            az *= recipNorm
+            recipNorm = 1.0 / sqrt(mx * mx + my * my + mz * mz)
+            mx *= recipNorm
+            my *= recipNorm
+            mz *= recipNorm
+
+            _2q0mx = 2.0 * q0 * mx
+            _2q0my = 2.0 * q0 * my
+            _2q0mz = 2.0 * q0 * mz
+            _2q1mx = 2.0 * q1 * mx
+            _2q0 = 2.0 * q0
+            _2q1 = 2.0 * q1
+            _2q2 = 2.0 * q2
+            _2q3 = 2.0 * q3
+            _2q0q2 = 2.0 * q0 * q2
+            _2q2q3 = 2.0 * q2 * q3
+            q0q0 = q0 * q0
+            q0q1 = q0 * q1
+            q0q2 = q0 * q2
+            q0q3 = q0 * q3
+            q1q1 = q1 * q1
+            q1q2 = q1 * q2
+            q1q3 = q1 * q3
+            q2q2 = q2 * q2
+            q2q3 = q2 * q3
+            q3q3 = q3 * q3
+
+            # Reference direction of Earth's magnetic field
+            hx = (mx * q0q0 - _2q0my * q3 + _2q0mz * q2 + mx * q1q1 +
+                  _2q1 * my * q2 + _2q1 * mz * q3 - mx * q2q2 - mx * q3q3)
+            hy = (_2q0mx * q3 + my * q0q0 - _2q0mz * q1 + _2q1mx * q2 -
+                  my * q1q1 + my * q2q2 + _2q2 * mz * q3 - my * q3q3)
+            _2bx = sqrt(hx * hx + hy * hy)
+            _2bz = (-_2q0mx * q2 + _2q0my * q1 + mz * q0q0 + _2q1mx * q3 -
+                    mz * q1q1 + _2q2 * my * q3 - mz * q2q2 + mz * q3q3)
+            _4bx = 2.0 * _2bx
+            _4bz = 2.0 * _2bz
+
+            # Objective function residuals shared by the gradient terms
+            fax = 2.0 * q1q3 - _2q0q2 - ax
+            fay = 2.0 * q0q1 + _2q2q3 - ay
+            faz = 1.0 - 2.0 * q1q1 - 2.0 * q2q2 - az
+            fmx = _2bx * (0.5 - q2q2 - q3q3) + _2bz * (q1q3 - q0q2) - mx
+            fmy = _2bx * (q1q2 - q0q3) + _2bz * (q0q1 + q2q3) - my
+            fmz = _2bx * (q0q2 + q1q3) + _2bz * (0.5 - q1q1 - q2q2) - mz
+
+            # Gradient descent corrective step
+            s0 = (-_2q2 * fax + _2q1 * fay - _2bz * q2 * fmx +
+                  (-_2bx * q3 + _2bz * q1) * fmy + _2bx * q2 * fmz)
+            s1 = (_2q3 * fax + _2q0 * fay - 4.0 * q1 * faz +
+                  _2bz * q3 * fmx + (_2bx * q2 + _2bz * q0) * fmy +
+                  (_2bx * q3 - _4bz * q1) * fmz)
+            s2 = (-_2q0 * fax + _2q3 * fay - 4.0 * q2 * faz +
+                  (-_4bx * q2 - _2bz * q0) * fmx +
+                  (_2bx * q1 + _2bz * q3) * fmy +
+                  (_2bx * q0 - _4bz * q2) * fmz)
+            s3 = (_2q1 * fax + _2q2 * fay +
+                  (-_4bx * q3 + _2bz * q1) * fmx +
+                  (-_2bx * q0 + _2bz * q2) * fmy + _2bx * q1 * fmz)
+            norm = s0 * s0 + s1 * s1 + s2 * s2 + s3 * s3
+            if norm > 0.0:
+                recipNorm = self.beta / sqrt(norm)
+                qDot1 -= recipNorm * s0
+                qDot2 -= recipNorm * s1
+                qDot3 -= recipNorm * s2
+                qDot4 -= recipNorm * s3
+
+        return self.__integrate(q, q0 + qDot1 * dt, q1 + qDot2 * dt,
+                                q2 + qDot3 * dt, q3 + qDot4 * dt)
+
+    def update_imu(self, gx, gy, gz, ax, ay, az, dt=None):
+        """
+        Fuse one gyroscope and accelerometer sample, see AHRS.update
+        """
+        if dt is None:
+            dt = self.sample_period
+        return self._step_imu(gx, gy, gz, ax, ay, az, dt)
+
+    def _step_imu(self, gx, gy, gz, ax, ay, az, dt):
+        q = self.quaternion
+        q0, q1, q2, q3 = q.w, q.x, q.y, q.z
+
+        qDot1 = 0.5 * (-q1 * gx - q2 * gy - q3 * gz)
+        qDot2 = 0.5 * (q0 * gx + q2 * gz - q3 * gy)
+        qDot3 = 0.5 * (q0 * gy - q1 * gz + q3 * gx)
+        qDot4 = 0.5 * (q0 * gz + q1 * gy - q2 * gx)
+
+        if not (ax == 0.0 and ay == 0.0 and az == 0.0):
+            recipNorm = 1.0 / sqrt(ax * ax + ay * ay + az * az)
+            ax *= recipNorm
+            ay *= recipNorm
+            az *= recipNorm
+
+            _2q0 = 2.0 * q0
+            _2q1 = 2.0 * q1
+            _2q2 = 2.0 * q2
+            _2q3 = 2.0 * q3
+            _4q0 = 4.0 * q0
+            _4q1 = 4.0 * q1
+            _4q2 = 4.0 * q2
+            _8q1 = 8.0 * q1
+            _8q2 = 8.0 * q2
+            q0q0 = q0 * q0
+            q1q1 = q1 * q1
+            q2q2 = q2 * q2
+            q3q3 = q3 * q3
+
+            s0 = _4q0 * q2q2 + _2q2 * ax + _4q0 * q1q1 - _2q1 * ay
+            s1 = (_4q1 * q3q3 - _2q3 * ax + 4.0 * q0q0 * q1 - _2q0 * ay -
+                  _4q1 + _8q1 * q1q1 + _8q1 * q2q2 + _4q1 * az)
+            s2 = (4.0 * q0q0 * q2 + _2q0 * ax + _4q2 * q3q3 - _2q3 * ay -
+                  _4q2 + _8q2 * q1q1 + _8q2 * q2q2 + _4q2 * az)
+            s3 = 4.0 * q1q1 * q3 - _2q1 * ax + 4.0 * q2q2 * q3 - _2q2 * ay
+            norm = s0 * s0 + s1 * s1 + s2 * s2 + s3 * s3
+            if norm > 0.0:
+                recipNorm = self.beta / sqrt(norm)
+                qDot1 -= recipNorm * s0
+                qDot2 -= recipNorm * s1
+                qDot3 -= recipNorm * s2
+                qDot4 -= recipNorm * s3
+
+        return self.__integrate(q, q0 + qDot1 * dt, q1 + qDot2 * dt,
+                                q2 + qDot3 * dt, q3 + qDot4 * dt)
+
+    @staticmethod
+    def __integrate(a_quat, q0, q1, q2, q3):
+        recipNorm = 1.0 / sqrt(q0 * q0 + q1 * q1 + q2 * q2 + q3 * q3)
+        a_quat.w = q0 * recipNorm
+        a_quat.x = q1 * recipNorm
+        a_quat.y = q2 * recipNorm
+        a_quat.z = q3 * recipNorm
+        return a_quat
+
+
+class MahonyAHRS(AHRS):
+    """ Mahony nonlinear complementary orientation filter """
+
+    def __init__(self, sample_period=0.01, kp=1.0, ki=0.0):
+        """
+        :param sample_period: Default time step of update() (s)
+        :param kp: Proportional gain on the accelerometer / magnetometer
+                   error
+        :param ki: Integral gain, learns the gyro bias when above zero
+        """
+        AHRS.__init__(self, sample_period)
+        self.kp = kp
+        self.ki = ki
+        self.integral = [0.0, 0.0, 0.0]
+
+    def reset(self, a_quat=None):
+        AHRS.reset(self, a_quat)
+        self.integral = [0.0, 0.0, 0.0]
+
+    def _step(self, gx, gy, gz, ax, ay, az, mx, my, mz, dt):
+        q = self.quaternion
+        q0, q1, q2, q3 = q.w, q.x, q.y, q.z
+
+        if not (ax == 0.0 and ay == 0.0 and az == 0.0):
+            recipNorm = 1.0 / sqrt(ax * ax + ay * ay + az * az)
+            ax *= recipNorm
+            ay *= recipNorm
+            az *= recipNorm
+
+            # Estimated direction of gravity
+            halfvx = q1 * q3 - q0 * q2
+            halfvy = q0 * q1 + q2 * q3
+            halfvz = q0 * q0 - 0.5 + q3 * q3
+
+            # Error is the cross product between estimated and measured
+            halfex = ay * halfvz - az * halfvy
+            halfey = az * halfvx - ax * halfvz
+            halfez = ax * halfvy - ay * halfvx
+
+            if not (mx == 0.0 and my == 0.0 and mz == 0.0):
+                recipNorm = 1.0 / sqrt(mx * mx + my * my + mz * mz)
+                mx *= recipNorm
+                my *= recipNorm
+                mz *= recipNorm
+                q0q1 = q0 * q1
+                q0q2 = q0 * q2
+                q0q3 = q0 * q3
+                q1q1 = q1 * q1
+                q1q2 = q1 * q2
+                q1q3 = q1 * q3
+                q2q2 = q2 * q2
+                q2q3 = q2 * q3
+                q3q3 = q3 * q3
+
+                # Reference direction of Earth's magnetic field
+                hx = 2.0 * (mx * (0.5 - q2q2 - q3q3) + my * (q1q2 - q0q3) +
+                            mz * (q1q3 + q0q2))
+                hy = 2.0 * (mx * (q1q2 + q0q3) + my * (0.5 - q1q1 - q3q3) +
+                            mz * (q2q3 - q0q1))
+                bx = sqrt(hx * hx + hy * hy)
+                bz = 2.0 * (mx * (q1q3 - q0q2) + my * (q2q3 + q0q1) +
+                            mz * (0.5 - q1q1 - q2q2))
+
+                # Estimated direction of the magnetic field
+                halfwx = bx * (0.5 - q2q2 - q3q3) + bz * (q1q3 - q0q2)
+                halfwy = bx * (q1q2 - q0q3) + bz * (q0q1 + q2q3)
+                halfwz = bx * (q0q2 + q1q3) + bz * (0.5 - q1q1 - q2q2)
+
+                halfex += my * halfwz - mz * halfwy
+                halfey += mz * halfwx - mx * halfwz
+                halfez += mx * halfwy - my * halfwx
+
+            if self.ki > 0.0:
+                integral = self.integral
+                integral[0] += 2.0 * self.ki * halfex * dt
+                integral[1] += 2.0 * self.ki * halfey * dt
+                integral[2] += 2.0 * self.ki * halfez * dt
+                gx += integral[0]
+                gy += integral[1]
+                gz += integral[2]
+
+            gx += 2.0 * self.kp * halfex
+            gy += 2.0 * self.kp * halfey
+            gz += 2.0 * self.kp * halfez
+
+        gx *= 0.5 * dt
+        gy *= 0.5 * dt
+        gz *= 0.5 * dt
+        q0, q1, q2, q3 = (q0 - q1 * gx - q2 * gy - q3 * gz,
+                          q1 + q0 * gx + q2 * gz - q3 * gy,
+                          q2 + q0 * gy - q1 * gz + q3 * gx,
+                          q3 + q0 * gz + q1 * gy - q2 * gx)
+        recipNorm = 1.0 / sqrt(q0 * q0 + q1 * q1 + q2 * q2 + q3 * q3)
+        q.w = q0 * recipNorm
+        q.x = q1 * recipNorm
+        q.y = q2 * recipNorm
+        q.z = q3 * recipNorm
+        return q
+
+    def update_imu(self, gx, gy, gz, ax, ay, az, dt=None):
+        """
+        Fuse one gyroscope and accelerometer sample, see AHRS.update
+        """
+        return self.update(gx, gy, gz, ax, ay, az, dt=dt)
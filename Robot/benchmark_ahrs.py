@@ -0,0 +1,102 @@
+"""
+Orientation filter cost per update
+
+Times one update of the AHRS filters in ahrs.py against the per sample
+work AngleMeterAlpha did before (accelerometer angles, two KalmanAngle
+filters and the complementary filter) and reports how much of a 1 kHz
+sample period each one uses. Run it on the robot's CPU for Pi figures.
+"""
+
+import argparse
+import math
+import random
+import time
+
+from Kalman import KalmanAngle
+from ahrs import MadgwickAHRS, MahonyAHRS
+
+RAD_TO_DEG = 57.2957786
+
+
+def make_samples(a_count, a_seed=1):
+    # Slightly moving sensor: gyro (rad/s), accel (g), mag (uT)
+    rng = random.Random(a_seed)
+    samples = []
+    for index in range(0, a_count):
+        samples.append((rng.gauss(0.0, 0.05), rng.gauss(0.0, 0.05),
+                        rng.gauss(0.0, 0.05),
+                        rng.gauss(0.0, 0.02), rng.gauss(0.0, 0.02),
+                        1.0 + rng.gauss(0.0, 0.02),
+                        20.0 + rng.gauss(0.0, 0.5), rng.gauss(0.0, 0.5),
+                        -40.0 + rng.gauss(0.0, 0.5)))
+    return samples
+
+
+def kalman_and_complementary(a_dt):
+    # The roll / pitch computation of AngleMeterAlpha.measureAngles
+    kalmanX = KalmanAngle()
+    kalmanY = KalmanAngle()
+    state = [0.0, 0.0]
+
+    def update(gx, gy, gz, ax, ay, az, mx, my, mz):
+        roll = math.atan2(ay, az) * RAD_TO_DEG
+        pitch = math.atan(-ax / math.sqrt((ay ** 2) + (az ** 2))) * RAD_TO_DEG
+        gyroXRate = gx * RAD_TO_DEG
+        gyroYRate = -gy * RAD_TO_DEG
+        kalmanX.getAngle(roll, gyroXRate, a_dt)
+        kalmanY.getAngle(pitch, gyroYRate, a_dt)
+        state[0] = 0.93 * (state[0] + gyroXRate * a_dt) + 0.07 * roll
+        state[1] = 0.93 * (state[1] + gyroYRate * a_dt) + 0.07 * pitch
+    return update
+
+
+def time_update(a_label, a_update, a_samples, a_rate):
+    start_time = time.perf_counter()
+    for sample in a_samples:
+        a_update(*sample)
+    elapsed = time.perf_counter() - start_time
+    cost = elapsed / len(a_samples)
+    print('{0:<44} {1:7.2f} us/update {2:5.1f} % of {3:.0f} Hz'.format(
+        a_label, cost * 1e6, 100.0 * cost * a_rate, a_rate))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--samples', type=int, default=100000)
+    parser.add_argument('--rate', type=float, default=1000.0)
+    args = parser.parse_args()
+
+    dt = 1.0 / args.rate
+    samples = make_samples(args.samples)
+    madgwick = MadgwickAHRS(dt)
+    mahony = MahonyAHRS(dt, ki=0.1)
+
+    def madgwick_imu(gx, gy, gz, ax, ay, az, mx, my, mz):
+        madgwick.update_imu(gx, gy, gz, ax, ay, az, dt)
+
+    def madgwick_marg(gx, gy, gz, ax, ay, az, mx, my, mz):
+        madgwick.update(gx, gy, gz, ax, ay, az, mx, my, mz, dt)
+
+    def mahony_imu(gx, gy, gz, ax, ay, az, mx, my, mz):
+        mahony.update(gx, gy, gz, ax, ay, az, dt=dt)
+
+    def mahony_marg(gx, gy, gz, ax, ay, az, mx, my, mz):
+        mahony.update(gx, gy, gz, ax, ay, az, mx, my, mz, dt)
+
+    def with_euler(a_update, a_filter):
+        def update(*sample):
+            a_update(*sample)
+            a_filter.get_roll_pitch_yaw()
+        return update
+
+    time_update('2x KalmanAngle + complementary (roll, pitch)',
+                kalman_and_complementary(dt), samples, args.rate)
+    time_update('Madgwick gyro + accel', madgwick_imu, samples, args.rate)
+    time_update('Madgwick gyro + accel + mag', madgwick_marg, samples,
+                args.rate)
+    time_update('Madgwick gyro + accel + mag + Euler angles',
+                with_euler(madgwick_marg, madgwick), samples, args.rate)
+    time_update('Mahony gyro + accel', mahony_imu, samples, args.rate)
+    time_update('Mahony gyro + accel + mag', mahony_marg, samples, args.rate)
+    time_update('Mahony gyro + accel + mag + Euler angles',
+                with_euler(mahony_marg, mahony), samples, args.rate)
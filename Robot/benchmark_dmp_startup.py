@@ -0,0 +1,53 @@
+"""
+Startup time benchmark for the MPU6050 DMP
+
+Times a cold dmp_initialize (firmware always uploaded), a warm
+dmp_initialize (upload skipped when the firmware fingerprint matches) and
+write_DMP_configuration_set on its own.
+"""
+
+import time
+from MPU6050 import MPU6050
+from MPUConstants import MPUConstants as C
+
+i2c_bus = 1
+device_address = 0x68
+repeats = 5
+
+
+def time_call(a_function, *args, **kwargs):
+    start_time = time.perf_counter()
+    result = a_function(*args, **kwargs)
+    return time.perf_counter() - start_time, result
+
+
+def report(a_label, a_timings):
+    print('{0:<32} best {1:7.3f} s  mean {2:7.3f} s'.format(
+        a_label, min(a_timings), sum(a_timings) / len(a_timings)))
+
+
+if __name__ == '__main__':
+    mpu = MPU6050(i2c_bus, device_address)
+
+    cold_timings = []
+    warm_timings = []
+    config_timings = []
+    for run in range(0, repeats):
+        elapsed, result = time_call(mpu.dmp_initialize,
+                                    a_skip_resident_firmware=False)
+        if result != 0:
+            print('Cold dmp_initialize failed with ' + repr(result))
+        cold_timings.append(elapsed)
+
+        elapsed, result = time_call(mpu.dmp_initialize)
+        if result != 0:
+            print('Warm dmp_initialize failed with ' + repr(result))
+        warm_timings.append(elapsed)
+
+        elapsed, result = time_call(mpu.write_DMP_configuration_set,
+                                    C.dmpConfig, C.MPU6050_DMP_CONFIG_SIZE)
+        config_timings.append(elapsed)
+
+    report('dmp_initialize (cold upload)', cold_timings)
+    report('dmp_initialize (warm start)', warm_timings)
+    report('write_DMP_configuration_set', config_timings)
@@ -0,0 +1,192 @@
+"""
+Persistent IMU calibration store
+
+Calibrations are kept in one JSON file so that a sensor that was calibrated
+before can start sampling at once instead of averaging hundreds of samples
+at every start. Each record belongs to one sensor, identified by the I2C
+bus, address and WHO_AM_I value, to one kind of calibration (e.g.
+'offsets' for the MPU6050 offset registers or 'gyro_bias') and to one
+temperature band, since biases drift with temperature.
+
+The file lies next to this module, whatever the working directory, unless
+the MEGABOT_CALIBRATION_STORE environment variable names another path.
+
+A record is stale once it is older than the store's max_age, or when it
+was written with another format version; load() ignores stale records.
+"""
+
+import json
+import math
+import os
+import time
+from collections import namedtuple
+
+STORE_ENV = 'MEGABOT_CALIBRATION_STORE'
+STORE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'mpu_calibration.json')
+VERSION = 1
+# Width of the temperature bands (degrees Celsius)
+TEMPERATURE_BAND = 10.0
+# Records older than this are stale (s)
+MAX_AGE = 30 * 24 * 3600.0
+
+# Calibration kinds and their values
+OFFSETS = 'offsets'            # MPU6050 offset registers: accel, gyro
+GYRO_BIAS = 'gyro_bias'        # bias of each gyro axis (deg/s): bias
+ACCEL_LINEAR = 'accel_linear'  # reading = scale * raw + bias: scale, bias
+MAG_OFFSETS = 'mag_offsets'    # hard iron offsets: offsets
+
+SensorIdentity = namedtuple('SensorIdentity', ['bus', 'address', 'who_am_i'])
+Calibration = namedtuple('Calibration', ['identity', 'kind', 'band',
+                                         'temperature', 'created', 'values',
+                                         'version'])
+
+
+class CalibrationStore:
+    """ Calibration records of several sensors in a JSON file """
+
+    def __init__(self, path=None, band_width=TEMPERATURE_BAND,
+                 max_age=MAX_AGE):
+        """
+        :param path: The JSON file; it is created by the first save(). None
+                     for the STORE_ENV environment variable, else STORE_PATH
+        :param band_width: Width of the temperature bands (degrees Celsius)
+        :param max_age: Age after which records are stale (s), None for no
+                        limit
+        """
+        if path is None:
+            path = os.environ.get(STORE_ENV) or STORE_PATH
+        self.path = path
+        self.band_width = band_width
+        self.max_age = max_age
+
+    def band(self, temperature):
+        """ Get the temperature band a temperature falls in """
+        return int(math.floor(temperature / self.band_width))
+
+    def __read(self):
+        try:
+            with open(self.path, 'r') as store_file:
+                return json.load(store_file).get('records', [])
+        except (IOError, OSError, ValueError):
+            # No store yet, or an unreadable one: nothing is calibrated
+            return []
+
+    def __write(self, records):
+        # Write a new file and rename it, so a crash never leaves a store
+        # cut in half
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w') as store_file:
+            json.dump({'records': records}, store_file, indent=1,
+                      sort_keys=True)
+        os.replace(temporary, self.path)
+
+    @staticmethod
+    def __matches(record, identity, kind, band=None):
+        return record.get('bus') == identity.bus and \
+            record.get('address') == identity.address and \
+            record.get('who_am_i') == identity.who_am_i and \
+            record.get('kind') == kind and \
+            (band is None or record.get('band') == band)
+
+    @staticmethod
+    def __calibration(record):
+        return Calibration(SensorIdentity(record['bus'], record['address'],
+                                          record['who_am_i']),
+                           record['kind'], record['band'],
+                           record['temperature'], record['created'],
+                           record['values'], record.get('version'))
+
+    def save(self, identity, kind, temperature, values):
+        """
+        Store a calibration, replacing the one of the same sensor, kind and
+        temperature band
+
+        :param identity: The SensorIdentity of the calibrated sensor
+        :param kind: Name of the calibration, e.g. 'offsets'
+        :param temperature: Sensor temperature during the calibration
+                            (degrees Celsius)
+        :param values: A dict of JSON serialisable values (lists, not NumPy
+                       arrays)
+        :return: The stored Calibration
+        """
+        band = self.band(temperature)
+        record = {'version': VERSION,
+                  'bus': identity.bus,
+                  'address': identity.address,
+                  'who_am_i': identity.who_am_i,
+                  'kind': kind,
+                  'band': band,
+                  'temperature': temperature,
+                  'created': time.time(),
+                  'values': values}
+        records = [old for old in self.__read()
+                   if not self.__matches(old, identity, kind, band)]
+        records.append(record)
+        self.__write(records)
+        return self.__calibration(record)
+
+    def find(self, identity, kind, temperature=None):
+        """
+        Get a stored calibration, stale or not
+
+        :param temperature: Current sensor temperature (degrees Celsius),
+                            or None to accept any band
+        :return: The newest matching Calibration, or None
+        """
+        band = None if temperature is None else self.band(temperature)
+        found = None
+        for record in self.__read():
+            if self.__matches(record, identity, kind, band) and \
+                    (found is None or record['created'] > found['created']):
+                found = record
+        if found is None:
+            return None
+        return self.__calibration(found)
+
+    def stale_reason(self, calibration, now=None):
+        """
+        Tell why a calibration should not be used any more
+
+        :param calibration: A Calibration from find()
+        :param now: The current time.time(), None to read the clock
+        :return: A short explanation, or None when the record is fresh
+        """
+        if calibration.version != VERSION:
+            return 'written by another store version'
+        if self.max_age is None:
+            return None
+        if now is None:
+            now = time.time()
+        age = now - calibration.created
+        if age > self.max_age:
+            return 'calibrated %.1f days ago' % (age / 86400.0)
+        return None
+
+    def load(self, identity, kind, temperature):
+        """
+        Get the fresh calibration of a sensor at a temperature
+
+        :return: The Calibration, or None when there is none for this
+                 temperature band or it is stale
+        """
+        calibration = self.find(identity, kind, temperature)
+        if calibration is None or self.stale_reason(calibration) is not None:
+            return None
+        return calibration
+
+    def remove(self, identity, kind=None):
+        """
+        Forget the calibrations of a sensor
+
+        :param kind: Only forget this kind, None for every kind
+        :return: The number of records removed
+        """
+        records = self.__read()
+        kept = [record for record in records
+                if not self.__matches(record, identity,
+                                      record.get('kind') if kind is None
+                                      else kind)]
+        if len(kept) != len(records):
+            self.__write(kept)
+        return len(records) - len(kept)
@@ -0,0 +1,128 @@
+"""
+Replaceable GPIO backend for interrupt (edge) inputs
+
+Sensor interrupt lines such as the MPU6050 INT pin are opened through
+open_edge_pin() so the RPi.GPIO edge detection can be swapped for a
+FakePin driven by tests or the simulator.
+
+The backend is chosen with set_backend() or the MEGABOT_GPIO_BACKEND
+environment variable ('rpi' or 'fake'). RPi.GPIO is used by default.
+"""
+
+import os
+import threading
+import time
+
+BACKEND_ENV = 'MEGABOT_GPIO_BACKEND'
+
+RISING = 'rising'
+FALLING = 'falling'
+
+_backend = None
+
+
+class EdgePin:
+    """
+    Collects edge timestamps from a callback and hands them out to one
+    waiting consumer. Only the newest edge is kept; edges the consumer
+    did not wait for in time are counted in missed.
+    """
+
+    def __init__(self, pin):
+        self.pin = pin
+        self.edges = 0
+        self.missed = 0
+        self.__condition = threading.Condition()
+        self.__edge_time = None
+
+    def edge(self, timestamp=None):
+        """ Record an edge, called from the GPIO callback thread """
+        if timestamp is None:
+            timestamp = time.monotonic()
+        with self.__condition:
+            if self.__edge_time is not None:
+                self.missed += 1
+            self.__edge_time = timestamp
+            self.edges += 1
+            self.__condition.notify()
+
+    def wait_for_edge(self, timeout=None):
+        """
+        Block until an edge arrives
+
+        :param timeout: Longest time to wait (s), None waits forever
+        :return: The time.monotonic() timestamp of the newest edge, or None
+                 on timeout
+        """
+        with self.__condition:
+            if self.__edge_time is None:
+                self.__condition.wait(timeout)
+            edge_time = self.__edge_time
+            self.__edge_time = None
+            return edge_time
+
+    def close(self):
+        pass
+
+
+class RPiEdgePin(EdgePin):
+    """ Edge input on a Raspberry Pi GPIO (BCM numbering) """
+
+    def __init__(self, pin, edge=RISING):
+        EdgePin.__init__(self, pin)
+        import RPi.GPIO as GPIO
+        self.GPIO = GPIO
+        GPIO.setmode(GPIO.BCM)
+        GPIO.setup(pin, GPIO.IN)
+        GPIO.add_event_detect(pin, GPIO.RISING if edge == RISING
+                              else GPIO.FALLING,
+                              callback=lambda channel: self.edge())
+
+    def close(self):
+        self.GPIO.remove_event_detect(self.pin)
+
+
+class FakePin(EdgePin):
+    """ Edge input driven by calling trigger() """
+
+    def __init__(self, pin=None, edge=RISING):
+        EdgePin.__init__(self, pin)
+
+    def trigger(self, timestamp=None):
+        self.edge(timestamp)
+
+
+BACKENDS = {
+    'rpi': RPiEdgePin,
+    'fake': FakePin,
+}
+
+
+def set_backend(backend):
+    """
+    Select the backend used by open_edge_pin
+
+    :param backend: A name from BACKENDS, a callable taking (pin, edge)
+                    and returning an EdgePin, or None for the default
+    """
+    global _backend
+    if isinstance(backend, str):
+        backend = BACKENDS[backend]
+    _backend = backend
+
+
+def get_backend():
+    if _backend is not None:
+        return _backend
+    return BACKENDS[os.environ.get(BACKEND_ENV, 'rpi')]
+
+
+def open_edge_pin(pin, edge=RISING):
+    """
+    Open a GPIO input that reports edges
+
+    :param pin: The GPIO number (BCM)
+    :param edge: RISING or FALLING
+    :return: An EdgePin
+    """
+    return get_backend()(pin, edge)
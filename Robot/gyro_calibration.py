@@ -14,27 +14,22 @@ import numpy as np
 import matplotlib.pyplot as plt
 
 from mpu6050 import MPU6050
+from imu_calibration import calibrate_gyro
+import calibration_store
 
 
 def gyro_cal():
     print("-" * 50)
     print('Gyro Calibrating - Keep the IMU Steady')
-    [mpu.get_gyro_data() for ii in range(0, cal_size)]  # clear buffer before calibration
-    mpu_array = []
-    gyro_offsets = [0.0, 0.0, 0.0]
-    while True:
-        try:
-            wx, wy, wz = mpu.get_gyro_data()  # get gyro values
-        except:
-            continue
-
-        mpu_array.append([wx, wy, wz])  # gyro vector append
-        if np.shape(mpu_array)[0] == cal_size:
-            for qq in range(0, 3):
-                gyro_offsets[qq] = np.mean(np.array(mpu_array)[:, qq])  # average
-            break
-    print('Gyro Calibration Complete')
-    return gyro_offsets
+    [mpu.get_gyro_data() for ii in range(0, 5)]  # drop the first few readings
+    # running mean/variance, stops once the offsets are known (at most cal_size points)
+    calibrator = calibrate_gyro(mpu.get_gyro_data, max_samples=cal_size)
+    gyro_offsets = list(calibrator.bias)
+    print('Gyro Calibration Complete ({0} points, {1} rejected for motion)'.format(
+        calibrator.count, calibrator.rejected))
+    if not calibrator.converged:
+        print('Warning: gyro offsets did not converge, keep the IMU steady')
+    return gyro_offsets, calibrator.converged
 
 
 if __name__ == '__main__':
@@ -44,8 +39,13 @@ if __name__ == '__main__':
 
     # Gyroscope Offset Calculation
     gyro_labels = ['w_x', 'w_y', 'w_z']  # gyro labels for plots
-    gyro_offsets = gyro_cal()  # calculate gyro offsets
+    gyro_offsets, converged = gyro_cal()  # calculate gyro offsets
     print(gyro_offsets)
+    if converged:
+        mpu.save_calibration(calibration_store.CalibrationStore(),
+                             calibration_store.GYRO_BIAS, {'bias': gyro_offsets})  # reused by later runs
+    else:
+        print('Gyro offsets not saved')
 
     # record new data
     data = np.array([mpu.get_gyro_data() for ii in range(0, cal_size)])
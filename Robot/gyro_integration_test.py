@@ -17,53 +17,58 @@ import matplotlib.pyplot as plt
 from scipy.integrate import cumtrapz
 
 from mpu6050 import MPU6050
+from ring_buffer import RingBuffer
+from imu_calibration import calibrate_gyro
+import calibration_store
 
 
 def gyro_cal():
     print("-"*50)
     print('Gyro Calibrating - Keep the IMU Steady')
-    [mpu.get_gyro_data() for ii in range(0, cal_size)]  # clear buffer before calibration
-    mpu_array = []
-    gyro_offsets = [0.0, 0.0, 0.0]
-    while True:
-        try:
-            wx, wy, wz = mpu.get_gyro_data()
-        except:
-            continue
-
-        mpu_array.append([wx, wy, wz])
-
-        if np.shape(mpu_array)[0] == cal_size:
-            for qq in range(0, 3):
-                gyro_offsets[qq] = np.mean(np.array(mpu_array)[:, qq])  # average
-            break
+    [mpu.get_gyro_data() for ii in range(0, 5)]  # drop the first few readings
+    # running mean/variance, stops once the offsets are known (at most cal_size points)
+    calibrator = calibrate_gyro(mpu.get_gyro_data, max_samples=cal_size)
+    gyro_offsets = list(calibrator.bias)
     print('Gyro Calibration Complete')
-    return gyro_offsets
+    if not calibrator.converged:
+        print('Warning: gyro offsets did not converge, keep the IMU steady')
+    return gyro_offsets, calibrator.converged
 
 
 if __name__ == '__main__':
-    mpu = MPU6050(0x68)  # IMU (Accelerometer, Gyroscope)
+    store = calibration_store.CalibrationStore()  # offsets saved by earlier runs
+    mpu = MPU6050(0x68, calibration=store)  # IMU (Accelerometer, Gyroscope)
 
     # Gyroscope Offset Calculation
     gyro_labels = ['\omega_x', '\omega_y', '\omega_z']  # gyro labels for plots # noqa: W605
     cal_size = 500  # points to use for calibration
-    gyro_offsets = gyro_cal()  # calculate gyro offsets
+    if calibration_store.GYRO_BIAS in mpu.calibrations:
+        gyro_offsets = mpu.calibrations[calibration_store.GYRO_BIAS].values['bias']
+        print('Using the stored gyro offsets')
+    else:
+        gyro_offsets, converged = gyro_cal()  # calculate gyro offsets
+        if converged:
+            mpu.save_calibration(store, calibration_store.GYRO_BIAS, {'bias': gyro_offsets})
+        else:
+            print('Gyro offsets not saved')
 
     # record new data
     input("Press Enter and Rotate Gyro 360 degrees")
     print("Recording Data...")
     record_time = 5  # how long to record
-    data, t_vec = [], []
+    max_rate = 2000  # highest expected sample rate (sizes the buffer)
+    data_ring = RingBuffer(record_time * max_rate, ['w_x', 'w_y', 'w_z'])
     t0 = time.time()
     while time.time()-t0 < record_time:
-        data.append(mpu.get_gyro_data())
-        t_vec.append(time.time()-t0)
+        data_ring.append(mpu.get_gyro_data(), timestamp=time.time()-t0)
+    t_vec = data_ring.view()['t']
+    data = data_ring.array()[:, 1:]  # gyro columns
     samp_rate = np.shape(data)[0]/(t_vec[-1]-t_vec[0])  # sample rate
     print("Stopped Recording\nSample Rate: {0:2.0f} Hz".format(samp_rate))
 
     # offset and integration of gyro and plotting results
     rot_axis = 2  # axis being rotated (2 = z-axis)
-    data_offseted = np.array(data)[:, rot_axis]-gyro_offsets[rot_axis]
+    data_offseted = data[:, rot_axis]-gyro_offsets[rot_axis]
     integ1_array = cumtrapz(data_offseted, x=t_vec)  # integrate once in time
 
     # print out results
@@ -1,6 +1,9 @@
-import smbus2
 import time
 import logging
+import calibration_store
+import sensor_decode
+from i2c_bus import open_bus
+from gpio_backend import open_edge_pin, FALLING
 
 
 class HMC5883():
@@ -21,20 +24,100 @@ class HMC5883():
     IDENTIFICATION_B = 0x0B  # identification register B (R)
     IDENTIFICATION_C = 0x0C  # identification register C (R)
 
-    def __init__(self):
-        self.bus = smbus2.SMBus(1)  # get I2C bus
+    # continuous measurement output rates (Hz) and their CONFIG_A DO bits
+    RATES = {0.75: 0, 1.5: 1, 3.0: 2, 7.5: 3, 15.0: 4, 30.0: 5, 75.0: 6}
+    # samples averaged per output and their CONFIG_A MA bits
+    AVERAGING = {1: 0, 2: 1, 4: 2, 8: 3}
+    STATUS_RDY = 0x01
+
+    def __init__(self, rate=15.0, averaging=8, drdy_pin=None):
+        """
+        :param rate: Output data rate (Hz), a key of RATES
+        :param averaging: Samples averaged per output, a key of AVERAGING
+        :param drdy_pin: GPIO (BCM) wired to DRDY, or an EdgePin. Without
+                         it the STATUS RDY bit is polled
+        """
+        self.bus = open_bus(1)  # get I2C bus
         self.bus_address = 0x1E  # HMC5883 address
+        if drdy_pin is None or hasattr(drdy_pin, 'wait_for_edge'):
+            self.drdy = drdy_pin
+        else:
+            # DRDY is pulled low when new data is placed in the registers
+            self.drdy = open_edge_pin(drdy_pin, FALLING)
+        self.samples = 0
 
-        # 8 samples averaged
-        # normal measurement configuration
-        self.bus.write_byte_data(self.bus_address, self.CONFIG_A, 0x60)
+        # averaging, output rate, normal measurement configuration
+        self.configure(rate, averaging)
 
         # device gain (default)
         # self.bus.write_byte_data(self.bus_address, self.CONFIG_B, 0x20)
 
         # continuous measurement mode
         self.bus.write_byte_data(self.bus_address, self.MODE, 0x00)
-        time.sleep(0.5)
+        self.next_time = time.monotonic()
+        # the first measurement is ready one output period later
+        self.wait_ready(min(0.5, 2.0 * self.period))
+
+    def get_identity(self):
+        """
+        Get the key of this sensor in a calibration store
+
+        :return: A calibration_store.SensorIdentity, identification
+                 register A standing for WHO_AM_I
+        """
+        ident = self.bus.read_byte_data(self.bus_address,
+                                        self.IDENTIFICATION_A)
+        return calibration_store.SensorIdentity(1, self.bus_address, ident)
+
+    def configure(self, rate=15.0, averaging=8):
+        """
+        Set the output data rate and averaging
+
+        :param rate: Output data rate (Hz), up to 75
+        :param averaging: Samples averaged per output (1, 2, 4 or 8)
+        """
+        if rate not in self.RATES:
+            raise ValueError("rate must be one of " +
+                             str(sorted(self.RATES)))
+        if averaging not in self.AVERAGING:
+            raise ValueError("averaging must be one of " +
+                             str(sorted(self.AVERAGING)))
+        self.rate = rate
+        self.period = 1.0 / rate
+        self.bus.write_byte_data(self.bus_address, self.CONFIG_A,
+                                 self.AVERAGING[averaging] << 5 |
+                                 self.RATES[rate] << 2)
+
+    def data_ready(self):
+        """
+        Check the STATUS RDY bit
+
+        :return: True when the output registers hold an unread sample
+        """
+        return bool(self.bus.read_byte_data(self.bus_address, self.STATUS) &
+                    self.STATUS_RDY)
+
+    def wait_ready(self, timeout):
+        """
+        Wait for a new sample
+
+        :param timeout: Longest time to wait (s)
+        :return: The time.monotonic() timestamp of the sample, or None on
+                 timeout
+        """
+        if self.drdy is not None:
+            return self.drdy.wait_for_edge(timeout)
+        deadline = time.monotonic() + timeout
+        while True:
+            now = time.monotonic()
+            if now >= self.next_time and self.data_ready():
+                return now
+            if now > deadline:
+                return None
+            # sleep until the sample is due, then poll RDY a few times
+            # per output period
+            time.sleep(min(max(self.next_time - now, self.period / 8.0),
+                           max(deadline - now, 0.0)))
 
     def read(self):
         """
@@ -42,32 +125,64 @@ class HMC5883():
 
         :return: (a list of) The magnetometer (xyz) readings
         """
-        x_high, x_low, z_high, z_low, y_high, y_low = \
-            self.bus.read_i2c_block_data(self.bus_address, 0x03, 6)
+        raw_data = self.bus.read_i2c_block_data(self.bus_address,
+                                                self.OUTPUT_X_MSB, 6)
 
-        x_mag = 0.0
-        y_mag = 0.0
-        z_mag = 0.0
+        # the data registers are ordered X, Z, Y
+        x_mag, z_mag, y_mag = sensor_decode.vector_be(raw_data)
 
-        x_mag = (x_high << 8) | x_low
-        if x_mag > 32767:
-            x_mag -= 65536
-        z_mag = (z_high << 8) | z_low
-        if z_mag > 32767:
-            z_mag -= 65536
-        y_mag = (y_high << 8) | y_low
-        if y_mag > 32767:
-            y_mag -= 65536
-
-        logging.debug(f"_magnetic field "
-                      f"X: {x_mag:.4f} Y: {y_mag:.4f} Z: {z_mag:.4f}")
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug(f"_magnetic field "
+                          f"X: {x_mag:.4f} Y: {y_mag:.4f} Z: {z_mag:.4f}")
 
         return (x_mag, y_mag, z_mag)
 
+    def poll(self):
+        """
+        Read the magnetometer only if a new sample is available
+
+        The bus is not touched before the next sample is due at the
+        configured output rate.
+
+        :return: (timestamp, x, y, z) for a new sample, otherwise None
+        """
+        if self.drdy is not None:
+            timestamp = self.drdy.wait_for_edge(0)
+        else:
+            timestamp = time.monotonic()
+            if timestamp < self.next_time:
+                return None
+            if not self.data_ready():
+                # poll RDY again a fraction of an output period later
+                self.next_time = timestamp + self.period / 8.0
+                return None
+        if timestamp is None:
+            return None
+        return self.__sample(timestamp)
+
+    def stream(self, timeout=1.0):
+        """
+        Generate new samples as they become available
+
+        :param timeout: Longest time to wait for a sample (s)
+        :return: A generator of (timestamp, x, y, z)
+        """
+        while True:
+            timestamp = self.wait_ready(timeout)
+            if timestamp is None:
+                raise IOError("No data ready from the HMC5883")
+            yield self.__sample(timestamp)
+
+    def __sample(self, a_timestamp):
+        x_mag, y_mag, z_mag = self.read()
+        # most of an output period passes before the next sample is ready
+        self.next_time = a_timestamp + 0.9 * self.period
+        self.samples += 1
+        return (a_timestamp, x_mag, y_mag, z_mag)
+
 
 if __name__ == '__main__':
-    logging.basicConfig(level=logging.DEBUG)
-    hmc = HMC5883()
-    while (True):
-        hmc.read()
-        time.sleep(1)
+    logging.basicConfig(level=logging.INFO)
+    hmc = HMC5883(rate=15.0)
+    for sample in hmc.stream():
+        logging.info("t: %.3f X: %d Y: %d Z: %d", *sample)
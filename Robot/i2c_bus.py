@@ -0,0 +1,268 @@
+"""
+Pluggable, shared I2C bus backend
+
+Every sensor driver opens its bus through open_bus() instead of calling
+smbus/smbus2 directly, so the hardware can be swapped for the simulated
+bus in sim_i2c when profiling or testing off the robot.
+
+The backend is chosen with set_backend() or the MEGABOT_I2C_BACKEND
+environment variable ('smbus2', 'smbus' or 'sim'). By default smbus2 is
+used, falling back to smbus when it is not installed.
+
+Each bus number is opened once per process. Drivers get a BusHandle onto
+the shared ManagedBus, which serializes transactions from all threads,
+lets higher priority clients (the IMU) jump the queue ahead of slower
+sensors and counts transactions, bytes and errors.
+"""
+
+import heapq
+import itertools
+import os
+import threading
+from contextlib import contextmanager
+
+from register_cache import RegisterShadow
+
+BACKEND_ENV = 'MEGABOT_I2C_BACKEND'
+
+# Lower values are served first when several threads wait for the bus
+PRIORITY_IMU = 0
+PRIORITY_NORMAL = 10
+PRIORITY_LOW = 20
+
+_backend = None
+_buses = {}
+_buses_lock = threading.Lock()
+
+
+def _smbus2_backend(bus_number):
+    import smbus2
+    return smbus2.SMBus(bus_number)
+
+
+def _smbus_backend(bus_number):
+    import smbus
+    return smbus.SMBus(bus_number)
+
+
+def _default_backend(bus_number):
+    try:
+        import smbus2  # noqa: F401
+    except ImportError:
+        return _smbus_backend(bus_number)
+    return _smbus2_backend(bus_number)
+
+
+def _sim_backend(bus_number):
+    import sim_i2c
+    return sim_i2c.open_sim_bus(bus_number)
+
+
+BACKENDS = {
+    'smbus2': _smbus2_backend,
+    'smbus': _smbus_backend,
+    'sim': _sim_backend,
+}
+
+
+def set_backend(backend):
+    """
+    Select the backend used by open_bus
+
+    :param backend: A name from BACKENDS, a callable taking the bus number
+                    and returning an SMBus-like handle, or None to go back
+                    to the default
+    """
+    global _backend
+    if isinstance(backend, str):
+        backend = BACKENDS[backend]
+    with _buses_lock:
+        _backend = backend
+        # Buses opened from now on use the new backend, and the register
+        # values shadowed for the old devices no longer apply
+        _buses.clear()
+        RegisterShadow.clear()
+
+
+def get_backend():
+    """
+    Get the backend used by open_bus
+
+    :return: A callable taking the bus number
+    """
+    if _backend is not None:
+        return _backend
+    name = os.environ.get(BACKEND_ENV)
+    if name:
+        return BACKENDS[name]
+    return _default_backend
+
+
+class PriorityLock:
+    """ Reentrant lock that hands over to the highest priority waiter """
+
+    def __init__(self):
+        self.__state_lock = threading.Lock()
+        self.__owner = None
+        self.__depth = 0
+        self.__waiters = []
+        self.__sequence = itertools.count()
+
+    def acquire(self, priority=PRIORITY_NORMAL):
+        me = threading.get_ident()
+        with self.__state_lock:
+            if self.__owner == me:
+                self.__depth += 1
+                return
+            if self.__owner is None:
+                self.__owner = me
+                self.__depth = 1
+                return
+            # Queue up; release() makes us the owner before waking us
+            event = threading.Event()
+            heapq.heappush(self.__waiters,
+                           (priority, next(self.__sequence), me, event))
+        event.wait()
+
+    def release(self):
+        with self.__state_lock:
+            self.__depth -= 1
+            if self.__depth:
+                return
+            if self.__waiters:
+                priority, sequence, owner, event = \
+                    heapq.heappop(self.__waiters)
+                self.__owner = owner
+                self.__depth = 1
+                event.set()
+            else:
+                self.__owner = None
+
+    def waiting(self):
+        return len(self.__waiters)
+
+
+class ManagedBus:
+    """ One process wide bus handle with locking and counters """
+
+    def __init__(self, bus_number, handle):
+        self.bus_number = bus_number
+        self.handle = handle
+        self.lock = PriorityLock()
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.transactions = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.errors = 0
+
+    def stats(self):
+        """
+        Get the bus counters
+
+        :return: A dict with transactions, bytes_read, bytes_written,
+                 errors and waiting (threads queued for the bus)
+        """
+        return {'transactions': self.transactions,
+                'bytes_read': self.bytes_read,
+                'bytes_written': self.bytes_written,
+                'errors': self.errors,
+                'waiting': self.lock.waiting()}
+
+    def call(self, priority, a_bytes_read, a_bytes_written, method, *args):
+        self.lock.acquire(priority)
+        try:
+            result = method(*args)
+            self.transactions += 1
+            self.bytes_read += a_bytes_read
+            self.bytes_written += a_bytes_written
+            return result
+        except (IOError, OSError):
+            self.errors += 1
+            raise
+        finally:
+            self.lock.release()
+
+
+class BusHandle:
+    """ A driver's SMBus-like view of a ManagedBus """
+
+    def __init__(self, managed_bus, priority=PRIORITY_NORMAL):
+        self.managed_bus = managed_bus
+        self.priority = priority
+
+    @contextmanager
+    def locked(self):
+        """
+        Hold the bus for a sequence of transactions that must not be
+        interleaved with other clients (e.g. bank select then memory write)
+        """
+        self.managed_bus.lock.acquire(self.priority)
+        try:
+            yield self
+        finally:
+            self.managed_bus.lock.release()
+
+    def read_byte_data(self, i2c_addr, register):
+        return self.managed_bus.call(
+            self.priority, 1, 1, self.managed_bus.handle.read_byte_data,
+            i2c_addr, register)
+
+    def write_byte_data(self, i2c_addr, register, value):
+        return self.managed_bus.call(
+            self.priority, 0, 2, self.managed_bus.handle.write_byte_data,
+            i2c_addr, register, value)
+
+    def read_i2c_block_data(self, i2c_addr, register, length=32):
+        return self.managed_bus.call(
+            self.priority, length, 1,
+            self.managed_bus.handle.read_i2c_block_data,
+            i2c_addr, register, length)
+
+    def write_i2c_block_data(self, i2c_addr, register, data):
+        return self.managed_bus.call(
+            self.priority, 0, len(data) + 1,
+            self.managed_bus.handle.write_i2c_block_data,
+            i2c_addr, register, data)
+
+    def stats(self):
+        return self.managed_bus.stats()
+
+    def close(self):
+        # The underlying handle is shared by every driver on this bus
+        pass
+
+
+def get_managed_bus(bus_number=1):
+    """
+    Get the process wide ManagedBus for a bus number, opening it with the
+    selected backend on first use
+    """
+    with _buses_lock:
+        managed_bus = _buses.get(bus_number)
+        if managed_bus is None:
+            managed_bus = ManagedBus(bus_number, get_backend()(bus_number))
+            _buses[bus_number] = managed_bus
+        return managed_bus
+
+
+def open_bus(bus_number=1, priority=PRIORITY_NORMAL):
+    """
+    Open an I2C bus shared with every other driver in the process
+
+    :param bus_number: The I2C bus number (1 on current Raspberry Pis)
+    :param priority: Queue priority of this client, PRIORITY_IMU for
+                     sensors that must not wait behind slower ones
+    :return: A BusHandle with the smbus read/write methods
+    """
+    return BusHandle(get_managed_bus(bus_number), priority)
+
+
+def bus_stats(bus_number=1):
+    """
+    Get the counters of a bus opened with open_bus
+
+    :return: See ManagedBus.stats
+    """
+    return get_managed_bus(bus_number).stats()
@@ -0,0 +1,506 @@
+"""
+IMU calibration
+
+GyroCalibrator estimates the gyro bias from a stream of samples taken at
+rest. It keeps Welford running means and variances, so each sample costs
+O(1) whatever the number of samples, and it stops as soon as the
+confidence interval of the bias is narrow enough.
+
+Samples are grouped in short windows. A window whose variance on any axis
+is above the motion threshold was taken while the IMU moved and is left
+out of the estimate.
+
+GyroBiasTracker keeps estimating the gyro bias while the IMU is in use:
+the mean of every window in which the IMU is still is blended into the
+bias, so no calibration stop is needed at start up or later on.
+
+AccelCalibrator fits the accelerometer from samples taken in static
+positions, accumulating only the sums of its normal equations as samples
+stream in. Each fit is one small linear solve:
+
+ - solve_linear(): scale and bias of every axis
+ - solve_six_position(): a full 3x3 correction (scale and cross-axis
+   misalignment) and offset, from the SIX_POSITIONS references
+ - solve_ellipsoid(): the same without references, from nine or more
+   arbitrary, well spread positions
+"""
+
+import math
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Two sided normal quantile of the bias confidence interval (99 %)
+CONFIDENCE_Z = 2.576
+
+# Single samples are fitted in blocks of this many
+ACCEL_BLOCK = 256
+
+# Six static positions: (axis, direction, expected reading in g). The axis
+# pointing up reads +1 g, the axes perpendicular to gravity read 0
+SIX_POSITIONS = (('z', 'upward', (0.0, 0.0, 1.0)),
+                 ('z', 'downward', (0.0, 0.0, -1.0)),
+                 ('y', 'upward', (0.0, 1.0, 0.0)),
+                 ('y', 'downward', (0.0, -1.0, 0.0)),
+                 ('x', 'upward', (1.0, 0.0, 0.0)),
+                 ('x', 'downward', (-1.0, 0.0, 0.0)))
+
+
+class GyroCalibrator:
+    """ Streaming gyro bias estimate with early stop """
+
+    def __init__(self, tolerance=0.02, max_std=0.5, window=25,
+                 min_samples=100, max_samples=2000, axes=3,
+                 z=CONFIDENCE_Z):
+        """
+        The defaults are in deg/s; scale them for raw LSB samples
+        (e.g. times 131 at +-250 deg/s).
+
+        :param tolerance: Stop once the bias confidence interval half width
+                          is below this on every axis
+        :param max_std: Windows with a larger standard deviation on any
+                        axis count as motion and are rejected
+        :param window: Samples per motion check
+        :param min_samples: Accepted samples needed before stopping early
+        :param max_samples: Give up after this many samples (accepted or
+                            rejected)
+        :param axes: Values per sample
+        :param z: Normal quantile of the confidence interval
+        """
+        if window < 2:
+            raise ValueError("window must be at least 2 samples")
+        self.tolerance = tolerance
+        self.max_variance = max_std * max_std
+        self.window = window
+        self.min_samples = min_samples
+        self.max_samples = max_samples
+        self.axes = axes
+        self.z = z
+        self.reset()
+
+    def reset(self):
+        """ Forget every sample """
+        self.count = 0
+        self.rejected = 0
+        self.done = False
+        self.converged = False
+        self.__mean = [0.0] * self.axes
+        self.__m2 = [0.0] * self.axes
+        self.__start_window()
+
+    def __start_window(self):
+        self.__window_count = 0
+        self.__window_mean = [0.0] * self.axes
+        self.__window_m2 = [0.0] * self.axes
+
+    def add(self, *sample):
+        """
+        Add one sample taken at rest
+
+        :param sample: One value per axis, e.g. add(wx, wy, wz)
+        :return: True once the calibration is done
+        """
+        n = self.__window_count + 1
+        self.__window_count = n
+        mean = self.__window_mean
+        m2 = self.__window_m2
+        for axis in range(0, self.axes):
+            value = sample[axis]
+            delta = value - mean[axis]
+            mean[axis] += delta / n
+            m2[axis] += delta * (value - mean[axis])
+        if n == self.window:
+            self.__end_window()
+        return self.done
+
+    def __end_window(self):
+        n = self.__window_count
+        window_mean = self.__window_mean
+        window_m2 = self.__window_m2
+        if max(window_m2) > self.max_variance * (n - 1):
+            # The IMU moved
+            self.rejected += n
+        else:
+            # Merge the window into the totals (Chan et al.)
+            count = self.count
+            total = count + n
+            mean = self.__mean
+            m2 = self.__m2
+            for axis in range(0, self.axes):
+                delta = window_mean[axis] - mean[axis]
+                mean[axis] += delta * n / total
+                m2[axis] += window_m2[axis] + delta * delta * count * n / total
+            self.count = total
+            if total >= self.min_samples and \
+                    max(self.half_width()) <= self.tolerance:
+                self.converged = True
+                self.done = True
+        if self.count + self.rejected >= self.max_samples:
+            self.done = True
+        self.__start_window()
+
+    @property
+    def bias(self):
+        """ The mean of the accepted samples, per axis """
+        return tuple(self.__mean)
+
+    @property
+    def variance(self):
+        """ The sample variance of the accepted samples, per axis """
+        if self.count < 2:
+            return (0.0,) * self.axes
+        return tuple(m2 / (self.count - 1) for m2 in self.__m2)
+
+    @property
+    def std(self):
+        return tuple(math.sqrt(variance) for variance in self.variance)
+
+    def half_width(self):
+        """
+        Get the confidence interval half width of the bias
+
+        :return: One value per axis, infinite before two samples
+        """
+        if self.count < 2:
+            return (float('inf'),) * self.axes
+        return tuple(self.z * math.sqrt(m2 / (self.count - 1) / self.count)
+                     for m2 in self.__m2)
+
+
+def calibrate_gyro(read, calibrator=None, max_failures=100, **kwargs):
+    """
+    Feed samples to a GyroCalibrator until it is done
+
+    :param read: Callable returning one sample tuple, e.g.
+                 MPU6050.get_gyro_data; samples that raise IOError or
+                 OSError are skipped
+    :param calibrator: A GyroCalibrator, or None to create one from kwargs
+    :param max_failures: Consecutive failed reads after which the sensor
+                         is taken as disconnected
+    :return: The calibrator (see bias, converged, count and rejected)
+    :raise IOError: The last read error, after max_failures failed reads
+                    in a row
+    """
+    if calibrator is None:
+        calibrator = GyroCalibrator(**kwargs)
+    failures = 0
+    while not calibrator.done:
+        try:
+            sample = read()
+        except (IOError, OSError):
+            failures += 1
+            if failures >= max_failures:
+                raise
+            continue
+        failures = 0
+        calibrator.add(*sample)
+    return calibrator
+
+
+class GyroBiasTracker:
+    """ Online gyro bias estimate, updated whenever the IMU is still """
+
+    def __init__(self, bias=None, window=50, max_std=0.5, max_change=2.0,
+                 max_accel_std=0.01, time_constant=30, relearn=10,
+                 axes=3):
+        """
+        Samples are checked in windows. A window is still when the gyro
+        and accelerometer standard deviations are small and its gyro mean
+        is within max_change of the current bias, which rejects slow
+        turns at a steady rate. The mean of each still window is blended
+        into the bias. The defaults are in deg/s and g; scale them for raw
+        LSB samples.
+
+        :param bias: Starting bias, e.g. from a calibration store; None
+                     takes the mean of the first still window, whatever its
+                     distance from zero
+        :param window: Samples per stillness check
+        :param max_std: Largest gyro standard deviation of a still window
+        :param max_change: Largest step between the bias and the mean of a
+                           still window
+        :param max_accel_std: Largest accelerometer standard deviation of a
+                              still window
+        :param time_constant: Number of still windows the bias averages
+                              over once that many have been seen
+        :param relearn: After this many quiet windows in a row that are all
+                        further than max_change from the bias, the bias is
+                        taken to be wrong and restarts from their mean
+        :param axes: Gyro values per sample
+        """
+        if window < 2:
+            raise ValueError("window must be at least 2 samples")
+        self.window = window
+        self.max_variance = max_std * max_std
+        self.max_change = max_change
+        self.max_accel_variance = max_accel_std * max_accel_std
+        self.time_constant = time_constant
+        self.relearn = relearn
+        self.axes = axes
+        self.known = bias is not None
+        self.__bias = list(bias) if bias is not None else [0.0] * axes
+        self.windows = 0
+        self.still = False
+        # A starting bias weighs as much as one still window
+        self.__weight = 1 if self.known else 0
+        self.__far = 0
+        self.__start_window()
+
+    def __start_window(self):
+        self.__count = 0
+        self.__forced = None
+        self.__mean = [0.0] * self.axes
+        self.__m2 = [0.0] * self.axes
+        self.__accel_mean = [0.0, 0.0, 0.0]
+        self.__accel_m2 = [0.0, 0.0, 0.0]
+
+    @property
+    def bias(self):
+        """ The current bias, per axis """
+        return tuple(self.__bias)
+
+    def update(self, gyro, accel=None, still=None):
+        """
+        Add one sample and remove the bias from it
+
+        :param gyro: One value per axis
+        :param accel: Optional (x, y, z) accelerometer sample of the same
+                      instant, for the stillness check
+        :param still: True when the IMU is known to be still (e.g. the
+                      MPU6050 zero motion status, or stopped motors), False
+                      when it is known to move, None to detect it
+        :return: The gyro sample minus the bias, as a tuple
+        """
+        n = self.__count + 1
+        self.__count = n
+        mean = self.__mean
+        m2 = self.__m2
+        for axis in range(0, self.axes):
+            value = gyro[axis]
+            delta = value - mean[axis]
+            mean[axis] += delta / n
+            m2[axis] += delta * (value - mean[axis])
+        if accel is not None:
+            mean = self.__accel_mean
+            m2 = self.__accel_m2
+            for axis in range(0, 3):
+                value = accel[axis]
+                delta = value - mean[axis]
+                mean[axis] += delta / n
+                m2[axis] += delta * (value - mean[axis])
+        if still is not None and self.__forced is not False:
+            # One moving sample spoils the whole window
+            self.__forced = still
+        if n == self.window:
+            self.__end_window()
+        bias = self.__bias
+        return tuple(gyro[axis] - bias[axis] for axis in range(0, self.axes))
+
+    def __end_window(self):
+        n = self.__count
+        mean = self.__mean
+        if self.__forced is not None:
+            still = self.__forced
+        else:
+            limit = self.max_variance * (n - 1)
+            accel_limit = self.max_accel_variance * (n - 1)
+            still = max(self.__m2) <= limit and \
+                max(self.__accel_m2) <= accel_limit
+            if not still:
+                self.__far = 0
+            elif self.known:
+                if max(abs(mean[axis] - self.__bias[axis])
+                       for axis in range(0, self.axes)) <= self.max_change:
+                    self.__far = 0
+                else:
+                    # A steady turn, unless it goes on for too long
+                    self.__far += 1
+                    still = self.__far >= self.relearn
+                    if still:
+                        self.__far = 0
+                        self.__weight = 0
+        self.still = still
+        if still:
+            self.windows += 1
+            self.__weight += 1
+            self.known = True
+            # A running mean at first, then an exponential average
+            gain = 1.0 / min(self.__weight, self.time_constant)
+            for axis in range(0, self.axes):
+                self.__bias[axis] += gain * (mean[axis] - self.__bias[axis])
+        self.__start_window()
+
+
+class AccelCalibrator:
+    """ Accelerometer scale, bias and misalignment from static positions """
+
+    def __init__(self):
+        if np is None:
+            raise ImportError("numpy is needed for AccelCalibrator")
+        self.reset()
+
+    def reset(self):
+        """ Forget every sample """
+        self.count = 0
+        # Per axis sums of the linear model reading = scale * raw + bias
+        self.__n = np.zeros(3)
+        self.__sx = np.zeros(3)
+        self.__sxx = np.zeros(3)
+        self.__sy = np.zeros(3)
+        self.__sxy = np.zeros(3)
+        # Normal equations of the affine fit, reading = [raw, 1] . W, and
+        # of the quadric fit, both on samples divided by norm
+        self.__xtx = np.zeros((4, 4))
+        self.__xty = np.zeros((4, 3))
+        self.__dtd = np.zeros((9, 9))
+        self.__dt1 = np.zeros(9)
+        self.__norm = None
+        self.__pending = np.zeros((ACCEL_BLOCK, 3))
+        self.__pending_count = 0
+        self.__pending_reference = None
+
+    def add(self, sample, reference=None):
+        """
+        Add one static sample
+
+        :param sample: Raw (x, y, z) in any unit
+        :param reference: The expected (x, y, z) reading in g, e.g. from
+                          SIX_POSITIONS, with NaN for unknown axes; None
+                          when the position is unknown (ellipsoid fit only)
+        """
+        if self.__pending_count and \
+                reference is not self.__pending_reference:
+            self.__flush()
+        self.__pending[self.__pending_count] = sample
+        self.__pending_reference = reference
+        self.__pending_count += 1
+        self.count += 1
+        if self.__pending_count == ACCEL_BLOCK:
+            self.__flush()
+
+    def __flush(self):
+        count = self.__pending_count
+        self.__pending_count = 0
+        if count:
+            self.__add_block(self.__pending[:count],
+                             self.__pending_reference)
+
+    def add_block(self, samples, reference=None):
+        """
+        Add samples taken in one static position
+
+        :param samples: An (N, 3) array of raw readings
+        :param reference: See add
+        """
+        samples = np.asarray(samples, dtype=np.float64).reshape(-1, 3)
+        self.__flush()
+        self.__add_block(samples, reference)
+        self.count += len(samples)
+
+    def __add_block(self, samples, reference):
+        if len(samples) == 0:
+            return
+        if reference is not None:
+            reference = np.asarray(reference, dtype=np.float64)
+            known = ~np.isnan(reference)
+            y = np.where(known, reference, 0.0)
+            sx = samples.sum(axis=0)
+            n = len(samples)
+            self.__n += known * n
+            self.__sx += known * sx
+            self.__sxx += known * np.einsum('ij,ij->j', samples, samples)
+            self.__sy += y * n
+            self.__sxy += y * sx
+        if self.__norm is None:
+            # Gravity in the sample unit keeps the solves well conditioned
+            self.__norm = np.linalg.norm(samples.mean(axis=0)) or 1.0
+        normalized = samples / self.__norm
+        if reference is not None and known.all():
+            design = np.column_stack((normalized, np.ones(len(samples))))
+            self.__xtx += design.T.dot(design)
+            self.__xty += np.outer(design.sum(axis=0), reference)
+        x, y, z = normalized.T
+        design = np.column_stack((x * x, y * y, z * z, 2 * x * y, 2 * x * z,
+                                  2 * y * z, 2 * x, 2 * y, 2 * z))
+        self.__dtd += design.T.dot(design)
+        self.__dt1 += design.sum(axis=0)
+
+    def solve_linear(self):
+        """
+        Least squares fit of reading = scale * raw + bias per axis
+
+        Needs at least two different references per axis.
+
+        :return: (scale, bias) arrays of 3
+        """
+        self.__flush()
+        n = self.__n
+        denominator = n * self.__sxx - self.__sx * self.__sx
+        if np.any(denominator <= 0.0):
+            raise ValueError("Every axis needs samples at two references")
+        scale = (n * self.__sxy - self.__sx * self.__sy) / denominator
+        bias = (self.__sy - scale * self.__sx) / n
+        return scale, bias
+
+    def solve_six_position(self):
+        """
+        Least squares fit of reading = matrix . (raw - offset) on the
+        samples added with a complete reference
+
+        Needs at least four positions that are not coplanar, e.g. the
+        SIX_POSITIONS.
+
+        :return: (matrix, offset)
+        """
+        self.__flush()
+        try:
+            weights = np.linalg.solve(self.__xtx, self.__xty)
+        except np.linalg.LinAlgError:
+            raise ValueError("The six position fit needs samples in at "
+                             "least four independent positions")
+        matrix = weights[:3].T
+        offset = -np.linalg.solve(matrix, weights[3])
+        return matrix / self.__norm, offset * self.__norm
+
+    def solve_ellipsoid(self):
+        """
+        Fit the ellipsoid the static samples lie on and map it to the 1 g
+        sphere
+
+        References are not used, but the samples must come from nine or
+        more well spread positions (six positions on the axes leave the
+        cross-axis terms undetermined). The correction is symmetric: it
+        removes scale and non orthogonality, not a rotation of the whole
+        sensor.
+
+        :return: (matrix, offset) with calibrated = matrix . (raw - offset)
+        """
+        self.__flush()
+        if self.count < 9:
+            raise ValueError("The ellipsoid fit needs at least 9 samples")
+        p = np.linalg.solve(self.__dtd, self.__dt1)
+        a, b, c, d, e, f, g, h, i = p
+        quadric = np.array([[a, d, e], [d, b, f], [e, f, c]])
+        linear = np.array([g, h, i])
+        center = -np.linalg.solve(quadric, linear)
+        # (x - center)' quadric (x - center) = 1 + center' quadric center
+        quadric /= 1.0 + center.dot(quadric).dot(center)
+        values, vectors = np.linalg.eigh(quadric)
+        if np.any(values <= 0.0):
+            raise ValueError("The samples do not lie on an ellipsoid")
+        matrix = (vectors * np.sqrt(values)).dot(vectors.T)
+        return matrix / self.__norm, center * self.__norm
+
+
+def apply_linear(samples, scale, bias):
+    """ Calibrate (N, 3) raw samples with solve_linear's result """
+    return np.asarray(samples) * scale + bias
+
+
+def apply_ellipsoid(samples, matrix, offset):
+    """
+    Calibrate (N, 3) raw samples with the result of solve_six_position or
+    solve_ellipsoid
+    """
+    return (np.asarray(samples) - offset).dot(matrix.T)
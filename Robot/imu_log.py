@@ -0,0 +1,223 @@
+"""
+Binary columnar sensor log
+
+A log file is a short self-describing header followed by fixed width
+little endian records:
+
+    MAGIC (8 bytes) | header length (uint32 LE) | JSON header | padding |
+    records ...
+
+The JSON header holds the record layout (numpy.dtype descr), the record
+size, the creation time and free form metadata, and is padded so that
+records start on a 64 byte boundary. A crash can only cut the last record
+short; the reader ignores the partial tail.
+
+LogWriter fills preallocated blocks of records in the caller's thread,
+without any formatting, and hands full blocks to a background thread
+through a bounded queue. When the disk cannot keep up, blocks are dropped
+and counted instead of blocking the caller. read_log() memory maps a file
+as a NumPy structured array.
+"""
+
+import json
+import logging
+import os
+import queue
+import struct
+import threading
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+MAGIC = b'IMULOG1\n'
+HEADER_LENGTH = struct.Struct('<I')
+ALIGNMENT = 64
+BLOCK_RECORDS = 256
+QUEUE_BLOCKS = 64
+
+logger = logging.getLogger(__name__)
+
+
+def _require_numpy():
+    if np is None:
+        raise ImportError('numpy is needed for binary logs')
+
+
+def log_dtype(fields):
+    """
+    Build the little endian record dtype of a log
+
+    :param fields: A list of (name, dtype) pairs, or a numpy.dtype
+    :return: A structured numpy.dtype with every field little endian
+    """
+    _require_numpy()
+    return np.dtype(fields).newbyteorder('<')
+
+
+def _header(dtype, meta):
+    header = json.dumps({'fields': dtype.descr,
+                         'record_size': dtype.itemsize,
+                         'created': time.time(),
+                         'meta': meta or {}}).encode('utf-8')
+    used = len(MAGIC) + HEADER_LENGTH.size + len(header)
+    header += b' ' * (-used % ALIGNMENT)
+    return MAGIC + HEADER_LENGTH.pack(len(header)) + header
+
+
+def read_header(path):
+    """
+    Read the header of a log file
+
+    :return: (dtype, header dict, offset of the first record)
+    """
+    _require_numpy()
+    with open(path, 'rb') as log_file:
+        if log_file.read(len(MAGIC)) != MAGIC:
+            raise ValueError('Not a binary sensor log: ' + str(path))
+        length, = HEADER_LENGTH.unpack(log_file.read(HEADER_LENGTH.size))
+        header = json.loads(log_file.read(length).decode('utf-8'))
+    dtype = np.dtype([tuple(field) for field in header['fields']])
+    if dtype.itemsize != header['record_size']:
+        raise ValueError('Inconsistent record size in ' + str(path))
+    return dtype, header, len(MAGIC) + HEADER_LENGTH.size + length
+
+
+def read_log(path):
+    """
+    Memory map the records of a log file
+
+    :return: A read only structured array backed by the file (empty when
+             the file has no complete record)
+    """
+    dtype, header, offset = read_header(path)
+    count = (os.path.getsize(path) - offset) // dtype.itemsize
+    if count == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset,
+                     shape=(count,))
+
+
+class LogWriter:
+    """ Appends records to a log file from a background thread """
+
+    def __init__(self, path, fields, meta=None, block_records=BLOCK_RECORDS,
+                 queue_blocks=QUEUE_BLOCKS):
+        """
+        :param path: The file to create (an existing file is replaced)
+        :param fields: A list of (name, dtype) pairs or a numpy.dtype
+        :param meta: Optional JSON serialisable metadata for the header
+        :param block_records: Records per block handed to the writer thread
+        :param queue_blocks: Full blocks that may wait for the disk before
+                             new ones are dropped
+        """
+        self.dtype = log_dtype(fields)
+        self.path = path
+        self.records = 0
+        # Each counter is only written by one thread: the caller, which
+        # drops blocks when the queue is full, and the writer thread
+        self.__queue_dropped = 0
+        self.__write_dropped = 0
+        self.__block_records = block_records
+        self.__queue = queue.Queue(queue_blocks)
+        # Blocks cycle between the caller, the queue, the writer thread and
+        # this free list
+        self.__free = queue.LifoQueue()
+        for _ in range(0, queue_blocks + 2):
+            self.__free.put(np.zeros(block_records, dtype=self.dtype))
+        self.__block = self.__free.get()
+        self.__fill = 0
+        self.__file = open(path, 'wb')
+        self.__file.write(_header(self.dtype, meta))
+        self.__thread = threading.Thread(target=self.__write_blocks,
+                                         name='LogWriter', daemon=True)
+        self.__thread.start()
+
+    @property
+    def dropped(self):
+        """ Records lost because the disk was behind or a write failed """
+        return self.__queue_dropped + self.__write_dropped
+
+    def append(self, values):
+        """
+        Add one record
+
+        :param values: A tuple with one value per field
+        """
+        self.__block[self.__fill] = values
+        self.__fill += 1
+        if self.__fill == self.__block_records:
+            self.__hand_over()
+
+    def extend(self, records):
+        """
+        Add the records of a structured array with the same fields
+        """
+        for name in records.dtype.names:
+            if name not in self.dtype.names:
+                raise ValueError('Unknown log field ' + name)
+        start = 0
+        while start < len(records):
+            count = min(len(records) - start,
+                        self.__block_records - self.__fill)
+            part = self.__block[self.__fill:self.__fill + count]
+            for name in records.dtype.names:
+                part[name] = records[name][start:start + count]
+            self.__fill += count
+            start += count
+            if self.__fill == self.__block_records:
+                self.__hand_over()
+
+    def __hand_over(self):
+        try:
+            self.__queue.put_nowait((self.__block, self.__fill))
+        except queue.Full:
+            # The disk is behind: lose this block, never the caller's time
+            self.__queue_dropped += self.__fill
+            self.__fill = 0
+            return
+        self.__fill = 0
+        self.__block = self.__free.get()
+
+    def __write_blocks(self):
+        while True:
+            item = self.__queue.get()
+            if item is None:
+                self.__file.flush()
+                self.__queue.task_done()
+                return
+            block, count = item
+            try:
+                self.__file.write(block[:count].tobytes())
+                self.records += count
+            except (IOError, OSError) as error:
+                self.__write_dropped += count
+                logger.error('Writing %s failed: %s', self.path, error)
+            self.__free.put(block)
+            self.__queue.task_done()
+
+    def flush(self):
+        """ Write every record appended so far and wait for the disk """
+        if self.__fill:
+            self.__queue.put((self.__block, self.__fill))
+            self.__fill = 0
+            self.__block = self.__free.get()
+        self.__queue.join()
+        self.__file.flush()
+
+    def close(self):
+        """ Flush, stop the writer thread and close the file """
+        if self.__file.closed:
+            return
+        self.flush()
+        self.__queue.put(None)
+        self.__thread.join()
+        self.__file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,223 @@
+"""
+Real-time plots decoupled from acquisition
+
+The acquisition thread only appends samples to RingBuffer instances.
+LivePlot redraws them from the GUI thread at a capped frame rate, so the
+sample rate no longer depends on how fast matplotlib draws:
+
+ - a series is recomputed only when its ring got new records since the
+   previous frame, and only the axes holding such a series are blitted
+ - time series are cut to the minimum and maximum of a fixed number of
+   buckets, so a frame costs the same whatever the window length and
+   peaks are never lost
+
+Rings are read without a copy; a frame may show a few of the oldest
+records already replaced by the producer, which is harmless for a plot.
+matplotlib itself is only used through the figure and axes handed in.
+"""
+
+import time
+
+import numpy as np
+
+FRAME_RATE = 20.0
+BUCKETS = 400
+
+
+def minmax_decimate(values, buckets):
+    """
+    Reduce a series to the minimum and maximum of each bucket
+
+    :param values: A 1D array; NaN values are ignored
+    :param buckets: Number of buckets. Series of up to 2 * buckets values
+                    are returned whole
+    :return: (indices, values) of at most 2 * buckets points, indices
+             increasing. When the length is not a multiple of buckets the
+             oldest remainder is left out
+    """
+    count = len(values)
+    if count <= 2 * buckets:
+        return np.arange(count), values
+    size = count // buckets
+    start = count - size * buckets
+    blocks = values[start:].reshape(buckets, size)
+    missing = np.isnan(blocks)
+    low = np.argmin(np.where(missing, np.inf, blocks), axis=1)
+    high = np.argmax(np.where(missing, -np.inf, blocks), axis=1)
+    # Keep each pair in time order so the line shape is preserved
+    offsets = start + size * np.arange(buckets)
+    indices = np.empty(2 * buckets, dtype=np.intp)
+    indices[0::2] = offsets + np.minimum(low, high)
+    indices[1::2] = offsets + np.maximum(low, high)
+    return indices, values[indices]
+
+
+class _Series:
+    """ One artist fed from one ring """
+
+    def __init__(self, axes, artist, ring, window):
+        self.axes = axes
+        self.artist = artist
+        self.ring = ring
+        self.window = window
+        self.cursor = None
+
+    def changed(self):
+        return self.ring.written != self.cursor
+
+    def update(self, buckets):
+        self.cursor = self.ring.written
+        self.set_data(self.ring.latest(self.window), buckets)
+
+
+class _LineSeries(_Series):
+    """ The newest records of one field against their window position """
+
+    def __init__(self, axes, artist, ring, window, field, transform):
+        _Series.__init__(self, axes, artist, ring, window)
+        self.field = field
+        self.transform = transform
+
+    def set_data(self, records, buckets):
+        indices, values = minmax_decimate(records[self.field], buckets)
+        if self.transform is not None:
+            values = self.transform(values)
+        # The newest record is always at the right edge of the window
+        self.artist.set_data(indices + (self.window - len(records)), values)
+
+
+class _PointSeries(_Series):
+    """ Points computed from several fields of the newest records """
+
+    def __init__(self, axes, artist, ring, window, fields, transform):
+        _Series.__init__(self, axes, artist, ring, window)
+        self.fields = fields
+        self.transform = transform
+
+    def set_data(self, records, buckets):
+        # Scattered points have no order to decimate along: subsample
+        step = max(1, len(records) // (2 * buckets))
+        first = (len(records) - 1) % step  # keep the newest point
+        columns = [records[field][first::step] for field in self.fields]
+        self.artist.set_data(*self.transform(*columns))
+
+
+class LivePlot:
+    """ Redraws ring buffer series at a capped frame rate """
+
+    def __init__(self, figure, frame_rate=FRAME_RATE, buckets=BUCKETS):
+        """
+        :param figure: A matplotlib figure whose axes are already set up
+        :param frame_rate: Highest number of frames per second
+        :param buckets: Decimation buckets per time series, about the
+                        number of horizontal pixels of a plot
+        """
+        self.figure = figure
+        self.period = 1.0 / frame_rate
+        self.buckets = buckets
+        self.frames = 0
+        self.closed = False
+        self.__series = []
+        self.__backgrounds = None
+        canvas = figure.canvas
+        canvas.mpl_connect('resize_event', self.__invalidate)
+        canvas.mpl_connect('close_event', self.__close)
+
+    def __invalidate(self, event):
+        self.__backgrounds = None
+
+    def __close(self, event):
+        self.closed = True
+
+    def __add(self, series):
+        series.artist.set_animated(True)
+        self.__series.append(series)
+        return series.artist
+
+    def add_line(self, axes, ring, field, window, transform=None,
+                 **line_kwargs):
+        """
+        Plot the newest records of a ring field, the newest at x = window
+
+        :param axes: The matplotlib axes to draw in
+        :param ring: The RingBuffer the acquisition appends to
+        :param field: The field name
+        :param window: Number of newest records shown
+        :param transform: Optional vectorised function applied to the
+                          values left after decimation, e.g. a calibration
+        :param line_kwargs: Passed to axes.plot (label, color, ...)
+        :return: The Line2D
+        """
+        line, = axes.plot([], [], **line_kwargs)
+        return self.__add(_LineSeries(axes, line, ring, window, field,
+                                      transform))
+
+    def add_points(self, axes, ring, fields, window, transform,
+                   **line_kwargs):
+        """
+        Plot points computed from several fields of the newest records
+
+        :param fields: The field names passed to transform
+        :param transform: Vectorised function of one array per field
+                          returning the (x, y) arrays to draw, e.g.
+                          (theta, r) on polar axes
+        :return: The Line2D
+        """
+        line, = axes.plot([], [], **line_kwargs)
+        return self.__add(_PointSeries(axes, line, ring, window,
+                                       tuple(fields), transform))
+
+    def draw(self):
+        """
+        Redraw the series whose ring changed since the previous frame
+
+        :return: True when a frame was drawn
+        """
+        canvas = self.figure.canvas
+        changed = [series for series in self.__series if series.changed()]
+        if self.__backgrounds is None:
+            # First frame or new size: draw the static parts once
+            canvas.draw()
+            self.__backgrounds = {}
+            for series in self.__series:
+                if series.axes not in self.__backgrounds:
+                    self.__backgrounds[series.axes] = \
+                        canvas.copy_from_bbox(series.axes.bbox)
+            dirty = list(self.__backgrounds)
+        elif changed:
+            dirty = []
+            for series in changed:
+                if series.axes not in dirty:
+                    dirty.append(series.axes)
+        else:
+            return False
+        for series in changed:
+            series.update(self.buckets)
+        for axes in dirty:
+            canvas.restore_region(self.__backgrounds[axes])
+            for series in self.__series:
+                if series.axes is axes:
+                    axes.draw_artist(series.artist)
+            canvas.blit(axes.bbox)
+        canvas.flush_events()
+        self.frames += 1
+        return True
+
+    def run(self, stop=None):
+        """
+        Draw frames until the figure is closed or stop is set
+
+        :param stop: Optional threading.Event
+        """
+        canvas = self.figure.canvas
+        next_frame = time.monotonic()
+        while not self.closed and (stop is None or not stop.is_set()):
+            self.draw()
+            next_frame += self.period
+            delay = next_frame - time.monotonic()
+            if delay > 0.0:
+                # Keeps the window responsive while waiting
+                canvas.start_event_loop(delay)
+            else:
+                # Drawing is slower than the frame rate: do not catch up
+                next_frame = time.monotonic()
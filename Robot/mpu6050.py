@@ -9,7 +9,34 @@ https://github.com/m-rtijn/mpu6050
 """
 
 import logging
-import smbus2 as smbus
+import time
+import calibration_store
+import sensor_decode
+from i2c_bus import open_bus, PRIORITY_IMU
+from register_cache import RegisterShadow
+
+# ACCEL_XOUT_H .. GYRO_ZOUT_L: accel xyz, temperature, gyro xyz
+MOTION_BURST_REGISTER = 0x3B
+MOTION_BURST_LENGTH = sensor_decode.MOTION6.size
+WHO_AM_I = 0x75
+# time for the first temperature sample after wake up (s)
+WAKE_UP_TIME = 0.01
+
+
+def read_motion_burst(bus, address):
+    """
+    Read accel, temperature and gyro in a single I2C transaction
+
+    Every value comes from the same sample instant, at the cost of one bus
+    transaction instead of one or two per axis.
+
+    :param bus: An open SMBus handle
+    :param address: The I2C address of the MPU-6050
+    :return: The raw signed values (ax, ay, az, temp, gx, gy, gz)
+    """
+    raw_data = bus.read_i2c_block_data(address, MOTION_BURST_REGISTER,
+                                       MOTION_BURST_LENGTH)
+    return sensor_decode.motion6(raw_data)
 
 
 class MPU6050:
@@ -18,6 +45,7 @@ class MPU6050:
     GRAVITIY_MS2 = 9.80665
     address = None
     bus = None
+    registers = None
 
     # Scale Modifiers
     ACCEL_SCALE_MODIFIER_2G = 16384.0
@@ -67,11 +95,74 @@ class MPU6050:
     GYRO_CONFIG = 0x1B
     MPU_CONFIG = 0x1A
 
-    def __init__(self, address, bus=1):
+    def __init__(self, address, bus=1, calibration=None):
+        """
+        :param address: The I2C address of the MPU-6050
+        :param bus: The I2C bus number
+        :param calibration: Optional calibration_store.CalibrationStore to
+                            load this sensor's calibrations from
+        """
         self.address = address
-        self.bus = smbus.SMBus(bus)
+        self.bus_number = bus
+        self.bus = open_bus(bus, PRIORITY_IMU)
+        # configuration registers are shadowed so the range lookups done
+        # for every sample do not go over the bus
+        self.registers = RegisterShadow.for_device(self.bus, bus, address)
+        # scale modifiers are recomputed only when the range register changes
+        self._accel_scale = (None, None)
+        self._gyro_scale = (None, None)
         # wake up the MPU-6050 since it starts in sleep mode
-        self.bus.write_byte_data(self.address, self.PWR_MGMT_1, 0x00)
+        self.registers.write(self.PWR_MGMT_1, 0x00)
+        # fresh calibrations of this sensor for the current temperature,
+        # by kind (e.g. calibration_store.GYRO_BIAS)
+        self.calibrations = {}
+        if calibration is not None:
+            time.sleep(WAKE_UP_TIME)
+            self.load_calibrations(calibration)
+
+    def get_identity(self):
+        """
+        Get the key of this sensor in a calibration store
+
+        :return: A calibration_store.SensorIdentity
+        """
+        who_am_i = self.bus.read_byte_data(self.address, WHO_AM_I)
+        return calibration_store.SensorIdentity(self.bus_number,
+                                                self.address, who_am_i)
+
+    def load_calibrations(self, store,
+                          kinds=(calibration_store.GYRO_BIAS,
+                                 calibration_store.ACCEL_LINEAR)):
+        """
+        Load the fresh calibrations of this sensor at its current
+        temperature into calibrations
+
+        :param store: A calibration_store.CalibrationStore
+        :param kinds: The calibration kinds to look for
+        :return: calibrations
+        """
+        identity = self.get_identity()
+        temperature = self.get_temp()
+        self.calibrations = {}
+        for kind in kinds:
+            calibration = store.load(identity, kind, temperature)
+            if calibration is not None:
+                self.calibrations[kind] = calibration
+        return self.calibrations
+
+    def save_calibration(self, store, kind, values):
+        """
+        Store a calibration of this sensor at its current temperature
+
+        :param store: A calibration_store.CalibrationStore
+        :param kind: The calibration kind, e.g. calibration_store.GYRO_BIAS
+        :param values: A dict of JSON serialisable values
+        :return: The stored calibration_store.Calibration
+        """
+        calibration = store.save(self.get_identity(), kind, self.get_temp(),
+                                 values)
+        self.calibrations[kind] = calibration
+        return calibration
 
     def read_i2c_word(self, register):
         """
@@ -80,13 +171,8 @@ class MPU6050:
         param: register: The first register address to read from
         :return: The combined result (word)
         """
-        high = self.bus.read_byte_data(self.address, register)
-        low = self.bus.read_byte_data(self.address, register + 1)
-        value = (high << 8) + low
-        if (value >= 0x8000):
-            return -((65535 - value) + 1)
-        else:
-            return value
+        raw_data = self.bus.read_i2c_block_data(self.address, register, 2)
+        return sensor_decode.int16_be(raw_data)
 
     def get_temp(self):
         """
@@ -108,10 +194,10 @@ class MPU6050:
                             Using a pre-defined range is advised
         """
         # first change it to 0x00 to make sure we write the correct value later
-        self.bus.write_byte_data(self.address, self.ACCEL_CONFIG, 0x00)
+        self.registers.write(self.ACCEL_CONFIG, 0x00)
 
         # write the new range to the ACCEL_CONFIG register
-        self.bus.write_byte_data(self.address, self.ACCEL_CONFIG, accel_range)
+        self.registers.write(self.ACCEL_CONFIG, accel_range)
 
     def read_accel_range(self, raw=False):
         """
@@ -122,7 +208,7 @@ class MPU6050:
         :return: The accelerometer range, raw or integer (2, 4, 8 or 16) value,
                  or -1 if something went wrong
         """
-        raw_data = self.bus.read_byte_data(self.address, self.ACCEL_CONFIG)
+        raw_data = self.registers.read(self.ACCEL_CONFIG)
         if raw:
             return raw_data
         else:
@@ -149,8 +235,17 @@ class MPU6050:
         y = self.read_i2c_word(self.ACCEL_YOUT0)
         z = self.read_i2c_word(self.ACCEL_ZOUT0)
 
-        accel_scale_modifier = None
+        return self._scale_accel(x, y, z, g)
+
+    def _accel_scale_modifier(self):
+        """
+        Get the LSB/g divisor for the current accelerometer range
+
+        :return: One of the ACCEL_SCALE_MODIFIER_* values
+        """
         accel_range = self.read_accel_range(True)
+        if accel_range == self._accel_scale[0]:
+            return self._accel_scale[1]
 
         if accel_range == self.ACCEL_RANGE_2G:
             accel_scale_modifier = self.ACCEL_SCALE_MODIFIER_2G
@@ -163,6 +258,18 @@ class MPU6050:
         else:
             logging.warning("Unkown range, accel_scale_modifier set to ACCEL_SCALE_MODIFIER_2G")  # noqa: E501
             accel_scale_modifier = self.ACCEL_SCALE_MODIFIER_2G
+        self._accel_scale = (accel_range, accel_scale_modifier)
+        return accel_scale_modifier
+
+    def _scale_accel(self, x, y, z, g=False):
+        """
+        Convert raw accelerometer values to g or m/s^2
+
+        :param g: True: unit is g
+                  False: unit m/s^2
+        :return: The scaled values (tuple)
+        """
+        accel_scale_modifier = self._accel_scale_modifier()
 
         x = x / accel_scale_modifier
         y = y / accel_scale_modifier
@@ -182,19 +289,17 @@ class MPU6050:
         :param gyro_range: The range, a pre-defined range is advised
         """
         # change to 0x00 to make sure we write the correct value later
-        self.bus.write_byte_data(self.address, self.GYRO_CONFIG, 0x00)
+        self.registers.write(self.GYRO_CONFIG, 0x00)
 
         # write the new range to the ACCEL_CONFIG register
-        self.bus.write_byte_data(self.address, self.GYRO_CONFIG, gyro_range)
+        self.registers.write(self.GYRO_CONFIG, gyro_range)
 
     def set_filter_range(self, filter_range=FILTER_BW_256):
         """Sets the low-pass bandpass filter frequency"""
         # Keep the current EXT_SYNC_SET configuration in bits 3, 4, 5 in the MPU_CONFIG register  # noqa: E501
-        EXT_SYNC_SET = self.bus.read_byte_data(self.address,
-                                               self.MPU_CONFIG) & 0b00111000
-        return self.bus.write_byte_data(self.address,
-                                        self.MPU_CONFIG,
-                                        EXT_SYNC_SET | filter_range)
+        EXT_SYNC_SET = self.registers.read(self.MPU_CONFIG) & 0b00111000
+        return self.registers.write(self.MPU_CONFIG,
+                                    EXT_SYNC_SET | filter_range)
 
     def read_gyro_range(self, raw=False):
         """
@@ -205,7 +310,7 @@ class MPU6050:
         :return: The range, raw or integer value (250, 500, 1000, 2000),
                  or -1 if something went wrong
         """
-        raw_data = self.bus.read_byte_data(self.address, self.GYRO_CONFIG)
+        raw_data = self.registers.read(self.GYRO_CONFIG)
         if raw:
             return raw_data
         else:
@@ -230,8 +335,17 @@ class MPU6050:
         y = self.read_i2c_word(self.GYRO_YOUT0)
         z = self.read_i2c_word(self.GYRO_ZOUT0)
 
-        gyro_scale_modifier = None
+        return self._scale_gyro(x, y, z)
+
+    def _gyro_scale_modifier(self):
+        """
+        Get the LSB/(deg/s) divisor for the current gyroscope range
+
+        :return: One of the GYRO_SCALE_MODIFIER_* values
+        """
         gyro_range = self.read_gyro_range(True)
+        if gyro_range == self._gyro_scale[0]:
+            return self._gyro_scale[1]
 
         if gyro_range == self.GYRO_RANGE_250DEG:
             gyro_scale_modifier = self.GYRO_SCALE_MODIFIER_250DEG
@@ -244,21 +358,50 @@ class MPU6050:
         else:
             logging.warning("Unkown range, gyro_scale_modifier set to GYRO_SCALE_MODIFIER_250DEG")  # noqa: E501
             gyro_scale_modifier = self.GYRO_SCALE_MODIFIER_250DEG
+        self._gyro_scale = (gyro_range, gyro_scale_modifier)
+        return gyro_scale_modifier
+
+    def _scale_gyro(self, x, y, z):
+        """
+        Convert raw gyroscope values to degrees per second
+
+        :return: The scaled values (tuple)
+        """
+        gyro_scale_modifier = self._gyro_scale_modifier()
 
         x /= gyro_scale_modifier
         y /= gyro_scale_modifier
         z /= gyro_scale_modifier
         return (x, y, z)
 
+    def read_motion_burst(self):
+        """
+        Read accel, temperature and gyro in one 14 byte block read
+
+        :return: The raw signed values (ax, ay, az, temp, gx, gy, gz)
+        """
+        return read_motion_burst(self.bus, self.address)
+
+    def get_motion6(self, g=False):
+        """
+        Get accelerometer, gyroscope and temperature from a single sample
+
+        :param g: True: accelerometer unit is g
+                  False: accelerometer unit m/s^2
+        :return: Accelerometer (tuple), gyroscope (tuple) and temperature
+        """
+        ax, ay, az, temp, gx, gy, gz = self.read_motion_burst()
+        accel = self._scale_accel(ax, ay, az, g)
+        gyro = self._scale_gyro(gx, gy, gz)
+        return accel, gyro, (temp / 340.0) + 36.53
+
     def get_all_data(self):
         """
         Get all the available data
 
         :return: Accelerometer, gyroscope, and temperature sensor values (list)
         """
-        temp = self.get_temp()
-        accel = self.get_accel_data()
-        gyro = self.get_gyro_data()
+        accel, gyro, temp = self.get_motion6()
         return [accel, gyro, temp]
 
 
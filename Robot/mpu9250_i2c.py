@@ -10,7 +10,10 @@
 #
 #########################################
 #
-import smbus,time
+import time
+import sensor_decode
+from i2c_bus import open_bus, PRIORITY_IMU
+from mpu6050 import read_motion_burst
 
 def MPU6050_start():
     # reset all sensors
@@ -49,28 +52,14 @@ def MPU6050_start():
     return gyro_config_vals[gyro_indx],accel_config_vals[accel_indx]
     
 def read_raw_bits(register):
-    # read accel and gyro values
-    high = bus.read_byte_data(MPU6050_ADDR, register)
-    low = bus.read_byte_data(MPU6050_ADDR, register+1)
-
-    # combine higha and low for unsigned bit value
-    value = ((high << 8) | low)
-    
+    # read accel and gyro values (high byte first) in one transaction
+    raw_data = bus.read_i2c_block_data(MPU6050_ADDR, register, 2)
     # convert to +- value
-    if(value > 32768):
-        value -= 65536
-    return value
+    return sensor_decode.int16_be(raw_data)
 
 def mpu6050_conv():
-    # raw acceleration bits
-    acc_x = read_raw_bits(ACCEL_XOUT_H)
-    acc_y = read_raw_bits(ACCEL_YOUT_H)
-    acc_z = read_raw_bits(ACCEL_ZOUT_H)
-    
-    # raw gyroscope bits
-    gyro_x = read_raw_bits(GYRO_XOUT_H)
-    gyro_y = read_raw_bits(GYRO_YOUT_H)
-    gyro_z = read_raw_bits(GYRO_ZOUT_H)
+    # raw acceleration, temperature and gyroscope bits in one transaction
+    acc_x,acc_y,acc_z,temp,gyro_x,gyro_y,gyro_z = read_motion_burst(bus,MPU6050_ADDR)
 
     #convert to acceleration in g and gyro dps
     a_x = (acc_x/(2.0**15.0))*accel_sens
@@ -89,52 +78,64 @@ def AK8963_start():
     bus.write_byte_data(AK8963_ADDR,AK8963_CNTL,0x0F)
     time.sleep(0.1)
     coeff_data = bus.read_i2c_block_data(AK8963_ADDR,AK8963_ASAX,3)
-    AK8963_coeffx = (0.5*(coeff_data[0]-128)) / 256.0 + 1.0
-    AK8963_coeffy = (0.5*(coeff_data[1]-128)) / 256.0 + 1.0
-    AK8963_coeffz = (0.5*(coeff_data[2]-128)) / 256.0 + 1.0
+    AK8963_coeffx = (0.5*(coeff_data[0]-128)) / 128.0 + 1.0
+    AK8963_coeffy = (0.5*(coeff_data[1]-128)) / 128.0 + 1.0
+    AK8963_coeffz = (0.5*(coeff_data[2]-128)) / 128.0 + 1.0
     time.sleep(0.1)
     bus.write_byte_data(AK8963_ADDR,AK8963_CNTL,0x00)
     time.sleep(0.1)
     AK8963_bit_res = 0b0001 # 0b0001 = 16-bit
-    AK8963_samp_rate = 0b0110 # 0b0010 = 8 Hz, 0b0110 = 100 Hz
+    AK8963_samp_rate = AK8963_RATES[AK8963_ODR] # 0b0010 = 8 Hz, 0b0110 = 100 Hz
     AK8963_mode = (AK8963_bit_res <<4)+AK8963_samp_rate # bit conversion
     bus.write_byte_data(AK8963_ADDR,AK8963_CNTL,AK8963_mode)
     time.sleep(0.1)
     return [AK8963_coeffx,AK8963_coeffy,AK8963_coeffz] 
     
 def AK8963_reader(register):
-    # read magnetometer values
-    low = bus.read_byte_data(AK8963_ADDR, register-1)
-    high = bus.read_byte_data(AK8963_ADDR, register)
-    # combine higha and low for unsigned bit value
-    value = ((high << 8) | low)
+    # read magnetometer values (low byte first) in one transaction
+    raw_data = bus.read_i2c_block_data(AK8963_ADDR, register-1, 2)
     # convert to +- value
-    if(value > 32768):
-        value -= 65536
-    
-    return value
+    return sensor_decode.int16_le(raw_data)
 
-def AK8963_conv():
-    # raw magnetometer bits
-    while 1:
-##        if ((bus.read_byte_data(AK8963_ADDR,AK8963_ST1) & 0x01))!=1:
-##            return 0,0,0
-        mag_x = AK8963_reader(HXH)
-        mag_y = AK8963_reader(HYH)
-        mag_z = AK8963_reader(HZH)
+def AK8963_read():
+    # newest magnetometer sample in uT, or None when there is no new one
+    global AK8963_next_time
+    now = time.monotonic()
+    if now < AK8963_next_time:
+        # the next sample is not due yet at the configured ODR: skip the bus
+        return None
+    st1 = bus.read_byte_data(AK8963_ADDR,AK8963_ST1)
+    if not st1 & 0x01:
+        AK8963_stats['not_ready'] += 1
+        return None
+    if st1 & 0x02:
+        # data overrun, at least one sample was skipped
+        AK8963_stats['overruns'] += 1
+    # HXL through ST2 in one transaction, reading ST2 releases the data
+    mag_x,mag_y,mag_z,st2 = sensor_decode.ak8963_data(
+        bus.read_i2c_block_data(AK8963_ADDR,AK8963_HXL,7))
+    AK8963_next_time = now + AK8963_period
+    if st2 & 0x08:
+        # magnetic sensor overflow, the values are not valid
+        AK8963_stats['overflows'] += 1
+        return None
+    AK8963_stats['samples'] += 1
+    # sensitivity adjustment and conversion to uT in one multiply
+    return (mag_x*AK8963_scale[0],mag_y*AK8963_scale[1],
+            mag_z*AK8963_scale[2])
 
-        # the next line is needed for AK8963
-        if (bus.read_byte_data(AK8963_ADDR,AK8963_ST2)) & 0x08!=0x08:
-            break
-        
-    #convert to acceleration in g and gyro dps
-##    m_x = AK8963_coeffs[0]*(mag_x/(2.0**15.0))*mag_sens
-##    m_y = AK8963_coeffs[1]*(mag_y/(2.0**15.0))*mag_sens
-##    m_z = AK8963_coeffs[2]*(mag_z/(2.0**15.0))*mag_sens
-    m_x = (mag_x/(2.0**15.0))*mag_sens
-    m_y = (mag_y/(2.0**15.0))*mag_sens
-    m_z = (mag_z/(2.0**15.0))*mag_sens
-    return m_x,m_y,m_z
+def AK8963_conv(timeout=0.1):
+    # wait for the next fresh, valid magnetometer sample
+    deadline = time.monotonic()+timeout
+    while 1:
+        mag = AK8963_read()
+        if mag is not None:
+            return mag
+        now = time.monotonic()
+        if now > deadline:
+            raise IOError("No data ready from the AK8963")
+        # sleep until the sample is due, then poll ST1 at a fraction of the ODR
+        time.sleep(max(AK8963_next_time-now,AK8963_period/10.0))
     
 # MPU6050 Registers
 MPU6050_ADDR = 0x68
@@ -155,6 +156,7 @@ GYRO_ZOUT_H  = 0x47
 #AK8963 registers
 AK8963_ADDR   = 0x0C
 AK8963_ST1    = 0x02
+AK8963_HXL   = 0x03
 HXH          = 0x04
 HYH          = 0x06
 HZH          = 0x08
@@ -164,11 +166,18 @@ AK8963_CNTL  = 0x0A
 AK8963_ASAX = 0x10
 
 mag_sens = 4800.0 # magnetometer sensitivity: 4800 uT
+AK8963_RATES = {8.0:0b0010,100.0:0b0110} # continuous mode ODR (Hz): mode bits
+AK8963_ODR = 100.0 # magnetometer output data rate (Hz)
+AK8963_period = 1.0/AK8963_ODR
+AK8963_next_time = 0.0 # earliest time the next sample can be ready
+AK8963_stats = {'samples':0,'not_ready':0,'overruns':0,'overflows':0}
 
 # start I2C driver
-bus = smbus.SMBus(1) # start comm with i2c bus
+bus = open_bus(1, PRIORITY_IMU) # start comm with i2c bus
 time.sleep(0.1)
 gyro_sens,accel_sens = MPU6050_start() # instantiate gyro/accel
 time.sleep(0.1)
 AK8963_coeffs = AK8963_start() # instantiate magnetometer
+# precomputed sensitivity adjustment and conversion of raw counts to uT
+AK8963_scale = [coeff*mag_sens/(2.0**15.0) for coeff in AK8963_coeffs]
 time.sleep(0.1)
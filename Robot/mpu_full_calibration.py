@@ -10,19 +10,21 @@
 # various methods with the IMU attached to a 3D-cube
 # (MPU9250 + calibration block)
 # --- The calibration coefficients are then saved to
-# --- a local .csv file, which can be loaded upon
+# --- the calibration store, which loads them upon
 # --- the next run of the program
 #
 #
 ######################################################
 import time
-import csv
-import math
+import threading
 import numpy as np
 import matplotlib.pyplot as plt
 
 from mpu6050 import MPU6050
 from hmc5883 import HMC5883
+from ring_buffer import RingBuffer
+from live_plot import LivePlot
+import calibration_store
 
 from accel_calibration import accel_cal
 from gyro_calibration import gyro_cal
@@ -76,84 +78,75 @@ def mpu_plot_test():
     axs[0].set_title('Calibrated MPU Time Series Plot')  # imu time series title
     fig.canvas.draw()  # draw axes
 
-    # Pre-allocate plot vectors
-    dummy_y_vals = np.zeros((plt_pts, ))  # for populating the plots at start
-    dummy_y_vals[dummy_y_vals == 0] = np.nan  # keep plots clear
-    lines = []  # lines for looping updates
-    for ii in range(0, 9):
-        if ii in range(0, 3):  # accel pre-allocation
-            line_ii, = axs[0].plot(np.arange(0, plt_pts), dummy_y_vals,
-                                   label='$' + mpu_labels[ii] + '$', color=plt.cm.tab10(ii))
-        elif ii in range(3, 6):  # gyro pre-allocation
-            line_ii, = axs[1].plot(np.arange(0, plt_pts), dummy_y_vals,
-                                   label='$' + mpu_labels[ii] + '$', color=plt.cm.tab10(ii))
-        elif ii in range(6, 9):  # mag pre-allocation
-            jj = ii-6
-            line_jj, = axs[2].plot(np.arange(0, plt_pts), dummy_y_vals,
-                                   label='$' + mpu_labels[ii] + '$', color=plt.cm.tab10(ii))
-            line_ii, = axs[3].plot(dummy_y_vals, dummy_y_vals,
-                                   label='$' + mag_cal_axes[jj] + '$-Axis Heading',
-                                   color=plt.cm.tab20b(int(jj*4)),
-                                   linestyle='', marker='o', markersize=3)
-            lines.append(line_jj)
-        lines.append(line_ii)
-    ax_legs = [axs[tt].legend() for tt in range(0, len(axs))]  # legends for axes
-    ax_bgnds = [fig.canvas.copy_from_bbox(axs[tt].bbox) for tt in range(0, len(axs))]  # axis backgrounds
-    fig.show()  # show figure
-    mpu_array = np.zeros((plt_pts, 9))  # pre-allocate the 9-DoF vector
-    mpu_array[mpu_array == 0] = np.nan
-
-    # Real-Time Plot Update Loop
-    ii_iter = 0  # plot update iteration counter
+    # Series fed by the acquisition thread, drawn at a capped frame rate
+    imu_ring = RingBuffer(plt_pts, mpu_labels[0:6])  # accel and gyro samples
+    mag_ring = RingBuffer(plt_pts, mpu_labels[6:9])  # magnetometer samples
+    plot = LivePlot(fig, frame_rate=20.0)
+    for ii in range(0, 3):  # calibrated accel lines
+        plot.add_line(axs[0], imu_ring, mpu_labels[ii], plt_pts,
+                      transform=lambda y, ii=ii: cal_offsets[ii][0] * y + cal_offsets[ii][1],
+                      label='$' + mpu_labels[ii] + '$', color=plt.cm.tab10(ii))
+    for ii in range(3, 6):  # gyro lines minus offsets
+        plot.add_line(axs[1], imu_ring, mpu_labels[ii], plt_pts,
+                      transform=lambda y, ii=ii: y - cal_offsets[ii],
+                      label='$' + mpu_labels[ii] + '$', color=plt.cm.tab10(ii))
     cal_rot_indices = [[6, 7], [7, 8], [6, 8]]  # heading indices
-    while True:
-        try:
-            ax, ay, az = mpu.get_accel_data()
-            wx, wy, wz = mpu.get_gyro_data()
-            mx, my, mz = mag.read()
-        except:
-            continue
-
-        mpu_array[0:-1] = mpu_array[1:]  # get rid of last point
-        mpu_array[-1] = [ax, ay, az, wx, wy, wz, mx, my, mz]  # update last point w/new data
-
-        if ii_iter == 100:
-            [fig.canvas.restore_region(ax_bgnds[tt]) for tt in range(0, len(ax_bgnds))]  # restore backgrounds
-            for ii in range(0, 9):
-                if ii in range(0, 3):
-                    lines[ii].set_ydata(cal_offsets[ii][0] * mpu_array[:, ii] +
-                                        cal_offsets[ii][1])  # update accel data array
-                    axs[0].draw_artist(lines[ii])  # update accel plot
-                if ii in range(3, 6):
-                    lines[ii].set_ydata(np.array(mpu_array[:, ii]) - cal_offsets[ii])  # update gyro data
-                    axs[1].draw_artist(lines[ii])  # update gyro plot
-                if ii in range(6, 9):
-                    jj = ii-6  # index offsetted to 0-2
-                    x = np.array(mpu_array[:, cal_rot_indices[jj][0]])  # raw x-variable
-                    y = np.array(mpu_array[:, cal_rot_indices[jj][1]])  # raw y-variable
-                    x_prime = x - cal_offsets[cal_rot_indices[jj][0]]  # x-var for heading
-                    y_prime = y - cal_offsets[cal_rot_indices[jj][1]]  # y-var for heading
-                    x_prime[np.isnan(x)] = np.nan
-                    y_prime[np.isnan(y)] = np.nan
-                    # r_var = np.sqrt(np.power(x_prime, 2.0) + np.power(y_prime, 2.0))  # radius vector
-                    r_var = math.hypot(x_prime, y_prime)  # radius vector
-                    theta = np.arctan2(-y_prime, x_prime)  # angle vector for heading
-                    lines[int(ii + jj)].set_ydata(mpu_array[:, ii] -
-                                                  cal_offsets[cal_rot_indices[jj][0]])  # update mag data
-                    # lines[int(ii + jj + 1)].set_data(x_prime, y_prime)  # update heading data
-                    lines[int(ii + jj + 1)].set_data(theta, r_var)
-                    axs[2].draw_artist(lines[int(ii + jj)])  # update mag plot
-                    axs[3].draw_artist(lines[int(ii + jj + 1)])  # update heading plot
-            [axs[tt].draw_artist(ax_legs[tt]) for tt in range(0, len(ax_legs))]  # update legends
-            [fig.canvas.blit(axs[tt].bbox) for tt in range(0, len(ax_legs))]  # update axes
-            fig.canvas.flush_events()  # flush blit events
-            ii_iter = 0  # reset plot counter
-        ii_iter += 1  # update plot counter
+    for jj in range(0, 3):  # mag lines and heading points
+        ii = jj + 6
+        plot.add_line(axs[2], mag_ring, mpu_labels[ii], plt_pts,
+                      transform=lambda y, ii=ii: y - cal_offsets[ii],
+                      label='$' + mpu_labels[ii] + '$', color=plt.cm.tab10(ii))
+        x_ii, y_ii = cal_rot_indices[jj]
+
+        def heading(x, y, x_ii=x_ii, y_ii=y_ii):
+            x_prime = x - cal_offsets[x_ii]  # x-var for heading
+            y_prime = y - cal_offsets[y_ii]  # y-var for heading
+            return np.arctan2(-y_prime, x_prime), np.hypot(x_prime, y_prime)  # angle, radius
+
+        plot.add_points(axs[3], mag_ring, (mpu_labels[x_ii], mpu_labels[y_ii]), plt_pts, heading,
+                        label='$' + mag_cal_axes[jj] + '$-Axis Heading',
+                        color=plt.cm.tab20b(int(jj*4)),
+                        linestyle='', marker='o', markersize=3)
+    [axs[tt].legend() for tt in range(0, len(axs))]  # legends for axes
+
+    # Acquisition loop, never waiting for the plot
+    stop = threading.Event()
+    sample_period = 0.001  # accel output rate with the default filter setting
+
+    def acquire():
+        next_read = time.monotonic()
+        while not stop.is_set():
+            # one read per new sample instead of spinning on the bus
+            next_read += sample_period
+            delay = next_read - time.monotonic()
+            if delay > 0.0:
+                time.sleep(delay)
+            else:
+                next_read = time.monotonic()  # reads are late: do not catch up
+            try:
+                (ax, ay, az), (wx, wy, wz), temp = mpu.get_motion6()
+                mag_sample = mag.poll()  # None until a new sample is ready
+            except (IOError, OSError):
+                continue
+            imu_ring.append((ax, ay, az, wx, wy, wz))
+            if mag_sample is not None:
+                mag_ring.append(mag_sample[1:], mag_sample[0])
+
+    acquisition = threading.Thread(target=acquire, name='mpu_acquisition',
+                                   daemon=True)
+    acquisition.start()
+    fig.show()  # show figure
+    try:
+        plot.run()  # redraw until the figure is closed
+    finally:
+        stop.set()
+        acquisition.join()
 
 
 if __name__ == '__main__':
-    mpu = MPU6050()  # IMU (Accelerometer, Gyroscope)
-    mag = HMC5883()  # Magnetometer
+    store = calibration_store.CalibrationStore()  # coefficients by sensor and temperature
+    mpu = MPU6050(0x68, calibration=store)  # IMU (Accelerometer, Gyroscope)
+    mag = HMC5883(rate=75.0)  # Magnetometer
 
     # input parameters
     mpu_labels = ['a_x', 'a_y', 'a_z',
@@ -163,20 +156,19 @@ if __name__ == '__main__':
                   'w_x', 'w_y', 'w_z',
                   ['m_x', 'm_x0'], ['m_y', 'm_y0'], ['m_z', 'm_z0']]
     mag_cal_axes = ['z', 'y', 'x']  # axis order being rotated for mag cal
-    cal_filename = 'mpu_cal_params.csv'  # filename for saving calib coeffs
     cal_size = 200  # how many points to use for calibration averages
     cal_offsets = np.array([[], [], [],
                             0.0, 0.0, 0.0,
                             [], [], []])  # cal vector
     # call to calibration functions
     re_cal_bool = input("Input 1 + Press Enter to Calibrate New Coefficients or \n" +
-                        "Press Enter to Load Local Calibration Coefficients ")
+                        "Press Enter to Load Stored Calibration Coefficients ")
     if re_cal_bool == "1":
         print("-" * 50)
         input("Press Enter to Start The Calibration Procedure")
         time.sleep(1)
 
-        gyro_offsets = gyro_cal()  # calibrate gyro offsets under stable conditions
+        gyro_offsets, gyro_converged = gyro_cal()  # calibrate gyro offsets under stable conditions
         cal_offsets[3:6] = gyro_offsets
 
         mpu_offsets = accel_cal()  # calibrate accel offsets
@@ -185,28 +177,31 @@ if __name__ == '__main__':
         ak_offsets = mag_cal()  # calibrate mag offsets
         cal_offsets[6:] = ak_offsets
 
-        # save calibration coefficients to file
-        with open(cal_filename, 'w', newline='') as csvfile:
-            writer = csv.writer(csvfile, delimiter=',')
-            for param_ii in range(0, len(cal_offsets)):
-                if param_ii > 2:
-                    writer.writerow([cal_labels[param_ii],
-                                     cal_offsets[param_ii]])
-                else:
-                    writer.writerow(cal_labels[param_ii] +
-                                    [ii for ii in cal_offsets[param_ii]])
+        # save calibration coefficients for this sensor and temperature
+        if gyro_converged:
+            mpu.save_calibration(store, calibration_store.GYRO_BIAS,
+                                 {'bias': [float(ii) for ii in gyro_offsets]})
+        else:
+            print('Gyro offsets not saved')
+        mpu.save_calibration(store, calibration_store.ACCEL_LINEAR,
+                             {'scale': [float(ii[0]) for ii in mpu_offsets],
+                              'bias': [float(ii[1]) for ii in mpu_offsets]})
+        store.save(mag.get_identity(), calibration_store.MAG_OFFSETS,
+                   mpu.get_temp(), {'offsets': np.asarray(ak_offsets).tolist()})
     else:
-        # read calibration coefficients from file
-        with open(cal_filename, 'r', newline='') as csvfile:
-            reader = csv.reader(csvfile, delimiter=',')
-            iter_ii = 0
-            for row in reader:
-                if len(row) > 2:
-                    row_vals = [float(ii) for ii in row[int((len(row)/2) + 1):]]
-                    cal_offsets[iter_ii] = row_vals
-                else:
-                    cal_offsets[iter_ii] = float(row[1])
-                iter_ii += 1
+        # load the calibration coefficients stored for this temperature
+        gyro_stored = mpu.calibrations.get(calibration_store.GYRO_BIAS)
+        accel_stored = mpu.calibrations.get(calibration_store.ACCEL_LINEAR)
+        mag_stored = store.load(mag.get_identity(), calibration_store.MAG_OFFSETS,
+                                mpu.get_temp())
+        if gyro_stored is None or accel_stored is None or mag_stored is None:
+            raise SystemExit("No fresh calibration stored for this IMU and temperature, "
+                             "input 1 to calibrate")
+        cal_offsets[3:6] = gyro_stored.values['bias']
+        for ii in range(0, 3):
+            cal_offsets[ii] = np.array([accel_stored.values['scale'][ii],
+                                        accel_stored.values['bias'][ii]])
+        cal_offsets[6:] = mag_stored.values['offsets']
 
     # print out offsets for each sensor
     print("-" * 50)
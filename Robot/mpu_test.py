@@ -3,6 +3,7 @@ from time import sleep, time
 import math
 import RPi.GPIO as GPIO
 import sys
+import sensor_decode
  
 PWR_MGMT_1   = 0x6B
 SMPLRT_DIV   = 0x19
@@ -25,12 +26,8 @@ def MPU_Init():
     bus.write_byte_data(Device_Address, INT_ENABLE, 1)
  
 def read_raw_data(addr):
-        high = bus.read_byte_data(Device_Address, addr)
-        low = bus.read_byte_data(Device_Address, addr+1)
-        value = ((high << 8) | low)
-        if(value > 32768):
-                value = value - 65536
-        return value
+        return sensor_decode.int16_be(
+                bus.read_i2c_block_data(Device_Address, addr, 2))
  
  
 def dist(a, b):
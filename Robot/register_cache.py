@@ -0,0 +1,117 @@
+"""
+Write-through shadow of the MPU-6050 configuration registers
+
+Configuration registers only change when we write them (or when the chip is
+reset), so after the first read or write their value is kept here and
+read-modify-write sequences and scale factor lookups no longer need a bus
+read. Data, status and FIFO registers are never cached.
+"""
+
+import threading
+
+# MPU-6050 configuration registers that are safe to shadow
+SMPLRT_DIV = 0x19
+CONFIG = 0x1A
+GYRO_CONFIG = 0x1B
+ACCEL_CONFIG = 0x1C
+FIFO_EN = 0x23
+INT_PIN_CFG = 0x37
+INT_ENABLE = 0x38
+USER_CTRL = 0x6A
+PWR_MGMT_1 = 0x6B
+PWR_MGMT_2 = 0x6C
+
+CACHED_REGISTERS = (SMPLRT_DIV, CONFIG, GYRO_CONFIG, ACCEL_CONFIG, FIFO_EN,
+                    INT_PIN_CFG, INT_ENABLE, USER_CTRL, PWR_MGMT_1,
+                    PWR_MGMT_2)
+
+# Bits that clear themselves once the chip has acted on them. They must not
+# be kept in the shadow, or the next read-modify-write would trigger them
+# again. USER_CTRL: DMP_RESET, FIFO_RESET, I2C_MST_RESET, SIG_COND_RESET
+SELF_CLEARING_BITS = {USER_CTRL: 0x0F}
+
+PWR1_DEVICE_RESET = 0x80
+
+
+class RegisterShadow:
+    """ Cached view of one device's configuration registers """
+
+    __shadows = {}
+    __shadows_lock = threading.Lock()
+
+    def __init__(self, bus, address, cached=CACHED_REGISTERS):
+        self.bus = bus
+        self.address = address
+        self.cached = frozenset(cached)
+        self.values = {}
+
+    @classmethod
+    def for_device(cls, bus, bus_number, address):
+        """
+        Get the shadow shared by every driver talking to a device
+
+        :param bus: An open SMBus handle used for cache misses
+        :param bus_number: The I2C bus number the device is on
+        :param address: The I2C address of the device
+        :return: The RegisterShadow for (bus_number, address)
+        """
+        key = (bus_number, address)
+        with cls.__shadows_lock:
+            shadow = cls.__shadows.get(key)
+            if shadow is None or \
+                    getattr(shadow.bus, 'managed_bus', shadow.bus) is not \
+                    getattr(bus, 'managed_bus', bus):
+                # Drivers get their own handle onto the shared bus; only
+                # another bus (e.g. after i2c_bus.set_backend) may reach
+                # another device, whose registers start unknown
+                shadow = cls(bus, address)
+                cls.__shadows[key] = shadow
+            return shadow
+
+    @classmethod
+    def clear(cls):
+        """ Drop the shadows of every device """
+        with cls.__shadows_lock:
+            cls.__shadows.clear()
+
+    def read(self, register):
+        """
+        Read a register, from the shadow if it holds a value
+
+        :param register: The register address
+        :return: The register value (0-255)
+        """
+        value = self.values.get(register)
+        if value is None:
+            value = self.bus.read_byte_data(self.address, register)
+            if register in self.cached:
+                self.values[register] = value
+        return value
+
+    def write(self, register, value):
+        """
+        Write a register on the device and update the shadow
+
+        :param register: The register address
+        :param value: The value to write
+        """
+        result = self.bus.write_byte_data(self.address, register, value)
+        if register in self.cached:
+            value &= 0xFF
+            if register == PWR_MGMT_1 and value & PWR1_DEVICE_RESET:
+                self.invalidate()
+            else:
+                self.values[register] = \
+                    value & ~SELF_CLEARING_BITS.get(register, 0)
+        return result
+
+    def invalidate(self, register=None):
+        """
+        Forget shadowed values so the next read goes to the device
+
+        :param register: A single register to forget, or None for all
+        """
+        if register is None:
+            self.values.clear()
+        else:
+            self.values.pop(register, None)
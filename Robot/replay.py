@@ -0,0 +1,592 @@
+"""
+Record and replay of sensor inputs
+
+A Recorder wraps everything the processing code gets from the outside
+world: I2C reads (IMU, magnetometer), GPIO input levels (ultrasonic echo,
+wheel encoders), interrupt edge times and clock readings. Every value is
+written to a session directory, one imu_log file per channel.
+
+A Replay hands the same values back in the same order: its ReplayClock is
+a virtual clock that stands in for the time module of the processing
+code, its ReplayBus for the I2C bus and so on. The processing code
+(KalmanAngle and the complementary filter in AngleMeterAlpha,
+imu_integrator, ...) therefore computes bit for bit the results it
+computed on the robot, at maximum speed or paced at a scaled clock, with
+any parameters changed between runs.
+
+Recording the robot:
+
+    recorder = Recorder('session')
+    i2c_bus.set_backend(recorder.bus_backend())
+    with recorder.install(AngleMeterAlpha):
+        AngleMeterAlpha.AngleMeterAlpha().measureAngles()  # Ctrl+C ends
+    recorder.close()
+
+Replaying it:
+
+    replay = Replay('session')
+    i2c_bus.set_backend(replay.bus_backend)
+    with replay.install(AngleMeterAlpha):
+        meter = AngleMeterAlpha.AngleMeterAlpha()
+        replay.run(meter.measureAngles)
+    print(replay.report())
+
+The processing code must consume its inputs from one thread, as the
+order of the values is what is replayed.
+"""
+
+import errno
+import os
+import time
+from contextlib import contextmanager
+
+import i2c_bus
+import imu_log
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Clock sources
+TIME = 0
+MONOTONIC = 1
+PERF_COUNTER = 2
+
+# I2C operations
+READ_BYTE = 0
+READ_BLOCK = 1
+
+# SMBus block transfers are at most 32 bytes
+BLOCK_SIZE = 32
+
+CLOCK_FILE = 'clock.imu'
+I2C_FILE = 'i2c.imu'
+GPIO_FILE = 'gpio.imu'
+EDGE_FILE = 'edges.imu'
+
+CLOCK_FIELDS = [('value', '<f8'), ('source', 'u1')]
+I2C_FIELDS = [('t', '<f8'), ('op', 'u1'), ('address', 'u1'),
+              ('register', 'u1'), ('length', 'u1'), ('error', 'u1'),
+              ('data', 'V%d' % BLOCK_SIZE)]
+GPIO_FIELDS = [('t', '<f8'), ('pin', 'u1'), ('level', 'u1')]
+# NaN edge times are timeouts
+EDGE_FIELDS = [('t', '<f8'), ('pin', 'u1'), ('edge', '<f8')]
+
+# The real clock, whatever a session installs into the processing modules
+_time = time.time
+_monotonic = time.monotonic
+_perf_counter = time.perf_counter
+_sleep = time.sleep
+
+
+class ReplayFinished(BaseException):
+    """
+    Raised from a replayed input once its recording is exhausted
+
+    A BaseException so that the except Exception retry loops of the sensor
+    code let it through to Replay.run.
+    """
+
+
+class ReplayDiverged(BaseException):
+    """ The code asked for a different input than was recorded """
+
+
+class _Session:
+    """ Installs a clock and a GPIO module into processing modules """
+
+    clock = None
+    gpio = None
+
+    @contextmanager
+    def install(self, *modules):
+        """
+        Replace the time module (and a GPIO module, when the module has one
+        and the session wraps GPIO) of the processing modules
+
+        :param modules: Imported modules, e.g. AngleMeterAlpha, hmc5883
+        """
+        saved = []
+        for module in modules:
+            names = [('time', self.clock)]
+            if self.gpio is not None and hasattr(module, 'GPIO'):
+                names.append(('GPIO', self.gpio))
+            for name, value in names:
+                saved.append((module, name, getattr(module, name, None)))
+                setattr(module, name, value)
+        try:
+            yield self
+        finally:
+            for module, name, value in reversed(saved):
+                setattr(module, name, value)
+
+
+class _TimeModule:
+    """ Forwards what a session does not replace to the time module """
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+# Recording
+
+
+class RecordingClock(_TimeModule):
+    """ The time module, logging every reading """
+
+    def __init__(self, writer):
+        self.__writer = writer
+
+    def time(self):
+        value = _time()
+        self.__writer.append((value, TIME))
+        return value
+
+    def monotonic(self):
+        value = _monotonic()
+        self.__writer.append((value, MONOTONIC))
+        return value
+
+    def perf_counter(self):
+        value = _perf_counter()
+        self.__writer.append((value, PERF_COUNTER))
+        return value
+
+    def sleep(self, seconds):
+        _sleep(seconds)
+
+
+class RecordingBus:
+    """ An SMBus-like handle logging every read """
+
+    def __init__(self, handle, writer):
+        self.handle = handle
+        self.__writer = writer
+
+    def __log(self, op, address, register, length, data, error=0):
+        self.__writer.append((_monotonic(), op, address, register, length,
+                              error, bytes(data).ljust(BLOCK_SIZE, b'\0')))
+
+    def read_byte_data(self, i2c_addr, register):
+        try:
+            value = self.handle.read_byte_data(i2c_addr, register)
+        except (IOError, OSError):
+            self.__log(READ_BYTE, i2c_addr, register, 1, b'', 1)
+            raise
+        self.__log(READ_BYTE, i2c_addr, register, 1, (value,))
+        return value
+
+    def read_i2c_block_data(self, i2c_addr, register, length=32):
+        if length > BLOCK_SIZE:
+            raise ValueError('Block reads are limited to %d bytes'
+                             % BLOCK_SIZE)
+        try:
+            data = self.handle.read_i2c_block_data(i2c_addr, register, length)
+        except (IOError, OSError):
+            self.__log(READ_BLOCK, i2c_addr, register, length, b'', 1)
+            raise
+        self.__log(READ_BLOCK, i2c_addr, register, length, data)
+        return data
+
+    def write_byte_data(self, i2c_addr, register, value):
+        return self.handle.write_byte_data(i2c_addr, register, value)
+
+    def write_i2c_block_data(self, i2c_addr, register, data):
+        return self.handle.write_i2c_block_data(i2c_addr, register, data)
+
+
+class RecordingGPIO:
+    """ An RPi.GPIO-like module logging every input() level """
+
+    def __init__(self, gpio, writer):
+        self.__gpio = gpio
+        self.__writer = writer
+
+    def input(self, pin):
+        level = self.__gpio.input(pin)
+        self.__writer.append((_monotonic(), pin, level))
+        return level
+
+    def __getattr__(self, name):
+        return getattr(self.__gpio, name)
+
+
+class RecordingEdgePin:
+    """ An EdgePin logging the result of every wait_for_edge() """
+
+    def __init__(self, pin, writer):
+        self.pin = pin
+        self.__writer = writer
+
+    def wait_for_edge(self, timeout=None):
+        edge_time = self.pin.wait_for_edge(timeout)
+        self.__writer.append((_monotonic(), self.pin.pin or 0,
+                              float('nan') if edge_time is None
+                              else edge_time))
+        return edge_time
+
+    def __getattr__(self, name):
+        return getattr(self.pin, name)
+
+
+class Recorder(_Session):
+    """ Records the inputs of a session into a directory """
+
+    def __init__(self, directory, gpio=None, meta=None):
+        """
+        :param directory: Created if needed; existing logs are replaced
+        :param gpio: Optional RPi.GPIO (or compatible) module to record
+        :param meta: Optional JSON serialisable description of the session
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.writers = {}
+        for name, fields in ((CLOCK_FILE, CLOCK_FIELDS),
+                             (I2C_FILE, I2C_FIELDS),
+                             (GPIO_FILE, GPIO_FIELDS),
+                             (EDGE_FILE, EDGE_FIELDS)):
+            self.writers[name] = imu_log.LogWriter(
+                os.path.join(directory, name), fields, meta=meta)
+        self.clock = RecordingClock(self.writers[CLOCK_FILE])
+        if gpio is not None:
+            self.gpio = RecordingGPIO(gpio, self.writers[GPIO_FILE])
+
+    def bus_backend(self, backend=None):
+        """
+        Get an i2c_bus backend recording another one
+
+        :param backend: The backend to record, the current one when None
+        :return: A callable for i2c_bus.set_backend
+        """
+        if backend is None:
+            backend = i2c_bus.get_backend()
+        elif isinstance(backend, str):
+            backend = i2c_bus.BACKENDS[backend]
+        return lambda bus_number: RecordingBus(backend(bus_number),
+                                               self.writers[I2C_FILE])
+
+    def edge_pin(self, pin):
+        """ Wrap an EdgePin (e.g. the AngleMeterAlpha int_pin) """
+        return RecordingEdgePin(pin, self.writers[EDGE_FILE])
+
+    def close(self):
+        """
+        Write out every channel
+
+        :return: Number of values lost because the disk was too slow; the
+                 session cannot be replayed exactly when it is not 0
+        """
+        dropped = 0
+        for writer in self.writers.values():
+            writer.close()
+            dropped += writer.dropped
+        return dropped
+
+
+# Replay
+
+
+class ReplayClock(_TimeModule):
+    """
+    Virtual clock returning the recorded readings in order
+
+    :param scale: None runs as fast as possible, otherwise readings are
+                  paced so virtual time passes scale times faster than
+                  wall time (1.0 is real time)
+    """
+
+    def __init__(self, records, scale=None):
+        self.__values = records['value'].tolist()
+        self.__sources = records['source'].tolist()
+        self.__index = 0
+        self.__origins = {}
+        self.scale = scale
+        self.now = self.__values[0] if self.__values else 0.0
+
+    @property
+    def position(self):
+        """ Number of readings returned so far """
+        return self.__index
+
+    def __len__(self):
+        return len(self.__values)
+
+    def elapsed(self):
+        """ Virtual time covered by the readings returned so far """
+        first = {}
+        last = {}
+        for index in range(0, self.__index):
+            source = self.__sources[index]
+            first.setdefault(source, self.__values[index])
+            last[source] = self.__values[index]
+        return max([last[source] - first[source] for source in last] or
+                   [0.0])
+
+    def __next(self, source):
+        index = self.__index
+        if index >= len(self.__values):
+            raise ReplayFinished('clock')
+        if self.__sources[index] != source:
+            raise ReplayDiverged('Clock reading %d: source %d was recorded, '
+                                 'not %d' % (index, self.__sources[index],
+                                             source))
+        self.__index = index + 1
+        value = self.__values[index]
+        if self.scale is not None:
+            self.__pace(source, value)
+        self.now = value
+        return value
+
+    def __pace(self, source, value):
+        # Each source has its own epoch
+        origin = self.__origins.get(source)
+        if origin is None:
+            self.__origins[source] = (value, _monotonic())
+            return
+        delay = origin[1] + (value - origin[0]) / self.scale - _monotonic()
+        if delay > 0:
+            _sleep(delay)
+
+    def time(self):
+        return self.__next(TIME)
+
+    def monotonic(self):
+        return self.__next(MONOTONIC)
+
+    def perf_counter(self):
+        return self.__next(PERF_COUNTER)
+
+    def sleep(self, seconds):
+        # Recorded readings already carry the time slept
+        pass
+
+
+class ReplayBus:
+    """ An SMBus-like handle returning the recorded reads; writes are ignored """
+
+    def __init__(self, records):
+        self.__ops = records['op'].tolist()
+        self.__addresses = records['address'].tolist()
+        self.__registers = records['register'].tolist()
+        self.__lengths = records['length'].tolist()
+        self.__errors = records['error'].tolist()
+        self.__data = records['data']
+        self.__index = 0
+
+    @property
+    def position(self):
+        return self.__index
+
+    def __len__(self):
+        return len(self.__ops)
+
+    def __next(self, op, address, register, length):
+        index = self.__index
+        if index >= len(self.__ops):
+            raise ReplayFinished('i2c')
+        if (self.__ops[index], self.__addresses[index],
+                self.__registers[index], self.__lengths[index]) != \
+                (op, address, register, length):
+            raise ReplayDiverged(
+                'I2C read %d: 0x%02X register 0x%02X length %d was '
+                'recorded, not 0x%02X register 0x%02X length %d'
+                % (index, self.__addresses[index], self.__registers[index],
+                   self.__lengths[index], address, register, length))
+        self.__index = index + 1
+        if self.__errors[index]:
+            raise IOError(errno.EIO, 'Recorded I2C error')
+        return self.__data[index].tobytes()[:length]
+
+    def read_byte_data(self, i2c_addr, register):
+        return self.__next(READ_BYTE, i2c_addr, register, 1)[0]
+
+    def read_i2c_block_data(self, i2c_addr, register, length=32):
+        return list(self.__next(READ_BLOCK, i2c_addr, register, length))
+
+    def write_byte_data(self, i2c_addr, register, value):
+        pass
+
+    def write_i2c_block_data(self, i2c_addr, register, data):
+        pass
+
+
+class ReplayGPIO:
+    """ An RPi.GPIO-like module returning the recorded input() levels """
+
+    BCM = 11
+    BOARD = 10
+    IN = 1
+    OUT = 0
+    LOW = 0
+    HIGH = 1
+    PUD_UP = 22
+    PUD_DOWN = 21
+    RISING = 31
+    FALLING = 32
+
+    def __init__(self, records):
+        self.__pins = records['pin'].tolist()
+        self.__levels = records['level'].tolist()
+        self.__index = 0
+
+    @property
+    def position(self):
+        return self.__index
+
+    def __len__(self):
+        return len(self.__levels)
+
+    def input(self, pin):
+        index = self.__index
+        if index >= len(self.__levels):
+            raise ReplayFinished('gpio')
+        if self.__pins[index] != pin:
+            raise ReplayDiverged('GPIO input %d: pin %d was recorded, not %d'
+                                 % (index, self.__pins[index], pin))
+        self.__index = index + 1
+        return self.__levels[index]
+
+    def setmode(self, *args, **kwargs):
+        pass
+
+    def setup(self, *args, **kwargs):
+        pass
+
+    def output(self, *args, **kwargs):
+        pass
+
+    def setwarnings(self, *args, **kwargs):
+        pass
+
+    def add_event_detect(self, *args, **kwargs):
+        pass
+
+    def remove_event_detect(self, *args, **kwargs):
+        pass
+
+    def cleanup(self, *args, **kwargs):
+        pass
+
+
+class ReplayEdgePin:
+    """ An EdgePin returning the recorded wait_for_edge() results """
+
+    def __init__(self, records, pin=None):
+        self.pin = pin
+        self.__edges = records['edge'].tolist()
+        self.__index = 0
+
+    @property
+    def position(self):
+        return self.__index
+
+    def __len__(self):
+        return len(self.__edges)
+
+    def wait_for_edge(self, timeout=None):
+        index = self.__index
+        if index >= len(self.__edges):
+            raise ReplayFinished('edges')
+        self.__index = index + 1
+        edge_time = self.__edges[index]
+        return None if edge_time != edge_time else edge_time
+
+    def close(self):
+        pass
+
+
+class Replay(_Session):
+    """ Replays a session directory written by Recorder """
+
+    def __init__(self, directory, scale=None):
+        """
+        :param directory: The Recorder directory
+        :param scale: None for maximum speed, else the virtual time speed
+                      relative to wall time (e.g. 10.0 for ten times
+                      faster than real time)
+        """
+        if np is None:
+            raise ImportError('numpy is needed for replay')
+        self.directory = directory
+        self.clock = ReplayClock(self.__read(CLOCK_FILE), scale)
+        self.bus = ReplayBus(self.__read(I2C_FILE))
+        self.gpio = ReplayGPIO(self.__read(GPIO_FILE))
+        self.edges = ReplayEdgePin(self.__read(EDGE_FILE))
+        self.wall_time = 0.0
+        self.finished = None
+
+    def __read(self, name):
+        return imu_log.read_log(os.path.join(self.directory, name))
+
+    def bus_backend(self, bus_number):
+        """ The i2c_bus backend: every bus number reads the recording """
+        return self.bus
+
+    def edge_pin(self, pin=None):
+        """ The recorded EdgePin (e.g. the AngleMeterAlpha int_pin) """
+        return self.edges
+
+    def run(self, target, *args, **kwargs):
+        """
+        Call target, usually the endless measuring loop, until the
+        recording is exhausted
+
+        :return: The report()
+        """
+        start = _perf_counter()
+        try:
+            target(*args, **kwargs)
+        except ReplayFinished as finished:
+            self.finished = str(finished)
+        finally:
+            self.wall_time += _perf_counter() - start
+        return self.report()
+
+    def report(self):
+        """
+        Get the replay throughput
+
+        :return: dict with the wall time, the virtual time covered by the
+                 clock readings, the speed up over real time, the values
+                 replayed per channel and the I2C reads per wall second
+        """
+        clock = self.clock
+        virtual_time = clock.elapsed()
+        wall_time = self.wall_time
+        return {'wall_time': wall_time,
+                'virtual_time': virtual_time,
+                'speed_up': virtual_time / wall_time if wall_time else 0.0,
+                'clock_readings': clock.position,
+                'i2c_reads': self.bus.position,
+                'gpio_inputs': self.gpio.position,
+                'edges': self.edges.position,
+                'reads_per_second': self.bus.position / wall_time
+                if wall_time else 0.0,
+                'finished': self.finished}
+
+
+if __name__ == '__main__':
+    import sys
+    import AngleMeterAlpha
+
+    if len(sys.argv) != 3 or sys.argv[1] not in ('record', 'replay'):
+        print('Usage: python replay.py record|replay DIRECTORY')
+        sys.exit(1)
+    if sys.argv[1] == 'record':
+        recorder = Recorder(sys.argv[2], meta={'code': 'AngleMeterAlpha'})
+        i2c_bus.set_backend(recorder.bus_backend())
+        with recorder.install(AngleMeterAlpha):
+            try:
+                AngleMeterAlpha.AngleMeterAlpha().measureAngles()
+            except KeyboardInterrupt:
+                pass
+        print('Values lost: %d' % recorder.close())
+    else:
+        replay = Replay(sys.argv[2])
+        i2c_bus.set_backend(replay.bus_backend)
+        with replay.install(AngleMeterAlpha):
+            meter = AngleMeterAlpha.AngleMeterAlpha()
+            print(replay.run(meter.measureAngles))
+        print(meter.snapshot())
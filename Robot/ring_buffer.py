@@ -0,0 +1,284 @@
+"""
+Preallocated ring buffer for sensor time series
+
+Records are stored in a structured NumPy array that is allocated once.
+Every record is written twice, at slot i and at slot i + capacity, so the
+newest N records are always one contiguous slice: ordered views cost no
+copy and an insert costs two row writes whatever the window size.
+
+One producer thread may append or extend while one consumer thread reads
+with read_since(); no lock is needed between them. SharedRingBuffer places
+the same layout in multiprocessing.shared_memory so that the producer and
+the consumers can be separate processes.
+"""
+
+import time
+
+import numpy as np
+
+TIMESTAMP_FIELD = 't'
+# Shared layout: int64 written count and capacity, padded to a cache
+# line, then the 2 * capacity records
+HEADER_SIZE = 64
+WRITTEN = 0
+CAPACITY = 1
+# Most records extend() writes before publishing them, so that a reader
+# knows how many unpublished records may be in flight
+IN_FLIGHT = 32
+
+
+def record_dtype(fields, timestamps=True, dtype=np.float64):
+    """
+    Build the record dtype of a ring
+
+    :param fields: Field names, or a list of (name, dtype) pairs
+    :param timestamps: Add a float64 't' field in front of the fields
+    :param dtype: The dtype of fields given by name only
+    :return: A structured numpy.dtype
+    """
+    fields = [field if isinstance(field, tuple) else (field, dtype)
+              for field in fields]
+    if timestamps:
+        fields.insert(0, (TIMESTAMP_FIELD, np.float64))
+    return np.dtype(fields)
+
+
+class RingBuffer:
+    """ Fixed capacity ring of timestamped sensor records """
+
+    def __init__(self, capacity, fields, timestamps=True, dtype=np.float64,
+                 fill=None, buffer=None):
+        """
+        :param capacity: Number of records kept
+        :param fields: Field names, or a list of (name, dtype) pairs
+        :param timestamps: Add a float64 't' field in front of the fields
+        :param dtype: The dtype of fields given by name only
+        :param fill: Start full of this value (e.g. numpy.nan for plots
+                     with a fixed number of points) instead of empty
+        :param buffer: Optional writable buffer of at least
+                       RingBuffer.size(capacity, ...) bytes holding the
+                       header and records; its contents are used as they
+                       are (only fill rewrites them)
+        """
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        self.capacity = capacity
+        self.timestamps = timestamps
+        self.dtype = record_dtype(fields, timestamps, dtype)
+        self.fields = self.dtype.names
+        if buffer is None:
+            self.__header = np.zeros(2, dtype=np.int64)
+            self.__data = np.zeros(2 * capacity, dtype=self.dtype)
+        else:
+            self.__header = np.ndarray((2,), np.int64, buffer)
+            self.__data = np.ndarray((2 * capacity,), self.dtype, buffer,
+                                     HEADER_SIZE)
+        self.__header[CAPACITY] = capacity
+        # A quarter of the ring at most, or read_since() would discard
+        # records of small rings even when the reader keeps up
+        self.__in_flight = max(1, min(IN_FLIGHT, capacity // 4))
+        self.__fill = fill
+        if fill is not None:
+            self.clear()
+
+    @staticmethod
+    def size(capacity, fields, timestamps=True, dtype=np.float64):
+        """ Number of bytes needed for the buffer argument """
+        return HEADER_SIZE + \
+            2 * capacity * record_dtype(fields, timestamps, dtype).itemsize
+
+    @property
+    def written(self):
+        """ Total number of records appended (the producer cursor) """
+        return int(self.__header[WRITTEN])
+
+    def __len__(self):
+        return min(self.written, self.capacity)
+
+    def full(self):
+        return self.written >= self.capacity
+
+    def clear(self):
+        self.__header[WRITTEN] = 0
+        if self.__fill is not None:
+            for name in self.fields:
+                self.__data[name] = self.__fill
+            self.__header[WRITTEN] = self.capacity
+
+    def append(self, values, timestamp=None):
+        """
+        Append one record in O(1)
+
+        :param values: The field values, without the timestamp
+        :param timestamp: The record time, time.monotonic() when omitted
+        """
+        if self.timestamps:
+            if timestamp is None:
+                timestamp = time.monotonic()
+            record = (timestamp,) + tuple(values)
+        else:
+            record = tuple(values)
+        written = int(self.__header[WRITTEN])
+        index = written % self.capacity
+        self.__data[index] = record
+        self.__data[index + self.capacity] = record
+        # Publish the record only once both copies are written
+        self.__header[WRITTEN] = written + 1
+
+    def extend(self, block, timestamps=None):
+        """
+        Append the rows of a 2D array, one column per field
+
+        The rows are written and published in parts of at most IN_FLIGHT
+        records, so read_since() stays safe while extend() runs.
+
+        :param block: An (N, fields) array without the timestamp column
+        :param timestamps: N timestamps, required when the buffer has them
+        """
+        rows = len(block)
+        columns = self.fields[1:] if self.timestamps else self.fields
+        start = 0
+        while start < rows:
+            written = int(self.__header[WRITTEN])
+            index = written % self.capacity
+            part_rows = min(rows - start, self.__in_flight,
+                            self.capacity - index)
+            part = slice(start, start + part_rows)
+            for target in (index, index + self.capacity):
+                destination = self.__data[target:target + part_rows]
+                if self.timestamps:
+                    destination[TIMESTAMP_FIELD] = timestamps[part]
+                for column, name in enumerate(columns):
+                    destination[name] = block[part, column]
+            # Publish the part only once both copies are written
+            self.__header[WRITTEN] = written + part_rows
+            start += part_rows
+
+    def __ordered(self, written, count):
+        end = written % self.capacity + self.capacity
+        return self.__data[end - count:end]
+
+    def view(self):
+        """
+        Get every stored record, oldest first
+
+        :return: A contiguous structured array view, valid until the
+                 producer wraps around
+        """
+        return self.__ordered(self.written, len(self))
+
+    def latest(self, count):
+        """
+        Get the newest records, oldest first
+
+        :param count: Number of records, at most the capacity
+        :return: A contiguous structured array view
+        """
+        return self.__ordered(self.written, min(count, len(self)))
+
+    def array(self):
+        """
+        Get every stored record as a 2D view, one column per field
+
+        Only possible when all fields share one dtype.
+
+        :return: An (N, fields) array view, oldest record first
+        """
+        view = self.view()
+        base_dtype = self.dtype.fields[self.fields[0]][0]
+        return view.view(base_dtype).reshape(len(view), len(self.fields))
+
+    def window(self, start_time, end_time=None):
+        """
+        Get the records with start_time <= t < end_time
+
+        Timestamps must be appended in increasing order.
+
+        :param start_time: Window start
+        :param end_time: Window end, None for up to the newest record
+        :return: A contiguous structured array view
+        """
+        view = self.view()
+        times = view[TIMESTAMP_FIELD]
+        first = np.searchsorted(times, start_time, side='left')
+        last = len(view) if end_time is None else \
+            np.searchsorted(times, end_time, side='left')
+        return view[first:last]
+
+    def read_since(self, cursor):
+        """
+        Copy the records appended after a consumer cursor
+
+        Safe to call from one consumer thread while one producer appends
+        or extends.
+
+        :param cursor: The written count returned by the previous call, or
+                       0 / buffer.written to start
+        :return: (records, new cursor, dropped), dropped being the number
+                 of records overwritten before they could be read
+        """
+        written = self.written
+        count = written - cursor
+        dropped = max(count - self.capacity, 0)
+        count -= dropped
+        records = self.__ordered(written, count).copy()
+        # Records the producer overwrote while we copied are not valid; the
+        # in flight records cover a part being written but not yet published
+        lost = self.written - written + self.__in_flight - \
+            (self.capacity - count)
+        if lost > 0:
+            lost = min(lost, count)
+            records = records[lost:]
+            dropped += lost
+        return records, written, dropped
+
+
+class SharedRingBuffer(RingBuffer):
+    """ RingBuffer in named shared memory, readable from other processes """
+
+    def __init__(self, name, fields, capacity=None, timestamps=True,
+                 dtype=np.float64, fill=None):
+        """
+        Create the ring when capacity is given, else attach to an existing
+        one. Both sides must pass the same fields, timestamps and dtype.
+
+        :param name: The shared memory block name
+        :param capacity: Number of records kept, None to attach
+        """
+        from multiprocessing import shared_memory
+
+        self.owner = capacity is not None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(
+                name, create=True,
+                size=RingBuffer.size(capacity, fields, timestamps, dtype))
+        else:
+            self.shm = shared_memory.SharedMemory(name)
+            # Only the creator removes the block: stop the resource
+            # tracker from unlinking it when this process exits
+            _untrack(self.shm)
+            capacity = int(np.ndarray((2,), np.int64,
+                                      self.shm.buf)[CAPACITY])
+        RingBuffer.__init__(self, capacity, fields, timestamps, dtype, fill,
+                            self.shm.buf)
+
+    def close(self):
+        """
+        Detach from the block, removing it if this process created it
+
+        Views returned by this ring must not be used afterwards.
+        """
+        # Drop the NumPy views first, the block cannot close while they
+        # are exported
+        del self._RingBuffer__data, self._RingBuffer__header
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def _untrack(shm):
+    try:
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    except (ImportError, AttributeError, KeyError):
+        pass
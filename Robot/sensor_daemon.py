@@ -0,0 +1,190 @@
+"""
+Out of process IMU acquisition
+
+run() measures with AngleMeterAlpha in the calling process and appends
+every raw sample, together with the orientation computed from it, to a
+SharedRingBuffer. start() does this in a separate process, so that sample
+timing does not depend on the GIL being shared with the camera stream
+server, the planner or NumPy work.
+
+Any number of SensorClient instances, in any process, attach to the ring
+by name. Reading needs no pickling or messages: latest() returns views of
+the shared block and read() copies only the new records.
+
+Timestamps are time.monotonic(), which is the same clock in every process.
+"""
+
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+
+import numpy as np
+
+from AngleMeterAlpha import AngleMeterAlpha, Orientation
+from ring_buffer import SharedRingBuffer
+
+RING_NAME = 'megabot_imu'
+CAPACITY = 4096
+START_TIMEOUT = 5.0
+
+# Record layout: t, sequence, the raw MPU6050 counts, then the orientation
+MOTION_FIELDS = ('ax', 'ay', 'az', 'gx', 'gy', 'gz')
+ORIENTATION_FIELDS = Orientation._fields[2:]
+FIELDS = [('sequence', np.int64)] + list(MOTION_FIELDS) + \
+    list(ORIENTATION_FIELDS)
+_ORIENTATION_START = 2 + len(MOTION_FIELDS)
+
+
+class _RecordingMeter(AngleMeterAlpha):
+    """ AngleMeterAlpha that keeps the raw sample of the latest update """
+
+    motion = (0, 0, 0, 0, 0, 0)
+
+    def read_motion(self):
+        self.motion = AngleMeterAlpha.read_motion(self)
+        return self.motion
+
+
+def _exit(signum, frame):
+    sys.exit(0)
+
+
+def run(name=RING_NAME, capacity=CAPACITY, ready=None, cpu=None,
+        **meter_args):
+    """
+    Measure and publish into a new shared ring until stopped
+
+    Blocks; SIGTERM and KeyboardInterrupt stop it and remove the ring.
+
+    :param name: The shared memory name
+    :param capacity: Number of records kept in the ring
+    :param ready: Optional multiprocessing.Event, set once the ring exists
+                  and the MPU6050 is initialised
+    :param cpu: Optional CPU number to pin this process to
+    :param meter_args: int_pin, fusion and magnetometer for AngleMeterAlpha
+    """
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, _exit)
+    if cpu is not None and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, {cpu})
+    ring = SharedRingBuffer(name, FIELDS, capacity)
+    try:
+        meter = _RecordingMeter(**meter_args)
+
+        def record(orientation):
+            ring.append((orientation.sequence,) + meter.motion +
+                        orientation[2:], orientation.timestamp)
+
+        meter.subscribe(record)
+        if ready is not None:
+            ready.set()
+        meter.measureAngles()
+    finally:
+        ring.close()
+
+
+def start(name=RING_NAME, capacity=CAPACITY, cpu=None,
+          timeout=START_TIMEOUT, **meter_args):
+    """
+    Start run() in a daemon process
+
+    :param timeout: Longest time to wait for the daemon to be ready (s)
+    :return: The multiprocessing.Process, once clients can attach
+    """
+    ready = multiprocessing.Event()
+    process = multiprocessing.Process(target=run, name='sensor_daemon',
+                                      args=(name, capacity, ready, cpu),
+                                      kwargs=meter_args, daemon=True)
+    process.start()
+    deadline = time.monotonic() + timeout
+    while not ready.wait(0.05):
+        if not process.is_alive() or time.monotonic() > deadline:
+            process.terminate()
+            process.join()
+            raise IOError("The sensor daemon did not start")
+    return process
+
+
+def stop(process, timeout=START_TIMEOUT):
+    """ Stop a daemon started with start() and wait for it to exit """
+    process.terminate()
+    process.join(timeout)
+
+
+class SensorClient:
+    """ Read access to a sensor daemon ring, from any process """
+
+    def __init__(self, name=RING_NAME):
+        """
+        :param name: The shared memory name given to run() or start()
+        """
+        self.ring = SharedRingBuffer(name, FIELDS)
+        self.cursor = self.ring.written
+        self.dropped = 0
+
+    def snapshot(self):
+        """
+        Get the newest orientation
+
+        :return: An Orientation, or None before the first sample
+        """
+        records = self.ring.latest(1)
+        if len(records) == 0:
+            return None
+        values = records[0].item()
+        return Orientation(values[0], values[1],
+                           *values[_ORIENTATION_START:])
+
+    def latest(self, count):
+        """
+        Get the newest records, oldest first
+
+        :param count: Number of records, at most the ring capacity
+        :return: A structured array view of the shared block, valid until
+                 the daemon wraps around
+        """
+        return self.ring.latest(count)
+
+    def read(self):
+        """
+        Copy the records published since the previous read
+
+        Records the daemon overwrote before they could be read are added
+        to dropped.
+
+        :return: A structured array with the FIELDS columns
+        """
+        records, self.cursor, dropped = self.ring.read_since(self.cursor)
+        self.dropped += dropped
+        return records
+
+    def wait_next(self, timeout=None, sequence=None, poll_period=0.001):
+        """
+        Wait for a record newer than sequence (default: the newest one)
+
+        :param timeout: Longest time to wait (s), None waits forever
+        :param poll_period: Time between checks of the ring (s)
+        :return: The Orientation, or None on timeout
+        """
+        if sequence is None:
+            latest = self.snapshot()
+            sequence = latest.sequence if latest is not None else 0
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            latest = self.snapshot()
+            if latest is not None and latest.sequence > sequence:
+                return latest
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            time.sleep(poll_period)
+
+    def close(self):
+        """ Detach from the ring """
+        self.ring.close()
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,134 @@
+"""
+Decoding of raw sensor words
+
+Every driver turns register bytes into signed values through this module:
+precompiled struct.Struct objects for single samples and
+numpy.frombuffer for bulk buffers such as FIFO drains. Functions accept
+bytes, bytearray, memoryview or the lists returned by
+SMBus.read_i2c_block_data.
+"""
+
+import struct
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# MPU-6050 ACCEL_XOUT_H .. GYRO_ZOUT_L: ax, ay, az, temp, gx, gy, gz
+MOTION6 = struct.Struct('>hhhhhhh')
+INT16_BE = struct.Struct('>h')
+INT16_LE = struct.Struct('<h')
+VECTOR_BE = struct.Struct('>hhh')
+VECTOR_LE = struct.Struct('<hhh')
+# AK8963 HXL .. ST2: x, y, z little endian then the ST2 status byte
+AK8963_DATA = struct.Struct('<hhhB')
+
+# The DMP packs 32 bit values of which the drivers use the high word
+DMP_QUATERNION = struct.Struct('>h2xh2xh2xh')
+DMP_VECTOR = struct.Struct('>h2xh2xh')
+DMP_QUATERNION_OFFSET = 0
+DMP_GYRO_OFFSET = 16
+DMP_ACCEL_OFFSET = 28
+
+INT16_BE_DTYPE = '>i2'
+
+
+def _buffer(data):
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return data
+    return bytes(data)
+
+
+def to_int16(value):
+    """
+    Interpret an integer as a two's complement 16 bit value
+
+    :param value: An unsigned or out of range integer
+    :return: The signed value (-32768..32767)
+    """
+    return ((int(value) + 0x8000) & 0xFFFF) - 0x8000
+
+
+def int16_be(data, offset=0):
+    """ Decode one big endian (high byte first) signed word """
+    return INT16_BE.unpack_from(_buffer(data), offset)[0]
+
+
+def int16_le(data, offset=0):
+    """ Decode one little endian (low byte first) signed word """
+    return INT16_LE.unpack_from(_buffer(data), offset)[0]
+
+
+def vector_be(data, offset=0):
+    """ Decode three big endian signed words (x, y, z) """
+    return VECTOR_BE.unpack_from(_buffer(data), offset)
+
+
+def vector_le(data, offset=0):
+    """ Decode three little endian signed words (x, y, z) """
+    return VECTOR_LE.unpack_from(_buffer(data), offset)
+
+
+def ak8963_data(data, offset=0):
+    """
+    Decode an AK8963 HXL .. ST2 burst
+
+    :return: (x, y, z, st2)
+    """
+    return AK8963_DATA.unpack_from(_buffer(data), offset)
+
+
+def motion6(data, offset=0):
+    """
+    Decode an MPU-6050 motion burst
+
+    :return: (ax, ay, az, temp, gx, gy, gz)
+    """
+    return MOTION6.unpack_from(_buffer(data), offset)
+
+
+def dmp_quaternion(data):
+    """ Decode the (w, x, y, z) high words of a DMP packet """
+    return DMP_QUATERNION.unpack_from(_buffer(data), DMP_QUATERNION_OFFSET)
+
+
+def dmp_gyro(data):
+    """ Decode the (x, y, z) gyro high words of a DMP packet """
+    return DMP_VECTOR.unpack_from(_buffer(data), DMP_GYRO_OFFSET)
+
+
+def dmp_acceleration(data):
+    """ Decode the (x, y, z) accel high words of a DMP packet """
+    return DMP_VECTOR.unpack_from(_buffer(data), DMP_ACCEL_OFFSET)
+
+
+def allocate_block(rows, columns):
+    """
+    Allocate an array for block_be output
+
+    :return: An (rows, columns) native int16 array
+    """
+    if np is None:
+        raise ImportError('numpy is needed for bulk decoding')
+    return np.zeros((rows, columns), dtype=np.int16)
+
+
+def block_be(data, columns, out=None):
+    """
+    Decode a buffer of big endian signed words into rows
+
+    :param data: The raw bytes, a whole number of rows long
+    :param columns: Words per row (e.g. 6 for accel + gyro FIFO records)
+    :param out: Optional preallocated array to copy the rows into
+    :return: An (N, columns) array: a zero copy big endian view of data,
+             or out[:N] when out is given
+    """
+    if np is None:
+        raise ImportError('numpy is needed for bulk decoding')
+    rows = np.frombuffer(_buffer(data), dtype=INT16_BE_DTYPE).reshape(
+        -1, columns)
+    if out is None:
+        return rows
+    out[:len(rows)] = rows
+    return out[:len(rows)]
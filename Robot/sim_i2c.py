@@ -0,0 +1,645 @@
+"""
+Simulated I2C bus and sensors for running the drivers without hardware
+
+SimSMBus implements the subset of the smbus/smbus2 API the drivers use and
+routes every transaction to a simulated device model:
+
+ - SimMPU6050: the MPU-6050 register map from MPUConstants, including
+   offsets, interrupt status, the FIFO (raw sensor sources and 42 byte DMP
+   packets) and the DMP memory banks
+ - SimHMC5883: the HMC5883L configuration, data and status registers
+ - SimAK8963: the AK8963 (MPU-9250 magnetometer) data, status and fuse ROM
+   registers
+
+Devices produce samples at the rate their configuration registers select,
+from a motion source (StationaryMotion or a recorded MotionPlayback). The
+bus counts transactions and bytes and can add a per-transaction and
+per-byte latency so loop throughput can be measured on a plain Linux box.
+"""
+
+import errno
+import math
+import random
+import struct
+import threading
+import time
+from collections import deque, namedtuple
+
+from MPUConstants import MPUConstants as C
+
+MotionSample = namedtuple('MotionSample', ['accel', 'gyro', 'mag', 'temp'])
+MotionSample.__doc__ = """
+One instant of motion: accel in g, gyro in deg/s, mag in uT (all x, y, z
+tuples in the sensor frame) and temperature in degrees Celsius
+"""
+
+# Earth field used when no magnetometer data is given, in uT
+DEFAULT_MAG = (20.0, 0.0, -40.0)
+
+
+class StationaryMotion:
+    """ A sensor lying flat and still """
+
+    def __init__(self, accel=(0.0, 0.0, 1.0), gyro=(0.0, 0.0, 0.0),
+                 mag=DEFAULT_MAG, temp=25.0):
+        self.sample = MotionSample(tuple(accel), tuple(gyro), tuple(mag),
+                                   temp)
+
+    def sample_at(self, a_time):
+        return self.sample
+
+
+class MotionPlayback:
+    """ Play back recorded motion at a fixed sample rate """
+
+    def __init__(self, samples, rate, loop=True):
+        """
+        :param samples: A sequence of MotionSample or
+                        (accel, gyro, mag, temp) tuples
+        :param rate: The rate the samples were recorded at (Hz)
+        :param loop: True: start over at the end
+                     False: hold the last sample
+        """
+        self.samples = [sample if isinstance(sample, MotionSample)
+                        else MotionSample(*sample) for sample in samples]
+        self.rate = rate
+        self.loop = loop
+
+    def sample_at(self, a_time):
+        index = int(a_time * self.rate)
+        if self.loop:
+            index %= len(self.samples)
+        else:
+            index = min(index, len(self.samples) - 1)
+        return self.samples[index]
+
+
+def _int16(value):
+    return max(-32768, min(32767, int(round(value))))
+
+
+class SimDevice:
+    """ Base class for simulated I2C slaves """
+
+    # Registers that are read or written as a stream in block transfers
+    # instead of advancing to the next register
+    STREAM_REGISTERS = ()
+
+    def __init__(self, motion=None, clock=time.monotonic):
+        self.motion = motion if motion is not None else StationaryMotion()
+        self.clock = clock
+        self.start_time = clock()
+        self.registers = bytearray(256)
+
+    def elapsed(self):
+        return self.clock() - self.start_time
+
+    def begin(self):
+        # Called once per bus transaction, so a block read always sees one
+        # consistent sample
+        self.update()
+
+    def update(self):
+        pass
+
+    def read(self, register):
+        return self.registers[register]
+
+    def write(self, register, value):
+        self.registers[register] = value & 0xFF
+
+    def streams(self, register):
+        return register in self.STREAM_REGISTERS
+
+
+class SimMPU6050(SimDevice):
+    """ Register level model of the MPU-6050 """
+
+    STREAM_REGISTERS = (C.MPU6050_RA_FIFO_R_W, C.MPU6050_RA_MEM_R_W)
+    FIFO_SIZE = 1024
+    DMP_PACKET = struct.Struct('>iiiiiiiiii2x')
+    DMP_RATE = 200.0
+    # The DMP reports acceleration at 8192 LSB/g whatever the range
+    DMP_ACCEL_SCALE = 8192.0
+
+    INT_DATA_RDY = 0x01
+    INT_DMP = 0x02
+    INT_FIFO_OFLOW = 0x10
+
+    def __init__(self, motion=None, clock=time.monotonic,
+                 accel_bias=(0.0, 0.0, 0.0), gyro_bias=(0.0, 0.0, 0.0),
+                 accel_noise=0.0, gyro_noise=0.0, seed=None):
+        """
+        :param accel_bias: Accelerometer bias added to the motion (g)
+        :param gyro_bias: Gyroscope bias added to the motion (deg/s)
+        :param accel_noise: Standard deviation of accelerometer noise (g)
+        :param gyro_noise: Standard deviation of gyroscope noise (deg/s)
+        :param seed: Seed for the noise generator
+        """
+        SimDevice.__init__(self, motion, clock)
+        self.accel_bias = accel_bias
+        self.gyro_bias = gyro_bias
+        self.accel_noise = accel_noise
+        self.gyro_noise = gyro_noise
+        self.random = random.Random(seed)
+        # DMP memory survives a register reset, like the real part between
+        # process restarts
+        self.memory = bytearray(C.MPU6050_DMP_MEMORY_BANKS *
+                                C.MPU6050_DMP_MEMORY_BANK_SIZE)
+        self.FIFO = deque()
+        self.samples = 0
+        self.DMP_packets = 0
+        self.overflows = 0
+        self.reset()
+
+    def reset(self):
+        self.registers[:] = bytes(len(self.registers))
+        self.registers[C.MPU6050_RA_PWR_MGMT_1] = 0x40
+        self.registers[C.MPU6050_RA_WHO_AM_I] = 0x68
+        self.memory_bank = 0
+        self.memory_address = 0
+        self.FIFO.clear()
+        self.quat = [1.0, 0.0, 0.0, 0.0]
+        self.sample_index = None
+        self.DMP_index = None
+
+    # Configuration decoded from the registers
+    def sample_rate(self):
+        dlpf = self.registers[C.MPU6050_RA_CONFIG] & 0x07
+        gyro_rate = 8000.0 if dlpf in (0, 7) else 1000.0
+        return gyro_rate / (1 + self.registers[C.MPU6050_RA_SMPLRT_DIV])
+
+    def accel_LSB(self):
+        return 16384.0 / (1 << ((self.registers[C.MPU6050_RA_ACCEL_CONFIG] >>
+                                 3) & 0x03))
+
+    def gyro_LSB(self):
+        return 131.0 / (1 << ((self.registers[C.MPU6050_RA_GYRO_CONFIG] >>
+                               3) & 0x03))
+
+    def offset(self, a_high_register):
+        return struct.unpack('>h', bytes(
+            self.registers[a_high_register:a_high_register + 2]))[0]
+
+    def raw_sample(self, a_time):
+        sample = self.motion.sample_at(a_time)
+        accel_LSB = self.accel_LSB()
+        gyro_LSB = self.gyro_LSB()
+        accel = []
+        gyro = []
+        for axis in range(0, 3):
+            # Accel offsets are in 16g units, gyro offsets in 1000 deg/s units
+            a_g = sample.accel[axis] + self.accel_bias[axis] + \
+                self.offset(C.MPU6050_RA_XA_OFFS_H + 2 * axis) / 2048.0
+            w_dps = sample.gyro[axis] + self.gyro_bias[axis] + \
+                self.offset(C.MPU6050_RA_XG_OFFS_USRH + 2 * axis) / 32.8
+            if self.accel_noise:
+                a_g += self.random.gauss(0.0, self.accel_noise)
+            if self.gyro_noise:
+                w_dps += self.random.gauss(0.0, self.gyro_noise)
+            accel.append(_int16(a_g * accel_LSB))
+            gyro.append(_int16(w_dps * gyro_LSB))
+        temp = _int16((sample.temp - 36.53) * 340.0)
+        return accel, temp, gyro, sample
+
+    # Sample generation
+    def update(self):
+        power = self.registers[C.MPU6050_RA_PWR_MGMT_1]
+        if power & 0x40:
+            # Sleeping
+            self.sample_index = None
+            return
+        now = self.elapsed()
+        rate = self.sample_rate()
+        index = int(now * rate)
+        if self.sample_index is None:
+            self.sample_index = index - 1
+        # Never replay more than one FIFO worth of missed samples
+        first = max(self.sample_index + 1, index - self.FIFO_SIZE)
+        for sample_index in range(first, index + 1):
+            self.produce_sample(sample_index / rate, 1.0 / rate)
+        self.sample_index = index
+
+    def produce_sample(self, a_time, a_dt):
+        accel, temp, gyro, sample = self.raw_sample(a_time)
+        self.samples += 1
+        data = struct.pack('>hhhhhhh', accel[0], accel[1], accel[2], temp,
+                           gyro[0], gyro[1], gyro[2])
+        self.registers[C.MPU6050_RA_ACCEL_XOUT_H:
+                       C.MPU6050_RA_ACCEL_XOUT_H + 14] = data
+        self.registers[C.MPU6050_RA_INT_STATUS] |= self.INT_DATA_RDY
+        self.integrate(sample.gyro, a_dt)
+
+        user_ctrl = self.registers[C.MPU6050_RA_USER_CTRL]
+        if not user_ctrl & (1 << C.MPU6050_USERCTRL_FIFO_EN_BIT):
+            return
+        if user_ctrl & (1 << C.MPU6050_USERCTRL_DMP_EN_BIT):
+            DMP_index = int(a_time * min(self.DMP_RATE, 1.0 / a_dt))
+            if DMP_index != self.DMP_index:
+                self.DMP_index = DMP_index
+                self.push_FIFO(self.DMP_packet(sample, gyro))
+                self.DMP_packets += 1
+                self.registers[C.MPU6050_RA_INT_STATUS] |= self.INT_DMP
+            return
+        sources = self.registers[C.MPU6050_RA_FIFO_EN]
+        FIFO_data = bytearray()
+        if sources & (1 << C.MPU6050_ACCEL_FIFO_EN_BIT):
+            FIFO_data += data[0:6]
+        if sources & (1 << C.MPU6050_TEMP_FIFO_EN_BIT):
+            FIFO_data += data[6:8]
+        if sources & (1 << C.MPU6050_XG_FIFO_EN_BIT):
+            FIFO_data += data[8:10]
+        if sources & (1 << C.MPU6050_YG_FIFO_EN_BIT):
+            FIFO_data += data[10:12]
+        if sources & (1 << C.MPU6050_ZG_FIFO_EN_BIT):
+            FIFO_data += data[12:14]
+        if FIFO_data:
+            self.push_FIFO(FIFO_data)
+
+    def integrate(self, a_gyro, a_dt):
+        # Propagate the orientation reported by the DMP: q += 0.5 q (0, w) dt
+        w, x, y, z = self.quat
+        gx, gy, gz = [math.radians(rate) * 0.5 * a_dt for rate in a_gyro]
+        w, x, y, z = (w - x * gx - y * gy - z * gz,
+                      x + w * gx + y * gz - z * gy,
+                      y + w * gy - x * gz + z * gx,
+                      z + w * gz + x * gy - y * gx)
+        norm = math.sqrt(w * w + x * x + y * y + z * z)
+        self.quat = [w / norm, x / norm, y / norm, z / norm]
+
+    def DMP_packet(self, a_sample, a_gyro):
+        quat = [int(round(component * (1 << 30))) for component in self.quat]
+        quat = [max(-(1 << 31), min((1 << 31) - 1, q)) for q in quat]
+        gyro = [value << 16 for value in a_gyro]
+        accel = [_int16(value * self.DMP_ACCEL_SCALE) << 16
+                 for value in a_sample.accel]
+        return self.DMP_PACKET.pack(*(quat + gyro + accel))
+
+    def push_FIFO(self, a_data):
+        for byte in a_data:
+            if len(self.FIFO) == self.FIFO_SIZE:
+                # The oldest byte is overwritten, like the real FIFO
+                self.FIFO.popleft()
+                if not self.registers[C.MPU6050_RA_INT_STATUS] & \
+                        self.INT_FIFO_OFLOW:
+                    self.overflows += 1
+                self.registers[C.MPU6050_RA_INT_STATUS] |= \
+                    self.INT_FIFO_OFLOW
+            self.FIFO.append(byte)
+
+    # Register access
+    def read(self, register):
+        if register == C.MPU6050_RA_INT_STATUS:
+            status = self.registers[register]
+            self.registers[register] = 0
+            return status
+        if register == C.MPU6050_RA_FIFO_COUNTH:
+            return len(self.FIFO) >> 8
+        if register == C.MPU6050_RA_FIFO_COUNTL:
+            return len(self.FIFO) & 0xFF
+        if register == C.MPU6050_RA_FIFO_R_W:
+            if self.FIFO:
+                return self.FIFO.popleft()
+            return 0
+        if register == C.MPU6050_RA_MEM_R_W:
+            value = self.memory_byte()
+            self.memory_address = (self.memory_address + 1) & 0xFF
+            return value
+        return self.registers[register]
+
+    def write(self, register, value):
+        value &= 0xFF
+        if register == C.MPU6050_RA_PWR_MGMT_1 and value & 0x80:
+            self.reset()
+            return
+        if register == C.MPU6050_RA_USER_CTRL:
+            if value & (1 << C.MPU6050_USERCTRL_FIFO_RESET_BIT):
+                self.FIFO.clear()
+            if value & (1 << C.MPU6050_USERCTRL_DMP_RESET_BIT):
+                self.quat = [1.0, 0.0, 0.0, 0.0]
+            # The reset bits clear themselves
+            value &= ~0x0F
+        elif register == C.MPU6050_RA_BANK_SEL:
+            self.memory_bank = value & 0x1F
+        elif register == C.MPU6050_RA_MEM_START_ADDR:
+            self.memory_address = value
+        elif register == C.MPU6050_RA_MEM_R_W:
+            if self.memory_bank < C.MPU6050_DMP_MEMORY_BANKS:
+                self.memory[self.memory_bank *
+                            C.MPU6050_DMP_MEMORY_BANK_SIZE +
+                            self.memory_address] = value
+            self.memory_address = (self.memory_address + 1) & 0xFF
+            return
+        elif register == C.MPU6050_RA_FIFO_R_W:
+            self.push_FIFO([value])
+            return
+        self.registers[register] = value
+
+    def memory_byte(self):
+        if self.memory_bank >= C.MPU6050_DMP_MEMORY_BANKS:
+            # User banks (hardware revision etc.) are not modelled
+            return 0
+        return self.memory[self.memory_bank * C.MPU6050_DMP_MEMORY_BANK_SIZE +
+                           self.memory_address]
+
+
+class SimHMC5883(SimDevice):
+    """ Register level model of the HMC5883L magnetometer """
+
+    CONFIG_A = 0x00
+    CONFIG_B = 0x01
+    MODE = 0x02
+    OUTPUT_X_MSB = 0x03
+    OUTPUT_Y_LSB = 0x08
+    STATUS = 0x09
+
+    # Output rates selected by CONFIG_A bits 4:2 (Hz)
+    RATES = (0.75, 1.5, 3.0, 7.5, 15.0, 30.0, 75.0, 75.0)
+    # Gains selected by CONFIG_B bits 7:5 (LSB/gauss)
+    GAINS = (1370.0, 1090.0, 820.0, 660.0, 440.0, 390.0, 330.0, 230.0)
+
+    def __init__(self, motion=None, clock=time.monotonic):
+        SimDevice.__init__(self, motion, clock)
+        self.registers[self.CONFIG_A] = 0x10
+        self.registers[self.CONFIG_B] = 0x20
+        self.registers[self.MODE] = 0x01
+        self.registers[0x0A:0x0D] = b'H43'
+        self.samples = 0
+        self.sample_index = None
+        self.single_pending = True
+
+    def data_ready(self):
+        self.begin()
+        return bool(self.registers[self.STATUS] & 0x01)
+
+    def update(self):
+        mode = self.registers[self.MODE] & 0x03
+        if mode == 0x01:
+            if self.single_pending:
+                self.single_pending = False
+                self.produce_sample()
+                # Back to idle after a single measurement
+                self.registers[self.MODE] = \
+                    (self.registers[self.MODE] & ~0x03) | 0x03
+            return
+        if mode != 0x00:
+            self.sample_index = None
+            return
+        rate = self.RATES[(self.registers[self.CONFIG_A] >> 2) & 0x07]
+        index = int(self.elapsed() * rate)
+        if index != self.sample_index:
+            self.sample_index = index
+            self.produce_sample()
+
+    def produce_sample(self):
+        sample = self.motion.sample_at(self.elapsed())
+        gain = self.GAINS[(self.registers[self.CONFIG_B] >> 5) & 0x07]
+        counts = []
+        for axis in (0, 2, 1):
+            # 1 gauss = 100 uT, out of range readings saturate to -4096
+            value = int(round(sample.mag[axis] / 100.0 * gain))
+            if value < -2048 or value > 2047:
+                value = -4096
+            counts.append(value)
+        self.registers[self.OUTPUT_X_MSB:self.OUTPUT_Y_LSB + 1] = \
+            struct.pack('>hhh', *counts)
+        self.registers[self.STATUS] |= 0x01
+        self.samples += 1
+
+    def read(self, register):
+        value = self.registers[register]
+        if register == self.OUTPUT_Y_LSB:
+            # Reading the last data register releases the sample
+            self.registers[self.STATUS] &= ~0x01
+        return value
+
+    def write(self, register, value):
+        if register in (self.CONFIG_A, self.CONFIG_B, self.MODE):
+            self.registers[register] = value & 0xFF
+            if register == self.MODE and value & 0x03 == 0x01:
+                self.single_pending = True
+            self.update()
+
+
+class SimAK8963(SimDevice):
+    """ Register level model of the AK8963 magnetometer """
+
+    WIA = 0x00
+    ST1 = 0x02
+    HXL = 0x03
+    ST2 = 0x09
+    CNTL1 = 0x0A
+    CNTL2 = 0x0B
+    ASAX = 0x10
+
+    # Continuous measurement rates selected by CNTL1 mode (Hz)
+    RATES = {0x02: 8.0, 0x06: 100.0}
+    FUSE_ROM_MODE = 0x0F
+    SINGLE_MODE = 0x01
+    # Measurement range, uT
+    RANGE = 4912.0
+
+    def __init__(self, motion=None, clock=time.monotonic,
+                 sensitivity=(0x80, 0x80, 0x80)):
+        """
+        :param sensitivity: Fuse ROM sensitivity adjustment (ASAX-ASAZ)
+        """
+        SimDevice.__init__(self, motion, clock)
+        self.registers[self.WIA] = 0x48
+        self.sensitivity = bytes(sensitivity)
+        self.reading = False
+        self.samples = 0
+        self.sample_index = None
+
+    def coefficients(self):
+        return [(value - 128) * 0.5 / 128.0 + 1.0
+                for value in self.sensitivity]
+
+    def update(self):
+        mode = self.registers[self.CNTL1] & 0x0F
+        if mode == self.SINGLE_MODE:
+            self.produce_sample()
+            self.registers[self.CNTL1] &= ~0x0F
+            return
+        rate = self.RATES.get(mode)
+        if rate is None:
+            self.sample_index = None
+            return
+        index = int(self.elapsed() * rate)
+        if index != self.sample_index:
+            self.sample_index = index
+            self.produce_sample()
+
+    def produce_sample(self):
+        sample = self.motion.sample_at(self.elapsed())
+        sixteen_bit = self.registers[self.CNTL1] & 0x10
+        resolution = 0.15 if sixteen_bit else 0.6
+        overflow = sum(abs(value) for value in sample.mag) > self.RANGE
+        counts = [_int16(sample.mag[axis] / coefficient / resolution)
+                  for axis, coefficient in enumerate(self.coefficients())]
+        if self.registers[self.ST1] & 0x01:
+            # The previous sample was never read
+            self.registers[self.ST1] |= 0x02
+        self.registers[self.HXL:self.HXL + 6] = struct.pack('<hhh', *counts)
+        self.registers[self.ST1] |= 0x01
+        self.registers[self.ST2] = (0x08 if overflow else 0x00) | \
+            (0x10 if sixteen_bit else 0x00)
+        self.samples += 1
+
+    def begin(self):
+        # New data is held back until the previous read ended with ST2
+        if not self.reading:
+            self.update()
+
+    def read(self, register):
+        # Polling ST1 only latches the data once it reports DRDY
+        if (register == self.ST1 and self.registers[self.ST1] & 0x01) or \
+                self.HXL <= register < self.ST2:
+            self.reading = True
+        if self.ASAX <= register < self.ASAX + 3:
+            if self.registers[self.CNTL1] & 0x0F != self.FUSE_ROM_MODE:
+                return 0
+            return self.sensitivity[register - self.ASAX]
+        value = self.registers[register]
+        if register == self.ST2:
+            # Reading ST2 ends the data read
+            self.registers[self.ST1] &= ~0x03
+            self.reading = False
+        return value
+
+    def write(self, register, value):
+        if register == self.CNTL2 and value & 0x01:
+            self.registers[self.CNTL1] = 0
+            self.registers[self.ST1] = 0
+            return
+        if register == self.CNTL1:
+            self.registers[register] = value & 0x1F
+            self.update()
+
+
+class SimSMBus:
+    """ SMBus lookalike that talks to simulated devices """
+
+    def __init__(self, bus=1, latency=0.0, byte_time=0.0):
+        """
+        :param bus: The bus number being simulated
+        :param latency: Extra time spent per transaction (s)
+        :param byte_time: Extra time spent per byte transferred (s),
+                          about 22.5e-6 for a 400 kHz bus
+        """
+        self.bus_number = bus
+        self.latency = latency
+        self.byte_time = byte_time
+        self.devices = {}
+        self.lock = threading.Lock()
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.transactions = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def attach(self, address, device):
+        self.devices[address] = device
+        return device
+
+    def close(self):
+        pass
+
+    def __device(self, address):
+        device = self.devices.get(address)
+        if device is None:
+            raise OSError(errno.EREMOTEIO, 'Remote I/O error')
+        return device
+
+    def __transfer(self, a_bytes_read, a_bytes_written):
+        self.transactions += 1
+        self.bytes_read += a_bytes_read
+        self.bytes_written += a_bytes_written
+        delay = self.latency + (a_bytes_read + a_bytes_written) * \
+            self.byte_time
+        if delay > 0.002:
+            time.sleep(delay)
+        elif delay > 0:
+            end_time = time.perf_counter() + delay
+            while time.perf_counter() < end_time:
+                pass
+
+    def read_byte_data(self, i2c_addr, register):
+        with self.lock:
+            device = self.__device(i2c_addr)
+            device.begin()
+            value = device.read(register)
+            self.__transfer(1, 1)
+            return value
+
+    def write_byte_data(self, i2c_addr, register, value):
+        with self.lock:
+            device = self.__device(i2c_addr)
+            device.begin()
+            device.write(register, value)
+            self.__transfer(0, 2)
+
+    def read_i2c_block_data(self, i2c_addr, register, length=32):
+        with self.lock:
+            device = self.__device(i2c_addr)
+            device.begin()
+            data = []
+            for index in range(0, length):
+                data.append(device.read(register))
+                if not device.streams(register):
+                    register += 1
+            self.__transfer(length, 1)
+            return data
+
+    def write_i2c_block_data(self, i2c_addr, register, data):
+        with self.lock:
+            device = self.__device(i2c_addr)
+            device.begin()
+            for value in data:
+                device.write(register, value)
+                if not device.streams(register):
+                    register += 1
+            self.__transfer(0, len(data) + 1)
+
+
+def create_bus(bus=1, motion=None, clock=time.monotonic, latency=0.0,
+               byte_time=0.0):
+    """
+    Create a simulated bus with the robot's sensors attached
+
+    An MPU-6050 at 0x68, an HMC5883L at 0x1E and an AK8963 at 0x0C all
+    follow the same motion source.
+
+    :return: The SimSMBus
+    """
+    sim_bus = SimSMBus(bus, latency, byte_time)
+    sim_bus.attach(C.MPU6050_DEFAULT_ADDRESS, SimMPU6050(motion, clock))
+    sim_bus.attach(0x1E, SimHMC5883(motion, clock))
+    sim_bus.attach(0x0C, SimAK8963(motion, clock))
+    return sim_bus
+
+
+_sim_buses = {}
+_sim_buses_lock = threading.Lock()
+
+
+def open_sim_bus(bus=1):
+    """
+    Get the process wide simulated bus for a bus number
+
+    Used by the 'sim' backend in i2c_bus so every driver opening the same
+    bus number talks to the same simulated devices.
+    """
+    with _sim_buses_lock:
+        sim_bus = _sim_buses.get(bus)
+        if sim_bus is None:
+            sim_bus = create_bus(bus)
+            _sim_buses[bus] = sim_bus
+        return sim_bus
+
+
+def install_sim_bus(sim_bus):
+    """ Make open_sim_bus return sim_bus for its bus number """
+    with _sim_buses_lock:
+        _sim_buses[sim_bus.bus_number] = sim_bus
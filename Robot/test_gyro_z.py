@@ -1,7 +1,10 @@
-import smbus
+from i2c_bus import open_bus, PRIORITY_IMU
 import time
 import threading
 import math
+from mpu6050 import read_motion_burst
+import sensor_decode
+import imu_calibration
 
 # Inisialisasi alamat I2C dan register MPU6050
 MPU6050_ADDR = 0x68
@@ -16,14 +19,20 @@ ACCEL_XOUT_H = 0x3B
 ACCEL_YOUT_H = 0x3D
 ACCEL_ZOUT_H = 0x3F
 
+# Faktor skala gyro pada +-250 dps (LSB per deg/s)
+GYRO_LSB = 131
+
 # Konfigurasi bus I2C
-bus = smbus.SMBus(1)
+bus = open_bus(1, PRIORITY_IMU)
 
 # Variable global untuk menyimpan sudut rotasi z
 rotation_angle_z = 0.0
 
-# Variable global untuk menyimpan nilai offset yang dihasilkan dari kalibrasi
-gyro_offset_z = 0.0
+# Estimasi offset gyro z, diperbarui setiap kali robot diam (sekitar 1 detik),
+# sehingga tidak perlu kalibrasi saat start
+gyro_bias = imu_calibration.GyroBiasTracker(
+    window=10, axes=1, max_std=0.5 * GYRO_LSB, max_change=2.0 * GYRO_LSB,
+    max_accel_std=0.01 * 16384.0)
 
 # Variabel global untuk menyimpan offset kalibrasi akselerometer
 accel_offset_x = 0
@@ -33,13 +42,12 @@ accel_offset_z = 0
 
 def read_word_2c(addr):
     # Membaca nilai 2-byte dari register MPU6050
-    high = bus.read_byte_data(MPU6050_ADDR, addr)
-    low = bus.read_byte_data(MPU6050_ADDR, addr + 1)
-    val = (high << 8) + low
-    if val >= 0x8000:
-        return -((65535 - val) + 1)
-    else:
-        return val
+    return sensor_decode.int16_be(
+        bus.read_i2c_block_data(MPU6050_ADDR, addr, 2))
+
+def read_motion():
+    # Membaca akselerometer, suhu dan gyro dalam satu transaksi I2C
+    return read_motion_burst(bus, MPU6050_ADDR)
 
 def set_gyro_scale(scale):
     # Mengatur faktor skala (scale factor) gyro
@@ -50,20 +58,12 @@ def set_gyro_scale(scale):
 #     # Mengatur Full Scale Range (FSR) akselerometer
 #     bus.write_byte_data(MPU6050_ADDR, ACCEL_CONFIG, fsr << 3)
 
-def calibrate_gyro():
-    # Mengkalibrasi gyro untuk menghitung nilai offset
-    global gyro_offset_z
-    gyro_data = []
-    for _ in range(1000):  # Ambil 1000 bacaan untuk kalibrasi
-        gyro_data.append(read_word_2c(GYRO_ZOUT_H))
-        time.sleep(0.001)  # Delay 0.001 detik
-    gyro_offset_z = sum(gyro_data) / len(gyro_data)
-
 def get_pitch_and_roll():
     # Membaca data akselerometer dari MPU6050 dan menghitung pitch dan roll
-    accel_x = read_word_2c(ACCEL_XOUT_H) - accel_offset_x
-    accel_y = read_word_2c(ACCEL_YOUT_H) - accel_offset_y
-    accel_z = read_word_2c(ACCEL_ZOUT_H) - accel_offset_z
+    accel_x, accel_y, accel_z = read_motion()[0:3]
+    accel_x -= accel_offset_x
+    accel_y -= accel_offset_y
+    accel_z -= accel_offset_z
     
     # Mengonversi nilai akselerometer menjadi g
     accel_scale = 16384.0  # Faktor skala untuk akselerometer (per dokumentasi MPU6050)
@@ -83,11 +83,13 @@ def get_pitch_and_roll():
 
 def get_rotation_angle():
     # Membaca data gyro z dari MPU6050 dan menghitung rotasi sudut z
-    gyro_z = read_word_2c(GYRO_ZOUT_H)
+    accel_x, accel_y, accel_z, temp, gyro_x, gyro_y, gyro_z = read_motion()
+    # Mengurangi offset; akselerometer dipakai untuk mendeteksi robot diam
+    gyro_z, = gyro_bias.update((gyro_z,), (accel_x, accel_y, accel_z))
     # Mengonversi ke satuan sudut (misalnya, radian)
     # Anda mungkin perlu mengkalibrasi data gyro sesuai dengan kebutuhan aplikasi Anda
     gyro_scale = 131 # Faktor skala untuk gyro z (per dokumentasi MPU6050)
-    gyro_z_scaled = (gyro_z - gyro_offset_z) / gyro_scale
+    gyro_z_scaled = gyro_z / gyro_scale
     return gyro_z_scaled
 
 def apply_lowpass_filter(current_value, new_value):
@@ -127,11 +129,6 @@ bus.write_byte_data(MPU6050_ADDR, PWR_MGMT_1, 0)
 set_gyro_scale(0b00)  # 0b11 adalah untuk faktor skala 2000 DPS
 # set_accel_fsr(0)  # 0 untuk skala +-2g
 
-print("Kalibrasi...")
-# Kalibrasi gyro
-calibrate_gyro()
-print("Kalibrasi selesai")
-
 # Buat thread untuk mengukur sudut rotasi z secara kontinu
 dt = 0.1  # Interval waktu untuk pengukuran (misalnya, 0.01 detik)
 gyro_thread = threading.Thread(target=integrate_gyro_data, args=(dt,))